@@ -95,4 +95,17 @@ def create_app() -> Flask:
             warmup_embeddings()
         except Exception as exc:
             logger.warning(f"Embedding warmup skipped due to error: {exc}")
+
+        # Центроиды векторного роутинга тем собираются в фоне, а не первым запросом
+        if getattr(CONFIG, "theme_router_mode", "") == "vector":
+            from app.retrieval.theme_router import THEMES_PROVIDER
+            from app.retrieval.vector_theme_router import get_vector_theme_router
+
+            get_vector_theme_router().schedule_build(THEMES_PROVIDER)
+
+    # Фоновый сэмплер горячих функций (PROFILER_BACKGROUND_ENABLED), см. /v1/admin/profile/summary
+    if os.environ.get("WERKZEUG_RUN_MAIN") != "false":
+        from app.infrastructure.profiler import get_background_sampler
+
+        get_background_sampler()
     return app
@@ -0,0 +1,91 @@
+"""
+ASGI-приложение: /v1/chat/query обслуживается асинхронным пайплайном,
+остальные маршруты (стриминг, batch, админка, quality, Swagger) — Flask-
+приложением, смонтированным через WSGI-адаптер.
+
+Запуск: uvicorn asgi:app --host 0.0.0.0 --port 9000
+"""
+from __future__ import annotations
+
+import contextlib
+from typing import Any, AsyncIterator, Optional
+
+from loguru import logger
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ModuleNotFoundError:  # pragma: no cover - optional dependency
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+
+async def chat_query(request: Request) -> JSONResponse:
+    """Асинхронный аналог Flask-маршрута chat.chat_query (тот же контракт)."""
+    from app.infrastructure.admission import AdmissionDecision, admission, overloaded_response
+    from app.orchestration.async_orchestrator import handle_query_async
+    from app.routes.chat import check_chat_payload
+
+    try:
+        try:
+            payload = await request.json()
+        except ValueError:
+            payload = None
+        validated_data, security_result, error = check_chat_payload(payload if isinstance(payload, dict) else {})
+        if error is not None:
+            body, status = error
+            return JSONResponse(body, status_code=status)
+
+        with admission() as decision:
+            if decision is AdmissionDecision.REJECT:
+                body = overloaded_response()
+                return JSONResponse(body, status_code=503, headers={"Retry-After": str(body["retry_after"])})
+            result = await handle_query_async(
+                channel=validated_data["channel"],
+                chat_id=validated_data["chat_id"],
+                message=security_result["sanitized_message"],
+            )
+
+        result["request_id"] = request.headers.get("X-Request-ID", "unknown")
+        result["security_warnings"] = security_result.get("warnings", [])
+        return JSONResponse(result)
+
+    except Exception as e:
+        logger.error(f"Unexpected error in chat_query (async): {e}", exc_info=True)
+        return JSONResponse({
+            "error": "internal_error",
+            "message": "Внутренняя ошибка сервера. Попробуйте позже."
+        }, status_code=500)
+
+
+@contextlib.asynccontextmanager
+async def _lifespan(_app: Starlette) -> AsyncIterator[None]:
+    yield
+    from app.infrastructure.http_client import close_async_provider_http_clients
+    from app.orchestration.async_orchestrator import shutdown_cpu_executor
+    from app.retrieval.retrieval import close_async_client
+
+    await close_async_provider_http_clients()
+    await close_async_client()
+    shutdown_cpu_executor()
+
+
+def create_asgi_app(flask_app: Optional[Any] = None) -> Starlette:
+    """
+    Args:
+        flask_app: WSGI-приложение для остальных маршрутов (по умолчанию create_app())
+    """
+    if flask_app is None:
+        from app import create_app
+
+        flask_app = create_app()
+
+    return Starlette(
+        routes=[
+            Route("/v1/chat/query", chat_query, methods=["POST"]),
+            Mount("/", app=WSGIMiddleware(flask_app)),
+        ],
+        lifespan=_lifespan,
+    )
@@ -48,8 +48,16 @@ class AppConfig:
     reranker_model: str = os.getenv("RERANKER_MODEL", "BAAI/bge-reranker-v2-m3")
     reranker_device: str = os.getenv("RERANKER_DEVICE", "cpu")
     reranker_threads: int = int(os.getenv("RERANKER_THREADS", "12"))
+    # Общий воркер реранкера: пары (query, doc) от разных запросов упаковываются в общие батчи
+    reranker_batching_enabled: bool = os.getenv("RERANKER_BATCHING_ENABLED", "true").lower() in ("1", "true", "yes")
+    reranker_batch_size: int = int(os.getenv("RERANKER_BATCH_SIZE", "32"))
+    reranker_max_wait_ms: int = int(os.getenv("RERANKER_MAX_WAIT_MS", "5"))
+    reranker_queue_size: int = int(os.getenv("RERANKER_QUEUE_SIZE", "64"))
+    reranker_queue_timeout_ms: int = int(os.getenv("RERANKER_QUEUE_TIMEOUT_MS", "100"))
+    reranker_job_timeout_s: float = float(os.getenv("RERANKER_JOB_TIMEOUT_S", "30"))
     retrieval_auto_merge_enabled: bool = os.getenv("RETRIEVAL_AUTO_MERGE_ENABLED", "true").lower() in ("1", "true", "yes")
     retrieval_auto_merge_max_tokens: int = int(os.getenv("RETRIEVAL_AUTO_MERGE_MAX_TOKENS", "1200"))
+    retrieval_auto_merge_prefetch_docs: int = int(os.getenv("RETRIEVAL_AUTO_MERGE_PREFETCH_DOCS", "10"))
     retrieval_auto_merge_use_tiktoken: bool = os.getenv("RETRIEVAL_AUTO_MERGE_USE_TIKTOKEN", "true").lower() in ("1", "true", "yes")
     retrieval_cache_maxsize: int = int(os.getenv("RETRIEVAL_CACHE_MAXSIZE", "1000"))
     retrieval_cache_ttl: int = int(os.getenv("RETRIEVAL_CACHE_TTL", "300"))  # seconds
@@ -66,6 +74,35 @@ class AppConfig:
     # LLMs
     default_llm: str = os.getenv("DEFAULT_LLM", "YANDEX").upper()
     core_outputs_format: str = os.getenv("CORE_OUTPUTS_FORMAT", "markdown")
+    # Провайдеры, вызываемые в потоковом режиме для /v1/chat/stream; остальные — обычным запросом
+    llm_stream_providers: str = os.getenv("LLM_STREAM_PROVIDERS", "YANDEX,GIGACHAT,GPT5,DEEPSEEK").upper()
+    # Hedged-запросы: если основной провайдер не ответил за перцентиль своей задержки,
+    # параллельно запускается следующий; побеждает первый успешный ответ
+    llm_hedging_enabled: bool = os.getenv("LLM_HEDGING_ENABLED", "true").lower() in ("1", "true", "yes")
+    llm_hedge_percentile: float = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+    llm_hedge_min_samples: int = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+    llm_hedge_default_delay_s: float = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY_S", "8.0"))
+    llm_hedge_min_delay_s: float = float(os.getenv("LLM_HEDGE_MIN_DELAY_S", "0.5"))
+    llm_hedge_max_extra: int = int(os.getenv("LLM_HEDGE_MAX_EXTRA", "1"))
+    llm_provider_max_concurrency: int = int(os.getenv("LLM_PROVIDER_MAX_CONCURRENCY", "8"))
+    llm_hedge_max_workers: int = int(os.getenv("LLM_HEDGE_MAX_WORKERS", "32"))
+    # Пул keep-alive HTTP-клиентов к провайдерам LLM
+    llm_http_connect_timeout_s: float = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT_S", "5"))
+    llm_http_read_timeout_s: float = float(os.getenv("LLM_HTTP_READ_TIMEOUT_S", "60"))
+    llm_http_timeouts: str = os.getenv("LLM_HTTP_TIMEOUTS", "")  # переопределения: YANDEX=3/60,GPT5=5/90
+    llm_http_max_retries: int = int(os.getenv("LLM_HTTP_MAX_RETRIES", "2"))
+    llm_http_backoff_base_s: float = float(os.getenv("LLM_HTTP_BACKOFF_BASE_S", "0.2"))
+    llm_http_pool_size: int = int(os.getenv("LLM_HTTP_POOL_SIZE", "16"))
+    llm_http2_enabled: bool = os.getenv("LLM_HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
+    # Упаковка контекста: дедупликация повторов (overlap, auto-merge) и точный бюджет токенов
+    llm_context_packing_enabled: bool = os.getenv("LLM_CONTEXT_PACKING_ENABLED", "true").lower() in ("1", "true", "yes")
+    llm_context_max_tokens: int = int(os.getenv("LLM_CONTEXT_MAX_TOKENS", "2400"))
+    # Динамический порядок провайдеров: EWMA задержки и доли ошибок, открытые breakers пропускаются
+    llm_dynamic_ordering_enabled: bool = os.getenv("LLM_DYNAMIC_ORDERING_ENABLED", "true").lower() in ("1", "true", "yes")
+    llm_scheduler_ewma_alpha: float = float(os.getenv("LLM_SCHEDULER_EWMA_ALPHA", "0.3"))
+    llm_scheduler_prior_latency_s: float = float(os.getenv("LLM_SCHEDULER_PRIOR_LATENCY_S", "5.0"))
+    llm_scheduler_failure_penalty_s: float = float(os.getenv("LLM_SCHEDULER_FAILURE_PENALTY_S", "10.0"))
+    llm_scheduler_error_half_life_s: float = float(os.getenv("LLM_SCHEDULER_ERROR_HALF_LIFE_S", "300"))
     deepseek_api_url: str = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
     deepseek_api_key: str = os.getenv("DEEPSEEK_API_KEY", "")
     deepseek_model: str = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
@@ -89,12 +126,28 @@ class AppConfig:
 
     # Theme router
     theme_router_mode: str = os.getenv("THEME_ROUTER_MODE", "heuristic").lower()
+    # Режим vector: центроиды тем по описаниям из themes.yaml и dense-векторам проиндексированных чанков
+    theme_router_vector_min_margin: float = float(os.getenv("THEME_ROUTER_VECTOR_MIN_MARGIN", "0.03"))
+    theme_router_vector_llm_fallback: bool = os.getenv("THEME_ROUTER_VECTOR_LLM_FALLBACK", "true").lower() in ("1", "true", "yes")
+    theme_router_vector_samples: int = int(os.getenv("THEME_ROUTER_VECTOR_SAMPLES", "64"))
+    theme_router_vector_description_weight: float = float(os.getenv("THEME_ROUTER_VECTOR_DESCRIPTION_WEIGHT", "0.3"))
+    # Фильтр Qdrant по теме для vector-роутера: вероятность топ-темы и отрыв по косинусу от второй темы
+    theme_filter_vector_min_score: float = float(os.getenv("THEME_FILTER_VECTOR_MIN_SCORE", "0.8"))
+    theme_filter_vector_min_margin: float = float(os.getenv("THEME_FILTER_VECTOR_MIN_MARGIN", "0.08"))
+    theme_router_cache_enabled: bool = os.getenv("THEME_ROUTER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    theme_router_cache_ttl_s: int = int(os.getenv("THEME_ROUTER_CACHE_TTL_S", "600"))
+    theme_router_cache_max_items: int = int(os.getenv("THEME_ROUTER_CACHE_MAX_ITEMS", "2000"))
 
     # Query logging
     query_log_enabled: bool = os.getenv("QUERY_LOG_ENABLED", "true").lower() in ("1", "true", "yes")
     query_log_dir: str = os.getenv("QUERY_LOG_DIR", "logs")
     query_log_max_candidates: int = int(os.getenv("QUERY_LOG_MAX_CANDIDATES", "20"))
     query_log_text_prefix_len: int = int(os.getenv("QUERY_LOG_TEXT_PREFIX_LEN", "300"))
+    # Фоновая запись логов (лог запросов, диагностика): очередь, пачка, ротация по размеру, сжатие
+    log_sink_queue_size: int = int(os.getenv("LOG_SINK_QUEUE_SIZE", "10000"))
+    log_sink_batch_size: int = int(os.getenv("LOG_SINK_BATCH_SIZE", "256"))
+    log_sink_max_file_mb: float = float(os.getenv("LOG_SINK_MAX_FILE_MB", "100"))
+    log_sink_compression: str = os.getenv("LOG_SINK_COMPRESSION", "none").lower()
 
     # Telegram
     telegram_bot_token: str = os.getenv("TELEGRAM_BOT_TOKEN", "")
@@ -108,6 +161,58 @@ class AppConfig:
     # Caching
     redis_url: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
     cache_enabled: bool = os.getenv("CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    # Процессный кэш (без Redis — единственный уровень, с Redis — L1): лимит элементов, общий бюджет и бюджеты по префиксу ключа (МБ), политика
+    cache_memory_max_items: int = int(os.getenv("CACHE_MEMORY_MAX_ITEMS", "1000"))
+    cache_memory_max_mb: float = float(os.getenv("CACHE_MEMORY_MAX_MB", "256"))
+    cache_memory_prefix_budgets_mb: str = os.getenv("CACHE_MEMORY_PREFIX_BUDGETS_MB", "")  # embedding=128,search=64
+    cache_memory_policy: str = os.getenv("CACHE_MEMORY_POLICY", "lru").lower()
+    # L1 перед Redis: срок жизни копии в процессе и канал pub/sub для инвалидации копий в других воркерах
+    cache_l1_enabled: bool = os.getenv("CACHE_L1_ENABLED", "true").lower() in ("1", "true", "yes")
+    cache_l1_ttl_s: int = int(os.getenv("CACHE_L1_TTL_S", "60"))
+    cache_invalidation_channel: str = os.getenv("CACHE_INVALIDATION_CHANNEL", "rag:cache:invalidate")
+    # Формат значений в Redis: json (прежний) или binary (векторы — сырые float32/float16, остальное — msgpack/JSON).
+    # По умолчанию json: binary включается, когда все воркеры обновлены и читают оба формата
+    cache_codec: str = os.getenv("CACHE_CODEC", "json").lower()
+    cache_vector_dtype: str = os.getenv("CACHE_VECTOR_DTYPE", "float32").lower()
+    # @cached: блокировка вычисления ключа (TTL и ожидание чужого результата), кэш ошибок, раннее обновление (XFetch)
+    cache_lock_ttl_s: float = float(os.getenv("CACHE_LOCK_TTL_S", "30"))
+    cache_lock_wait_s: float = float(os.getenv("CACHE_LOCK_WAIT_S", "5"))
+    cache_negative_ttl_s: int = int(os.getenv("CACHE_NEGATIVE_TTL_S", "5"))
+    cache_early_refresh_beta: float = float(os.getenv("CACHE_EARLY_REFRESH_BETA", "1.0"))
+    # Объединение одинаковых одновременных запросов к /v1/chat/query в одно выполнение пайплайна
+    query_coalescing_enabled: bool = os.getenv("QUERY_COALESCING_ENABLED", "true").lower() in ("1", "true", "yes")
+    query_coalescing_wait_s: float = float(os.getenv("QUERY_COALESCING_WAIT_S", "60"))
+    # Кэш готовых ответов LLM (ключ: запрос, отпечаток контекста, версия промптов, провайдеры, поколение коллекции)
+    answer_cache_enabled: bool = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    answer_cache_ttl_s: int = int(os.getenv("ANSWER_CACHE_TTL_S", "3600"))
+    answer_cache_skip_query_types: str = os.getenv("ANSWER_CACHE_SKIP_QUERY_TYPES", "troubleshooting").lower()
+    # ASGI (asgi.py): размер пула потоков для CPU-этапов асинхронного пайплайна (0 = число ядер)
+    async_cpu_workers: int = int(os.getenv("ASYNC_CPU_WORKERS", "0"))
+    # Граф этапов запроса: спекулятивный поиск без фильтра параллельно с роутингом, потоки для этапов
+    speculative_search_enabled: bool = os.getenv("SPECULATIVE_SEARCH_ENABLED", "true").lower() in ("1", "true", "yes")
+    pipeline_stage_workers: int = int(os.getenv("PIPELINE_STAGE_WORKERS", "0"))
+    # Дедлайн запроса (с): при нехватке времени этапы деградируют (k, rerank, auto-merge, провайдер); 0 = без дедлайна
+    request_deadline_s: float = float(os.getenv("REQUEST_DEADLINE_S", "0"))
+    # Admission control /v1/chat/query: пороги запросов в работе и глубины очередей этапов (0 = без порога)
+    admission_control_enabled: bool = os.getenv("ADMISSION_CONTROL_ENABLED", "true").lower() in ("1", "true", "yes")
+    admission_degrade_in_flight: int = int(os.getenv("ADMISSION_DEGRADE_IN_FLIGHT", "32"))
+    admission_reject_in_flight: int = int(os.getenv("ADMISSION_REJECT_IN_FLIGHT", "64"))
+    admission_degrade_queue_depth: int = int(os.getenv("ADMISSION_DEGRADE_QUEUE_DEPTH", "16"))
+    admission_reject_queue_depth: int = int(os.getenv("ADMISSION_REJECT_QUEUE_DEPTH", "48"))
+    admission_retry_after_s: int = int(os.getenv("ADMISSION_RETRY_AFTER_S", "2"))
+    # Трассировка запросов: доля сэмплируемых, лимит спанов, файл экспорта OTLP JSON ("" = нет)
+    tracing_sample_rate: float = float(os.getenv("TRACING_SAMPLE_RATE", "0.1"))
+    tracing_max_spans: int = int(os.getenv("TRACING_MAX_SPANS", "256"))
+    tracing_export_path: str = os.getenv("TRACING_EXPORT_PATH", "")
+    # Профилировщик (/v1/admin/profile): предел длительности; фоновый сэмплер горячих функций
+    profiler_max_duration_s: float = float(os.getenv("PROFILER_MAX_DURATION_S", "60"))
+    profiler_background_enabled: bool = os.getenv("PROFILER_BACKGROUND_ENABLED", "false").lower() in ("1", "true", "yes")
+    profiler_background_interval_s: float = float(os.getenv("PROFILER_BACKGROUND_INTERVAL_S", "0.1"))
+    profiler_background_window_s: float = float(os.getenv("PROFILER_BACKGROUND_WINDOW_S", "300"))
+    # Пакетный API /v1/chat/batch: максимум вопросов, порция retrieval, одновременные вызовы LLM
+    chat_batch_max_size: int = int(os.getenv("CHAT_BATCH_MAX_SIZE", "500"))
+    chat_batch_chunk_size: int = int(os.getenv("CHAT_BATCH_CHUNK_SIZE", "32"))
+    chat_batch_llm_concurrency: int = int(os.getenv("CHAT_BATCH_LLM_CONCURRENCY", "4"))
 
     # Ingestion
     crawl_start_url: str = os.getenv("CRAWL_START_URL", "https://docs-chatcenter.edna.ru/")
@@ -139,6 +244,11 @@ class AppConfig:
     ragas_batch_size: int = int(os.getenv("RAGAS_BATCH_SIZE", "5"))
     ragas_async_timeout: int = int(os.getenv("RAGAS_ASYNC_TIMEOUT", "60"))
     ragas_llm_model: str = os.getenv("RAGAS_LLM_MODEL", "yandexgpt")
+    # Фоновая очередь качества: сохранение взаимодействий пачками, отложенные RAGAS-оценки
+    quality_queue_max_size: int = int(os.getenv("QUALITY_QUEUE_MAX_SIZE", "1000"))
+    quality_queue_batch_size: int = int(os.getenv("QUALITY_QUEUE_BATCH_SIZE", "20"))
+    quality_queue_flush_interval_s: float = float(os.getenv("QUALITY_QUEUE_FLUSH_INTERVAL_S", "1.0"))
+    ragas_max_pending: int = int(os.getenv("RAGAS_MAX_PENDING", "50"))
 
     # Runtime boost synonyms (used by group_boosts context)
     group_boost_synonyms_raw: str = os.getenv("GROUP_BOOST_SYNONYMS", "")
@@ -234,9 +344,116 @@ class AppConfig:
         if self.qdrant_scroll_batch_size <= 0:
             errors.append("qdrant_scroll_batch_size must be positive")
 
+        if self.reranker_batch_size <= 0:
+            errors.append("reranker_batch_size must be positive")
+
+        if self.reranker_queue_size <= 0:
+            errors.append("reranker_queue_size must be positive")
+
+        if self.reranker_max_wait_ms < 0 or self.reranker_queue_timeout_ms < 0:
+            errors.append("reranker wait/queue timeouts must be non-negative")
+
         if self.gigachat_timeout <= 0:
             errors.append("gigachat_timeout must be positive")
 
+        if not 0.0 < self.llm_hedge_percentile <= 1.0:
+            errors.append("llm_hedge_percentile must be in (0, 1]")
+
+        if self.llm_provider_max_concurrency <= 0 or self.llm_hedge_max_workers <= 0:
+            errors.append("llm_provider_max_concurrency and llm_hedge_max_workers must be positive")
+
+        if self.llm_hedge_max_extra < 0:
+            errors.append("llm_hedge_max_extra must be non-negative")
+
+        if self.llm_http_connect_timeout_s <= 0 or self.llm_http_read_timeout_s <= 0:
+            errors.append("llm_http connect/read timeouts must be positive")
+
+        if self.llm_http_pool_size <= 0:
+            errors.append("llm_http_pool_size must be positive")
+
+        if not 0.0 <= self.theme_router_vector_description_weight <= 1.0:
+            errors.append("theme_router_vector_description_weight must be in [0, 1]")
+
+        if not 0.0 <= self.theme_filter_vector_min_score <= 1.0:
+            errors.append("theme_filter_vector_min_score must be in [0, 1]")
+
+        if self.theme_filter_vector_min_margin < 0:
+            errors.append("theme_filter_vector_min_margin must be non-negative")
+
+        if self.query_coalescing_wait_s <= 0:
+            errors.append("query_coalescing_wait_s must be positive")
+
+        if self.answer_cache_ttl_s <= 0:
+            errors.append("answer_cache_ttl_s must be positive")
+
+        if self.cache_memory_max_items <= 0 or self.cache_memory_max_mb < 0:
+            errors.append("cache_memory_max_items must be positive and cache_memory_max_mb non-negative")
+        if self.cache_memory_policy not in ("lru", "tinylfu"):
+            errors.append("cache_memory_policy must be one of: lru, tinylfu")
+        if self.cache_l1_ttl_s <= 0:
+            errors.append("cache_l1_ttl_s must be positive")
+        if self.cache_codec not in ("json", "binary"):
+            errors.append("cache_codec must be one of: json, binary")
+        if self.cache_vector_dtype not in ("float32", "float16"):
+            errors.append("cache_vector_dtype must be one of: float32, float16")
+        if self.cache_lock_ttl_s <= 0 or self.cache_lock_wait_s < 0:
+            errors.append("cache_lock_ttl_s must be positive and cache_lock_wait_s non-negative")
+        if self.cache_negative_ttl_s < 0 or self.cache_early_refresh_beta < 0:
+            errors.append("cache_negative_ttl_s and cache_early_refresh_beta must be non-negative")
+
+        if self.async_cpu_workers < 0:
+            errors.append("async_cpu_workers must be non-negative")
+        if self.pipeline_stage_workers < 0:
+            errors.append("pipeline_stage_workers must be non-negative")
+        if self.request_deadline_s < 0:
+            errors.append("request_deadline_s must be non-negative")
+        admission_thresholds = (
+            self.admission_degrade_in_flight,
+            self.admission_reject_in_flight,
+            self.admission_degrade_queue_depth,
+            self.admission_reject_queue_depth,
+        )
+        if any(threshold < 0 for threshold in admission_thresholds):
+            errors.append("admission thresholds must be non-negative")
+        if self.admission_retry_after_s <= 0:
+            errors.append("admission_retry_after_s must be positive")
+        if not 0.0 <= self.tracing_sample_rate <= 1.0:
+            errors.append("tracing_sample_rate must be between 0 and 1")
+        if self.log_sink_queue_size <= 0 or self.log_sink_batch_size <= 0 or self.log_sink_max_file_mb <= 0:
+            errors.append("log_sink_queue_size, log_sink_batch_size and log_sink_max_file_mb must be positive")
+        if self.log_sink_compression not in ("none", "gzip", "zstd"):
+            errors.append("log_sink_compression must be one of: none, gzip, zstd")
+        if self.tracing_max_spans <= 0:
+            errors.append("tracing_max_spans must be positive")
+        if self.profiler_max_duration_s <= 0:
+            errors.append("profiler_max_duration_s must be positive")
+        if self.profiler_background_interval_s <= 0 or self.profiler_background_window_s <= 0:
+            errors.append("profiler_background_interval_s and profiler_background_window_s must be positive")
+        if self.chat_batch_max_size <= 0 or self.chat_batch_chunk_size <= 0:
+            errors.append("chat_batch_max_size and chat_batch_chunk_size must be positive")
+        if self.chat_batch_llm_concurrency <= 0:
+            errors.append("chat_batch_llm_concurrency must be positive")
+        if self.retrieval_auto_merge_prefetch_docs < 0:
+            errors.append("retrieval_auto_merge_prefetch_docs must be non-negative")
+
+        if self.quality_queue_max_size <= 0 or self.quality_queue_batch_size <= 0 or self.ragas_max_pending <= 0:
+            errors.append("quality_queue_max_size, quality_queue_batch_size and ragas_max_pending must be positive")
+
+        if not 0.0 <= self.ragas_evaluation_sample_rate <= 1.0:
+            errors.append("ragas_evaluation_sample_rate must be in [0, 1]")
+
+        if self.theme_router_cache_ttl_s <= 0 or self.theme_router_cache_max_items <= 0:
+            errors.append("theme_router_cache ttl and max_items must be positive")
+
+        if self.llm_context_max_tokens <= 0:
+            errors.append("llm_context_max_tokens must be positive")
+
+        if not 0.0 < self.llm_scheduler_ewma_alpha <= 1.0:
+            errors.append("llm_scheduler_ewma_alpha must be in (0, 1]")
+
+        if self.llm_scheduler_prior_latency_s <= 0 or self.llm_scheduler_error_half_life_s <= 0:
+            errors.append("llm_scheduler prior latency and error half-life must be positive")
+
         # Validate adaptive thresholds
         if self.adaptive_short_threshold <= 0 or self.adaptive_long_threshold <= 0:
             errors.append("adaptive thresholds must be positive")
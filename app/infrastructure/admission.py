@@ -0,0 +1,239 @@
+"""
+Admission control для /v1/chat/query, /v1/chat/stream и /v1/chat/batch.
+
+Решение о запросе принимается до начала пайплайна по числу запросов в
+работе (in-flight) и глубине очередей модельных этапов (пул этапов графа,
+пул CPU-этапов ASGI, очередь reranker):
+
+- accept — полный пайплайн;
+- degrade — запрос принимается, но выполняется дешевле: облегчённая
+  RetrievalStrategy и без rerank (см. DEGRADED_ADMISSION_STEPS);
+- reject — быстрый отказ 503 с Retry-After, пока очереди не разгрузятся.
+
+Пакет вопросов занимает в in-flight столько мест, сколько вопросов
+обрабатывает одновременно, и не принимается в режиме degrade. Потоковые
+ответы живут дольше обработчика маршрута, поэтому для них место берётся
+через admission_ticket и освобождается при закрытии ответа.
+
+Очереди регистрируются через register_queue_probe там, где создаются пулы,
+поэтому модуль не зависит от пайплайна. Решения и число запросов в работе
+экспортируются в Prometheus.
+"""
+from __future__ import annotations
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from enum import Enum
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from loguru import logger
+
+from app.config import CONFIG
+from app.infrastructure.metrics import admission_decisions_total, admission_in_flight
+
+
+class AdmissionDecision(Enum):
+    ACCEPT = "accept"
+    DEGRADE = "degrade"
+    REJECT = "reject"
+
+
+# Шаги деградации (app.infrastructure.deadline) для запросов, принятых в режиме degrade
+DEGRADED_ADMISSION_STEPS = ("cheap_strategy", "skip_rerank")
+
+_queue_probes: Dict[str, Callable[[], int]] = {}
+_probes_lock = threading.Lock()
+
+_degraded: ContextVar[bool] = ContextVar("admission_degraded", default=False)
+
+
+def register_queue_probe(name: str, probe: Callable[[], int]) -> None:
+    """Регистрирует функцию, возвращающую глубину очереди модельного этапа."""
+    with _probes_lock:
+        _queue_probes[name] = probe
+
+
+def queue_depths() -> Dict[str, int]:
+    with _probes_lock:
+        probes = dict(_queue_probes)
+    depths: Dict[str, int] = {}
+    for name, probe in probes.items():
+        try:
+            depths[name] = int(probe())
+        except Exception as exc:  # pragma: no cover - зонд не должен ломать приём запросов
+            logger.debug(f"Admission: queue probe {name} failed: {exc}")
+    return depths
+
+
+def admission_degraded() -> bool:
+    """Принят ли текущий запрос в режиме degrade."""
+    return _degraded.get()
+
+
+class AdmissionController:
+    """
+    Приём запросов по нагрузке. Порог 0 отключает соответствующую проверку.
+
+    Args:
+        degrade_in_flight / reject_in_flight: пороги числа запросов в работе
+        degrade_queue_depth / reject_queue_depth: пороги глубины самой длинной очереди этапов
+    """
+
+    def __init__(
+        self,
+        degrade_in_flight: int = 0,
+        reject_in_flight: int = 0,
+        degrade_queue_depth: int = 0,
+        reject_queue_depth: int = 0,
+    ):
+        self.degrade_in_flight = degrade_in_flight
+        self.reject_in_flight = reject_in_flight
+        self.degrade_queue_depth = degrade_queue_depth
+        self.reject_queue_depth = reject_queue_depth
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def _decide(self, in_flight: int, queue_depth: int) -> AdmissionDecision:
+        if _exceeds(in_flight, self.reject_in_flight) or _exceeds(queue_depth, self.reject_queue_depth):
+            return AdmissionDecision.REJECT
+        if _exceeds(in_flight, self.degrade_in_flight) or _exceeds(queue_depth, self.degrade_queue_depth):
+            return AdmissionDecision.DEGRADE
+        return AdmissionDecision.ACCEPT
+
+    def acquire(self, weight: int = 1, allow_degrade: bool = True) -> AdmissionDecision:
+        """
+        Решение о приёме; принятый запрос (accept/degrade) занимает weight мест
+        в in-flight до release(weight).
+
+        Args:
+            weight: сколько запросов в работе добавляет принятый (пакет — больше одного)
+            allow_degrade: False — вместо degrade отказ (запрос нельзя удешевить)
+        """
+        weight = max(1, weight)
+        depths = queue_depths()
+        queue_depth = max(depths.values(), default=0)
+        with self._lock:
+            decision = self._decide(self._in_flight + weight - 1, queue_depth)
+            if decision is AdmissionDecision.DEGRADE and not allow_degrade:
+                decision = AdmissionDecision.REJECT
+            if decision is not AdmissionDecision.REJECT:
+                self._in_flight += weight
+                admission_in_flight.set(self._in_flight)
+        admission_decisions_total.labels(decision=decision.value).inc()
+        if decision is not AdmissionDecision.ACCEPT:
+            logger.warning(
+                f"Admission: {decision.value} (in_flight={self._in_flight}, weight={weight}, queues={depths})"
+            )
+        return decision
+
+    def release(self, weight: int = 1) -> None:
+        with self._lock:
+            self._in_flight -= max(1, weight)
+            admission_in_flight.set(self._in_flight)
+
+    @contextmanager
+    def admit(self, weight: int = 1, allow_degrade: bool = True) -> Iterator[AdmissionDecision]:
+        """
+        Решение о приёме запроса на время блока.
+
+        Принятый запрос (accept/degrade) учитывается в in-flight до выхода из
+        блока; при reject блок должен сразу вернуть отказ.
+        """
+        decision = self.acquire(weight, allow_degrade)
+        if decision is AdmissionDecision.REJECT:
+            yield decision
+            return
+
+        try:
+            with admission_scope(decision):
+                yield decision
+        finally:
+            self.release(weight)
+
+
+@contextmanager
+def admission_scope(decision: AdmissionDecision) -> Iterator[None]:
+    """Делает решение видимым admission_degraded() внутри блока (в том числе в генераторе ответа)."""
+    token = _degraded.set(decision is AdmissionDecision.DEGRADE)
+    try:
+        yield
+    finally:
+        _degraded.reset(token)
+
+
+def _exceeds(value: int, threshold: int) -> bool:
+    return threshold > 0 and value >= threshold
+
+
+def overloaded_response() -> Dict[str, Any]:
+    """Тело ответа 503 при отказе в приёме (общее для Flask и ASGI); retry_after дублирует Retry-After."""
+    return {
+        "error": "overloaded",
+        "message": "Сервис перегружен. Повторите запрос позже.",
+        "retry_after": max(1, int(getattr(CONFIG, "admission_retry_after_s", 2))),
+    }
+
+
+_controller: Optional[AdmissionController] = None
+_controller_lock = threading.Lock()
+
+
+def get_admission_controller() -> Optional[AdmissionController]:
+    """Общий для процесса контроллер; None при ADMISSION_CONTROL_ENABLED=false."""
+    global _controller
+    if not getattr(CONFIG, "admission_control_enabled", True):
+        return None
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                _controller = AdmissionController(
+                    degrade_in_flight=int(getattr(CONFIG, "admission_degrade_in_flight", 32)),
+                    reject_in_flight=int(getattr(CONFIG, "admission_reject_in_flight", 64)),
+                    degrade_queue_depth=int(getattr(CONFIG, "admission_degrade_queue_depth", 16)),
+                    reject_queue_depth=int(getattr(CONFIG, "admission_reject_queue_depth", 48)),
+                )
+    return _controller
+
+
+@contextmanager
+def admission() -> Iterator[AdmissionDecision]:
+    """Решение о приёме запроса чата (без контроллера — всегда accept)."""
+    controller = get_admission_controller()
+    if controller is None:
+        yield AdmissionDecision.ACCEPT
+        return
+    with controller.admit() as decision:
+        yield decision
+
+
+def admission_ticket(weight: int = 1, allow_degrade: bool = True) -> Tuple[AdmissionDecision, Callable[[], None]]:
+    """
+    Решение о приёме для ответа, который отдаётся после выхода из обработчика
+    (SSE, NDJSON). Место в in-flight держится до вызова release — его нужно
+    вызвать при закрытии ответа; повторный вызов ничего не делает.
+
+    Returns:
+        (решение, release); при reject release ничего не освобождает
+    """
+    controller = get_admission_controller()
+    if controller is None:
+        return AdmissionDecision.ACCEPT, lambda: None
+    decision = controller.acquire(weight, allow_degrade)
+    if decision is AdmissionDecision.REJECT:
+        return decision, lambda: None
+    released = [False]
+    release_lock = threading.Lock()
+
+    def release() -> None:
+        with release_lock:
+            if released[0]:
+                return
+            released[0] = True
+        controller.release(weight)
+
+    return decision, release
@@ -0,0 +1,319 @@
+"""
+Кодеки значений кэша в Redis.
+
+json — прежний формат: numpy-типы переводятся в списки и числа, значение
+хранится JSON-текстом (dense-вектор BGE-M3 — ~20 КБ текста).
+
+binary — компактный формат с заголовком версии:
+
+    b"\\x00RC" | версия (1 байт) | формат структуры (1 байт) | длина структуры (uint32 LE)
+    | структура | бинарные блоки
+
+Структура — значение, в котором числовые массивы заменены ссылками на блоки;
+сериализуется msgpack (если установлен), иначе JSON (orjson, если установлен).
+В блоки попадают:
+- numpy-массивы и списки float длиной от MIN_PACKED_LEN — сырые байты
+  float32 или float16 (CACHE_VECTOR_DTYPE); при чтении numpy-массив
+  восстанавливается массивом, список — списком;
+- веса sparse-векторов ({token_id: weight}, {"indices": [...], "values": [...]})
+  — упакованные массивы индексов uint32 и весов.
+
+Чтение не зависит от настроенного кодека: значение с магическими байтами
+разбирается как binary, остальное — как JSON. Поэтому раскатка безопасна:
+сначала все воркеры обновляются с CACHE_CODEC=json (значение по умолчанию;
+читают оба формата), затем включается binary. Значение неизвестной версии
+считается промахом.
+"""
+from __future__ import annotations
+
+import json
+import struct
+from typing import Any, Optional
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - без msgpack структура сериализуется в JSON
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - без orjson используется стандартный json
+    orjson = None
+
+CACHE_CODECS = ("json", "binary")
+VECTOR_DTYPES = ("float32", "float16")
+
+MAGIC = b"\x00RC"  # JSON-текст не может начинаться с нулевого байта
+CODEC_VERSION = 1
+FORMAT_MSGPACK = 1
+FORMAT_JSON = 2
+_HEADER = struct.Struct("<3sBBI")
+
+# Списки float короче этого хранятся в структуре как есть (оценки, координаты)
+MIN_PACKED_LEN = 16
+# Ключ ссылки на бинарный блок внутри структуры
+_BLOB_KEY = "\x00rc"
+_INDEX_DTYPE = np.dtype("<u4")
+
+
+class CacheCodecError(ValueError):
+    """Значение кэша не удалось разобрать (повреждено или записано другой версией)."""
+
+
+def to_serializable(obj: Any) -> Any:
+    """Конвертирует numpy-типы в JSON-сериализуемые типы."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, dict):
+        return {k: to_serializable(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [to_serializable(item) for item in obj]
+    else:
+        return obj
+
+
+def decode_value(raw: Any) -> Any:
+    """Разбирает значение из Redis любого из форматов (binary по магическим байтам, иначе JSON)."""
+    if isinstance(raw, (bytes, bytearray, memoryview)) and bytes(raw[:len(MAGIC)]) == MAGIC:
+        return _decode_binary(bytes(raw))
+    return json.loads(raw)
+
+
+class JsonCacheCodec:
+    """Прежний формат: JSON-текст."""
+
+    name = "json"
+
+    def normalize(self, value: Any) -> Any:
+        """Значение в том виде, в каком его вернёт decode (для копии в L1)."""
+        return to_serializable(value)
+
+    def encode(self, value: Any) -> bytes:
+        return json.dumps(to_serializable(value)).encode("utf-8")
+
+    def decode(self, raw: Any) -> Any:
+        return decode_value(raw)
+
+
+class BinaryCacheCodec:
+    """Векторы и sparse-веса — сырыми байтами, остальное — msgpack/JSON."""
+
+    name = "binary"
+
+    def __init__(self, vector_dtype: str = "float32"):
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unknown cache vector dtype: {vector_dtype}")
+        self.vector_dtype = np.dtype(vector_dtype).newbyteorder("<")
+
+    def normalize(self, value: Any) -> Any:
+        """numpy-скаляры — в числа Python; массивы остаются массивами, как после decode."""
+        if isinstance(value, np.ndarray):
+            return value
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, dict):
+            return {k: self.normalize(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [self.normalize(item) for item in value]
+        return value
+
+    def encode(self, value: Any) -> bytes:
+        blobs: list[bytes] = []
+        structure = self._pack(value, blobs, [0])
+        body, fmt = _dump_structure(structure)
+        return b"".join([_HEADER.pack(MAGIC, CODEC_VERSION, fmt, len(body)), body, *blobs])
+
+    def decode(self, raw: Any) -> Any:
+        return decode_value(raw)
+
+    def _pack(self, obj: Any, blobs: list[bytes], offset: list[int]) -> Any:
+        if isinstance(obj, np.ndarray):
+            return self._pack_array(obj, blobs, offset)
+        if isinstance(obj, np.generic):
+            return obj.item()
+        if isinstance(obj, dict):
+            packed = self._pack_sparse(obj, blobs, offset)
+            if packed is not None:
+                return packed
+            return {k: self._pack(v, blobs, offset) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            vector = _float_vector(obj)
+            if vector is not None:
+                return {_BLOB_KEY: ["l", self._blob(vector.astype(self.vector_dtype), blobs, offset)]}
+            return [self._pack(item, blobs, offset) for item in obj]
+        return obj
+
+    def _pack_array(self, array: np.ndarray, blobs: list[bytes], offset: list[int]) -> Any:
+        if array.dtype.kind == "f":
+            stored = array.astype(self.vector_dtype)
+        elif array.dtype.kind in "iub":
+            stored = array.astype(array.dtype.newbyteorder("<"))
+        else:
+            # Строки и объекты — как раньше, списком
+            return self._pack(array.tolist(), blobs, offset)
+        ref = self._blob(stored, blobs, offset)
+        return {_BLOB_KEY: ["a", ref, list(array.shape), array.dtype.str]}
+
+    def _pack_sparse(self, obj: dict, blobs: list[bytes], offset: list[int]) -> Optional[dict]:
+        if obj.keys() == {"indices", "values"}:
+            indices, values = _indices(obj["indices"]), _float_vector(obj["values"], min_len=0)
+            if indices is None or values is None or len(indices) != len(values):
+                return None
+            return {_BLOB_KEY: [
+                "p",
+                self._blob(indices, blobs, offset),
+                self._blob(values.astype(self.vector_dtype), blobs, offset),
+            ]}
+        weights = _sparse_weights(obj)
+        if weights is None:
+            return None
+        indices, values, key_type = weights
+        return {_BLOB_KEY: [
+            "s",
+            self._blob(indices, blobs, offset),
+            self._blob(values.astype(self.vector_dtype), blobs, offset),
+            key_type,
+        ]}
+
+    @staticmethod
+    def _blob(array: np.ndarray, blobs: list[bytes], offset: list[int]) -> list:
+        data = array.tobytes()
+        blobs.append(data)
+        ref = [offset[0], len(data), array.dtype.str]
+        offset[0] += len(data)
+        return ref
+
+
+def get_cache_codec(name: str = "binary", vector_dtype: str = "float32") -> JsonCacheCodec | BinaryCacheCodec:
+    """Кодек по имени из CACHE_CODEC."""
+    if name == "json":
+        return JsonCacheCodec()
+    if name == "binary":
+        return BinaryCacheCodec(vector_dtype)
+    raise ValueError(f"Unknown cache codec: {name}. Expected one of: {', '.join(CACHE_CODECS)}")
+
+
+# --------------------------------------------------------------- упаковка
+
+def _float_vector(obj: Any, min_len: int = MIN_PACKED_LEN) -> Optional[np.ndarray]:
+    """Список float (или numpy-чисел) как одномерный массив, иначе None."""
+    if len(obj) < max(min_len, 1) or not isinstance(obj[0], (float, np.floating)):
+        return None
+    try:
+        array = np.asarray(obj)
+    except (TypeError, ValueError):
+        return None
+    return array if array.ndim == 1 and array.dtype.kind == "f" else None
+
+
+def _indices(obj: Any) -> Optional[np.ndarray]:
+    if not isinstance(obj, (list, tuple)) or not all(isinstance(i, (int, np.integer)) for i in obj):
+        return None
+    if any(isinstance(i, bool) for i in obj) or (obj and not 0 <= min(obj) <= max(obj) < 2 ** 32):
+        return None
+    return np.asarray(obj, dtype=_INDEX_DTYPE)
+
+
+def _sparse_weights(obj: dict) -> Optional[tuple[np.ndarray, np.ndarray, str]]:
+    """Словарь {token_id: weight} с целыми (или строками-числами) ключами как два массива."""
+    if len(obj) < 8:
+        return None
+    first = next(iter(obj))
+    if isinstance(first, str):
+        keys = list(obj)
+        if not all(type(key) is str and key.isdigit() for key in keys):
+            return None
+        ids = [int(key) for key in keys]
+        if [str(i) for i in ids] != keys:  # ведущие нули не восстановить
+            return None
+        key_type = "s"
+    elif isinstance(first, int) and not isinstance(first, bool):
+        ids = list(obj)
+        if not all(type(key) is int for key in ids):
+            return None
+        key_type = "i"
+    else:
+        return None
+    indices = _indices(ids)
+    values = _float_vector(list(obj.values()), min_len=0)
+    if indices is None or values is None:
+        return None
+    return indices, values, key_type
+
+
+def _dump_structure(structure: Any) -> tuple[bytes, int]:
+    if msgpack is not None:
+        return msgpack.packb(structure, use_bin_type=True), FORMAT_MSGPACK
+    if orjson is not None:
+        try:
+            return orjson.dumps(structure, option=orjson.OPT_NON_STR_KEYS), FORMAT_JSON
+        except TypeError:
+            # Типы, которых orjson не знает (например, целые больше 64 бит)
+            pass
+    return json.dumps(structure, ensure_ascii=False).encode("utf-8"), FORMAT_JSON
+
+
+# --------------------------------------------------------------- распаковка
+
+def _decode_binary(raw: bytes) -> Any:
+    if len(raw) < _HEADER.size:
+        raise CacheCodecError("Truncated cache value")
+    _magic, version, fmt, length = _HEADER.unpack_from(raw)
+    if version != CODEC_VERSION:
+        raise CacheCodecError(f"Unsupported cache codec version: {version}")
+    body = raw[_HEADER.size:_HEADER.size + length]
+    if len(body) != length:
+        raise CacheCodecError("Truncated cache value")
+    if fmt == FORMAT_MSGPACK:
+        if msgpack is None:
+            raise CacheCodecError("Cache value is msgpack-encoded but msgpack is not installed")
+        structure = msgpack.unpackb(body, raw=False, strict_map_key=False)
+    elif fmt == FORMAT_JSON:
+        structure = json.loads(body)
+    else:
+        raise CacheCodecError(f"Unknown cache structure format: {fmt}")
+    blobs = memoryview(raw)[_HEADER.size + length:]
+    if not blobs:
+        return structure
+    return _unpack(structure, blobs)
+
+
+def _unpack(obj: Any, blobs: memoryview) -> Any:
+    if isinstance(obj, dict):
+        ref = obj.get(_BLOB_KEY)
+        if ref is not None and len(obj) == 1:
+            return _restore(ref, blobs)
+        return {k: _unpack(v, blobs) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_unpack(item, blobs) for item in obj]
+    return obj
+
+
+def _array(ref: list, blobs: memoryview) -> np.ndarray:
+    offset, length, dtype = ref
+    if offset + length > len(blobs):
+        raise CacheCodecError("Cache value blob is out of range")
+    return np.frombuffer(blobs[offset:offset + length], dtype=np.dtype(dtype))
+
+
+def _restore(ref: list, blobs: memoryview) -> Any:
+    tag = ref[0]
+    if tag == "l":
+        return _array(ref[1], blobs).tolist()
+    if tag == "a":
+        # astype копирует: массив не ссылается на буфер значения и доступен для записи
+        return _array(ref[1], blobs).astype(np.dtype(ref[3])).reshape(ref[2])
+    if tag == "p":
+        return {"indices": _array(ref[1], blobs).tolist(), "values": _array(ref[2], blobs).tolist()}
+    if tag == "s":
+        indices, values = _array(ref[1], blobs).tolist(), _array(ref[2], blobs).tolist()
+        if ref[3] == "s":
+            return {str(i): v for i, v in zip(indices, values)}
+        return dict(zip(indices, values))
+    raise CacheCodecError(f"Unknown cache blob type: {tag}")
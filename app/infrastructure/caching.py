@@ -4,11 +4,23 @@
 from __future__ import annotations
 
 import json
+import fnmatch
 import hashlib
+import inspect
+import math
 import os
+import random
+import struct
+import sys
+import threading
 import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
 from typing import Any, Optional
 from functools import wraps
+
+import numpy as np
 from loguru import logger
 
 try:
@@ -19,6 +31,9 @@ except ImportError:
     logger.warning("Redis not available, using in-memory cache")
 
 from app.config import CONFIG
+from app.infrastructure.cache_codec import get_cache_codec
+from app.infrastructure.metrics import cached_calls_total, memory_cache_evictions_total
+from app.infrastructure.single_flight import SingleFlight
 
 
 class CacheConfig:
@@ -29,47 +44,312 @@ class CacheConfig:
     MAX_MEMORY_ITEMS = 1000
 
 
+def parse_prefix_budgets(raw: str) -> dict[str, int]:
+    """
+    Разбирает CACHE_MEMORY_PREFIX_BUDGETS_MB вида "embedding=128,search=64".
+
+    Returns:
+        {префикс ключа: бюджет в байтах}
+    """
+    result: dict[str, int] = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        prefix, _, value = item.partition("=")
+        try:
+            result[prefix.strip()] = int(float(value) * 1024 * 1024)
+        except ValueError:
+            logger.warning(f"Ignoring malformed CACHE_MEMORY_PREFIX_BUDGETS_MB entry: {item!r}")
+    return result
+
+
+def approximate_size(value: Any) -> int:
+    """
+    Оценка памяти значения в байтах (без обхода всех элементов длинных
+    однородных списков: вектор из 1024 float оценивается по первому элементу).
+    """
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        # numpy-массивы: данные плюс заголовок объекта
+        return nbytes + 112
+    if isinstance(value, (str, bytes, int, float, bool)) or value is None:
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            approximate_size(key) + approximate_size(item) for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size = sys.getsizeof(value)
+        if len(value) > 32 and isinstance(value, (list, tuple)) and isinstance(value[0], (int, float)):
+            return size + len(value) * sys.getsizeof(value[0])
+        return size + sum(approximate_size(item) for item in value)
+    return sys.getsizeof(value)
+
+
+class FrequencySketch:
+    """
+    Count-Min Sketch частот обращений к ключам для допуска TinyLFU.
+
+    Четыре строки счётчиков с насыщением на 15; после sample_size
+    обращений все счётчики делятся пополам, чтобы старая популярность
+    затухала.
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+    _SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+
+    def __init__(self, capacity: int):
+        width = 64
+        while width < 4 * max(1, capacity):
+            width *= 2
+        self._mask = width - 1
+        self._rows = [[0] * width for _ in range(self.DEPTH)]
+        self.sample_size = 10 * max(1, capacity)
+        self._additions = 0
+
+    def _indexes(self, key: str) -> list[int]:
+        h = hash(key)
+        return [((h ^ seed) * 0x100000001B3 >> 17) & self._mask for seed in self._SEEDS]
+
+    def increment(self, key: str) -> None:
+        for row, index in zip(self._rows, self._indexes(key)):
+            if row[index] < self.MAX_COUNT:
+                row[index] += 1
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self._additions //= 2
+            for row in self._rows:
+                for index, count in enumerate(row):
+                    if count:
+                        row[index] = count >> 1
+
+    def frequency(self, key: str) -> int:
+        return min(row[index] for row, index in zip(self._rows, self._indexes(key)))
+
+
+class _Entry:
+    __slots__ = ("value", "expires_at", "size", "prefix")
+
+    def __init__(self, value: Any, expires_at: float, size: int, prefix: str):
+        self.value = value
+        self.expires_at = expires_at
+        self.size = size
+        self.prefix = prefix
+
+
+MEMORY_CACHE_POLICIES = ("lru", "tinylfu")
+
+
 class InMemoryCache:
-    """Простой in-memory кэш как fallback."""
+    """
+    Кэш процесса с O(1) get/set (fallback без Redis и локальные кэши).
+
+    - вытеснение LRU; при policy="tinylfu" новый ключ вытесняет кандидата
+      только если обращались к нему чаще (частоты — FrequencySketch), так
+      что поток одноразовых ключей не вымывает горячие;
+    - ограничения: число элементов, общий бюджет байт и бюджеты по префиксу
+      ключа (часть до первого ":"), размер — approximate_size;
+    - TTL проверяется лениво: при чтении и когда просроченный элемент
+      оказывается кандидатом на вытеснение;
+    - все операции под одной блокировкой (потоки Flask/gunicorn).
+    """
 
-    def __init__(self, max_items: int = 1000):
-        self.cache: dict[str, tuple[Any, float]] = {}
+    def __init__(
+        self,
+        max_items: int = 1000,
+        max_bytes: int = 0,
+        prefix_budgets: Optional[dict[str, int]] = None,
+        policy: str = "lru",
+        name: str = "memory",
+    ):
+        if policy not in MEMORY_CACHE_POLICIES:
+            raise ValueError(f"policy must be one of {MEMORY_CACHE_POLICIES}")
+        self.name = name
         self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.prefix_budgets = dict(prefix_budgets or {})
+        self.policy = policy
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._prefix_order: dict[str, "OrderedDict[str, None]"] = {}
+        self._prefix_bytes: dict[str, int] = {}
+        self._bytes = 0
+        self._sketch = FrequencySketch(max_items) if policy == "tinylfu" else None
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "rejections": 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
     def get(self, key: str) -> Optional[Any]:
-        if key in self.cache:
-            value, expiry = self.cache[key]
-            if time.time() < expiry:
-                return value
-            else:
-                del self.cache[key]
-        return None
+        with self._lock:
+            if self._sketch is not None:
+                self._sketch.increment(key)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            if entry.expires_at <= time.monotonic():
+                self._remove(key, entry, "expired")
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._prefix_order[entry.prefix].move_to_end(key)
+            self._counters["hits"] += 1
+            return entry.value
 
     def set(self, key: str, value: Any, ttl: int) -> None:
-        # Удаляем старые элементы если кэш переполнен
-        if len(self.cache) >= self.max_items:
-            # Удаляем 20% самых старых элементов
-            items_to_remove = len(self.cache) // 5
-            sorted_items = sorted(self.cache.items(), key=lambda x: x[1][1])
-            for old_key, _ in sorted_items[:items_to_remove]:
-                del self.cache[old_key]
-
-        expiry = time.time() + ttl
-        self.cache[key] = (value, expiry)
+        prefix = key.partition(":")[0]
+        size = approximate_size(key) + approximate_size(value)
+        budget = self.prefix_budgets.get(prefix, 0)
+        with self._lock:
+            if (budget and size > budget) or (self.max_bytes and size > self.max_bytes):
+                # Значение больше бюджета целиком — не вытесняем ради него весь префикс
+                self._reject()
+                return
+            previous = self._entries.get(key)
+            if previous is not None:
+                # Обновление уже допущенного ключа: проверка TinyLFU не нужна
+                self._remove(key, previous, None)
+            if not self._make_room(key, prefix, size, budget, admit_always=previous is not None):
+                self._reject()
+                return
+            self._entries[key] = _Entry(value, time.monotonic() + ttl, size, prefix)
+            self._prefix_order.setdefault(prefix, OrderedDict())[key] = None
+            self._prefix_bytes[prefix] = self._prefix_bytes.get(prefix, 0) + size
+            self._bytes += size
 
     def delete(self, key: str) -> None:
-        self.cache.pop(key, None)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(key, entry, None)
 
     def clear(self) -> None:
-        self.cache.clear()
+        with self._lock:
+            self._entries.clear()
+            self._prefix_order.clear()
+            self._prefix_bytes.clear()
+            self._bytes = 0
+
+    def keys(self) -> list[str]:
+        """Снимок ключей (включая ещё не удалённые просроченные)."""
+        with self._lock:
+            return list(self._entries)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            lookups = counters["hits"] + counters["misses"]
+            prefixes = {
+                prefix: {
+                    "items": len(order),
+                    "bytes": self._prefix_bytes.get(prefix, 0),
+                    "budget_bytes": self.prefix_budgets.get(prefix, 0),
+                }
+                for prefix, order in self._prefix_order.items()
+                if order
+            }
+            return {
+                "policy": self.policy,
+                "items": len(self._entries),
+                "max_items": self.max_items,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                **counters,
+                "hit_ratio": round(counters["hits"] / lookups, 4) if lookups else 0.0,
+                "prefixes": prefixes,
+            }
+
+    # ------------------------------------------------------------- internals
+
+    def _over_limit(self, prefix: str, size: int, budget: int) -> Optional[str]:
+        """Какое ограничение нарушит новый элемент: "prefix", "bytes", "items" или None."""
+        if budget and self._prefix_bytes.get(prefix, 0) + size > budget:
+            return "prefix"
+        if self.max_bytes and self._bytes + size > self.max_bytes:
+            return "bytes"
+        if self.max_items > 0 and len(self._entries) >= self.max_items:
+            return "items"
+        return None
+
+    def _make_room(self, key: str, prefix: str, size: int, budget: int, admit_always: bool = False) -> bool:
+        """Вытесняет элементы под новый; False — TinyLFU не допустил новый ключ."""
+        now = time.monotonic()
+        while True:
+            limit = self._over_limit(prefix, size, budget)
+            if limit is None:
+                return True
+            order = self._prefix_order[prefix] if limit == "prefix" else self._entries
+            victim_key = next(iter(order))
+            victim = self._entries[victim_key]
+            if victim.expires_at <= now:
+                self._remove(victim_key, victim, "expired")
+                continue
+            if (
+                self._sketch is not None
+                and not admit_always
+                and self._sketch.frequency(key) <= self._sketch.frequency(victim_key)
+            ):
+                return False
+            self._remove(victim_key, victim, "capacity" if limit == "items" else "bytes")
+
+    def _remove(self, key: str, entry: _Entry, reason: Optional[str]) -> None:
+        del self._entries[key]
+        order = self._prefix_order.get(entry.prefix)
+        if order is not None:
+            order.pop(key, None)
+        self._prefix_bytes[entry.prefix] = self._prefix_bytes.get(entry.prefix, 0) - entry.size
+        self._bytes -= entry.size
+        if reason == "expired":
+            self._counters["expirations"] += 1
+        elif reason is not None:
+            self._counters["evictions"] += 1
+        if reason is not None:
+            memory_cache_evictions_total.labels(cache=self.name, reason=reason).inc()
+
+    def _reject(self) -> None:
+        self._counters["rejections"] += 1
+        memory_cache_evictions_total.labels(cache=self.name, reason="rejected").inc()
 
 
 class CacheManager:
-    """Менеджер кэширования с поддержкой Redis и in-memory fallback."""
+    """
+    Менеджер кэширования с поддержкой Redis и in-memory fallback.
+
+    Без Redis процессный кэш — единственный уровень. С Redis он работает как L1
+    перед общим L2: чтение сначала идёт в L1, при промахе — в Redis с
+    заполнением L1; запись идёт в оба уровня. Копия в L1 живёт не дольше
+    cache_l1_ttl_s, а изменения ключей рассылаются другим воркерам через
+    Redis pub/sub, и те удаляют свои копии.
+    """
 
     def __init__(self):
         self.redis_client = None
-        self.memory_cache = InMemoryCache(CacheConfig.MAX_MEMORY_ITEMS)
+        self.memory_cache = InMemoryCache(
+            max_items=int(getattr(CONFIG, "cache_memory_max_items", CacheConfig.MAX_MEMORY_ITEMS)),
+            max_bytes=int(float(getattr(CONFIG, "cache_memory_max_mb", 0)) * 1024 * 1024),
+            prefix_budgets=parse_prefix_budgets(getattr(CONFIG, "cache_memory_prefix_budgets_mb", "")),
+            policy=str(getattr(CONFIG, "cache_memory_policy", "lru")),
+            name="cache_manager",
+        )
+        self.codec = get_cache_codec(
+            str(getattr(CONFIG, "cache_codec", "json")),
+            str(getattr(CONFIG, "cache_vector_dtype", "float32")),
+        )
+        self.l1_enabled = bool(getattr(CONFIG, "cache_l1_enabled", True))
+        self.l1_ttl = int(getattr(CONFIG, "cache_l1_ttl_s", 60))
+        self.invalidation_channel = str(getattr(CONFIG, "cache_invalidation_channel", "rag:cache:invalidate"))
+        self.instance_id = uuid.uuid4().hex
+        self._stats_lock = threading.Lock()
+        self._lookups = 0
+        self._l1_hits = 0
+        self._l2_hits = 0
+        self._l2_misses = 0
+        # Растёт при каждой инвалидации: значение, прочитанное из Redis до неё, не попадает в L1
+        self._invalidation_seq = 0
+        # Блокировки вычисления ключей без Redis: {ключ блокировки: (токен, истечение)}
+        self._local_locks: dict[str, tuple[str, float]] = {}
 
         # В родительском процессе Flask reloader не инициализируем подключения
         if os.environ.get("WERKZEUG_RUN_MAIN") == "false":
@@ -81,6 +361,7 @@ class CacheManager:
                 # Проверяем подключение
                 self.redis_client.ping()
                 logger.info("Redis cache initialized")
+                self._start_invalidation_listener()
             except Exception as e:
                 logger.warning(f"Redis connection failed: {e}, using memory cache")
                 self.redis_client = None
@@ -90,12 +371,24 @@ class CacheManager:
     def get(self, key: str) -> Optional[Any]:
         """Получить значение из кэша."""
         try:
-            if self.redis_client:
-                value = self.redis_client.get(key)
-                if value:
-                    return json.loads(value)
-            else:
+            if not self.redis_client:
                 return self.memory_cache.get(key)
+            self._count(lookups=1)
+            if self.l1_enabled:
+                value = self.memory_cache.get(key)
+                if value is not None:
+                    self._count(l1_hits=1)
+                    return value
+            seq = self._invalidation_seq
+            raw = self.redis_client.get(key)
+            if not raw:
+                self._count(l2_misses=1)
+                return None
+            self._count(l2_hits=1)
+            value = self.codec.decode(raw)
+            if self.l1_enabled and seq == self._invalidation_seq:
+                self.memory_cache.set(key, value, self.l1_ttl)
+            return value
         except Exception as e:
             logger.warning(f"Cache get error: {e}")
             return None
@@ -104,36 +397,23 @@ class CacheManager:
         """Установить значение в кэш."""
         try:
             if self.redis_client:
-                # Конвертируем numpy типы в Python типы для JSON сериализации
-                serializable_value = self._make_serializable(value)
-                self.redis_client.setex(key, ttl, json.dumps(serializable_value))
+                self.redis_client.setex(key, ttl, self.codec.encode(value))
+                if self.l1_enabled:
+                    # В L1 — то же представление, что вернёт чтение из Redis
+                    self.memory_cache.set(key, self.codec.normalize(value), min(ttl, self.l1_ttl))
+                    self._publish_invalidation(keys=[key])
             else:
                 self.memory_cache.set(key, value, ttl)
         except Exception as e:
             logger.warning(f"Cache set error: {e}")
 
-    def _make_serializable(self, obj: Any) -> Any:
-        """Конвертирует объекты в JSON-сериализуемые типы."""
-        import numpy as np
-
-        if isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, dict):
-            return {k: self._make_serializable(v) for k, v in obj.items()}
-        elif isinstance(obj, (list, tuple)):
-            return [self._make_serializable(item) for item in obj]
-        else:
-            return obj
-
     def delete(self, key: str) -> None:
         """Удалить значение из кэша."""
         try:
             if self.redis_client:
                 self.redis_client.delete(key)
+                self.invalidate_local(keys=[key])
+                self._publish_invalidation(keys=[key])
             else:
                 self.memory_cache.delete(key)
         except Exception as e:
@@ -144,49 +424,399 @@ class CacheManager:
         try:
             if self.redis_client:
                 self.redis_client.flushdb()
+                self.invalidate_local(clear=True)
+                self._publish_invalidation(clear=True)
             else:
                 self.memory_cache.clear()
         except Exception as e:
             logger.warning(f"Cache clear error: {e}")
 
+    def invalidate_local(
+        self, keys: Optional[list[str]] = None, pattern: Optional[str] = None, clear: bool = False
+    ) -> int:
+        """Удаляет копии из процессного кэша (L1). Возвращает число удалённых ключей."""
+        with self._stats_lock:
+            self._invalidation_seq += 1
+        if clear:
+            removed = len(self.memory_cache)
+            self.memory_cache.clear()
+            return removed
+        targets = list(keys or [])
+        if pattern is not None:
+            targets += [key for key in self.memory_cache.keys() if _key_matches(key, pattern)]
+        for key in targets:
+            self.memory_cache.delete(key)
+        return len(targets)
+
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        """
+        Блокировка вычисления ключа (общая для воркеров через Redis SET NX).
+
+        Returns:
+            токен для release_lock или None, если блокировку держит другой вызов
+        """
+        lock_key = f"lock:{key}"
+        token = uuid.uuid4().hex
+        if self.redis_client:
+            try:
+                return token if self.redis_client.set(lock_key, token, nx=True, px=int(ttl * 1000)) else None
+            except Exception as e:
+                logger.warning(f"Cache lock error: {e}, using process lock")
+        now = time.monotonic()
+        with self._stats_lock:
+            held = self._local_locks.get(lock_key)
+            if held is not None and held[1] > now:
+                return None
+            self._local_locks[lock_key] = (token, now + ttl)
+        return token
+
+    def release_lock(self, key: str, token: str) -> None:
+        """Снимает блокировку, если она всё ещё принадлежит token."""
+        lock_key = f"lock:{key}"
+        with self._stats_lock:
+            held = self._local_locks.get(lock_key)
+            if held is not None and held[0] == token:
+                del self._local_locks[lock_key]
+                return
+        if self.redis_client:
+            try:
+                self.redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+            except Exception as e:
+                logger.warning(f"Cache unlock error: {e}")
+
+    def tier_stats(self) -> dict[str, Any]:
+        """Попадания по уровням: L1 (процесс) и L2 (Redis)."""
+        with self._stats_lock:
+            lookups, l1_hits, l2_hits, l2_misses = self._lookups, self._l1_hits, self._l2_hits, self._l2_misses
+        l2_lookups = l2_hits + l2_misses
+        return {
+            "lookups": lookups,
+            "hit_ratio": round((l1_hits + l2_hits) / lookups, 4) if lookups else 0.0,
+            "l1": {
+                "enabled": self.l1_enabled,
+                "ttl_s": self.l1_ttl,
+                "hits": l1_hits,
+                "misses": lookups - l1_hits,
+                "hit_ratio": round(l1_hits / lookups, 4) if lookups else 0.0,
+                **{k: v for k, v in self.memory_cache.stats().items() if k not in ("hits", "misses", "hit_ratio")},
+            },
+            "l2": {
+                "hits": l2_hits,
+                "misses": l2_misses,
+                "hit_ratio": round(l2_hits / l2_lookups, 4) if l2_lookups else 0.0,
+            },
+        }
+
+    def _count(self, lookups: int = 0, l1_hits: int = 0, l2_hits: int = 0, l2_misses: int = 0) -> None:
+        with self._stats_lock:
+            self._lookups += lookups
+            self._l1_hits += l1_hits
+            self._l2_hits += l2_hits
+            self._l2_misses += l2_misses
+
+    def _publish_invalidation(self, **payload: Any) -> None:
+        """Сообщает другим воркерам, какие копии в L1 устарели."""
+        if not self.l1_enabled:
+            return
+        try:
+            message = json.dumps({"origin": self.instance_id, **payload})
+            self.redis_client.publish(self.invalidation_channel, message)
+        except Exception as e:
+            logger.warning(f"Cache invalidation publish error: {e}")
+
+    def handle_invalidation(self, data: Any) -> None:
+        """Обрабатывает сообщение канала инвалидации (свои сообщения пропускаются)."""
+        try:
+            message = json.loads(data)
+        except (TypeError, ValueError):
+            logger.warning(f"Malformed cache invalidation message: {data!r}")
+            return
+        if not isinstance(message, dict) or message.get("origin") == self.instance_id:
+            return
+        self.invalidate_local(
+            keys=message.get("keys"),
+            pattern=message.get("pattern"),
+            clear=bool(message.get("clear")),
+        )
+
+    def _start_invalidation_listener(self) -> None:
+        if not self.l1_enabled:
+            return
+        thread = threading.Thread(target=self._listen_invalidations, name="cache-invalidation", daemon=True)
+        thread.start()
+
+    def _listen_invalidations(self) -> None:
+        """Фоновая подписка на канал инвалидации с переподключением."""
+        while True:
+            try:
+                pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.invalidation_channel)
+                # Сообщения, пропущенные без подписки, не восстановить — сбрасываем L1 целиком
+                self.invalidate_local(clear=True)
+                for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self.handle_invalidation(message.get("data"))
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener error: {e}, resubscribing")
+                time.sleep(1.0)
+
+
+def _key_matches(key: str, pattern: str) -> bool:
+    """Glob-шаблон в стиле Redis KEYS, иначе — вхождение подстроки."""
+    if any(char in pattern for char in "*?["):
+        return fnmatch.fnmatchcase(key, pattern)
+    return pattern in key
+
 
 # Глобальный экземпляр кэш-менеджера
 # __init__ пропускает инициализацию подключений в родительском процессе Flask reloader
 cache_manager = CacheManager()
 
 
+_KEY_FLOAT = struct.Struct("<d")
+# Маркер конверта значения @cached: {marker: 1, "v": значение, "d": время вычисления, "e": истечение},
+# закэшированной ошибки — {marker: 1, "error": текст, "e": истечение}
+_ENVELOPE_MARKER = "__cached__"
+_LOCK_POLL_S = 0.05
+# Снятие блокировки только её владельцем (по токену)
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class CachedFailureError(RuntimeError):
+    """Повторный вызов в пределах negative TTL после ошибки: функция не вызывается."""
+
+
+def _canonical(obj: Any, out: list[bytes], strict: bool) -> None:
+    """
+    Каноническое бинарное представление аргумента для ключа кэша.
+
+    Не зависит от repr: каждое значение кодируется тегом типа и длиной,
+    словари и множества — в отсортированном порядке, numpy-массивы — байтами
+    данных. При strict=True для неизвестных типов — TypeError (такой вызов
+    не кэшируется), иначе используется str().
+    """
+    if obj is None or isinstance(obj, bool):
+        out.append(b"N" if obj is None else (b"T" if obj else b"F"))
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8")
+        out.append(b"s%d:" % len(data))
+        out.append(data)
+    elif isinstance(obj, int):
+        out.append(b"i%d;" % obj)
+    elif isinstance(obj, float):
+        out.append(b"f" + _KEY_FLOAT.pack(obj))
+    elif isinstance(obj, (bytes, bytearray)):
+        out.append(b"b%d:" % len(obj))
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        out.append(b"l%d:" % len(obj))
+        for item in obj:
+            _canonical(item, out, strict)
+    elif isinstance(obj, dict):
+        items = sorted((_canonical_bytes(key, strict), _canonical_bytes(value, strict)) for key, value in obj.items())
+        out.append(b"d%d:" % len(items))
+        for key, value in items:
+            out.append(key)
+            out.append(value)
+    elif isinstance(obj, (set, frozenset)):
+        items = sorted(_canonical_bytes(item, strict) for item in obj)
+        out.append(b"S%d:" % len(items))
+        out.extend(items)
+    elif isinstance(obj, Enum):
+        _canonical((type(obj).__qualname__, obj.value), out, strict)
+    elif isinstance(obj, np.ndarray):
+        data = np.ascontiguousarray(obj).tobytes()
+        out.append(b"a%s%s%d:" % (obj.dtype.str.encode(), str(obj.shape).encode(), len(data)))
+        out.append(data)
+    elif isinstance(obj, np.generic):
+        _canonical(obj.item(), out, strict)
+    elif strict:
+        raise TypeError(f"Unsupported cache key argument type: {type(obj).__qualname__}")
+    else:
+        _canonical(f"{type(obj).__qualname__}:{obj}", out, strict)
+
+
+def _canonical_bytes(obj: Any, strict: bool) -> bytes:
+    out: list[bytes] = []
+    _canonical(obj, out, strict)
+    return b"".join(out)
+
+
 def cache_key(prefix: str, *args) -> str:
-    """Генерация ключа кэша."""
-    content = "|".join(str(arg) for arg in args)
-    hash_obj = hashlib.md5(content.encode())
-    return f"{prefix}:{hash_obj.hexdigest()}"
+    """Генерация ключа кэша: blake2b канонического представления аргументов."""
+    digest = hashlib.blake2b(_canonical_bytes(args, strict=False), digest_size=16)
+    return f"{prefix}:{digest.hexdigest()}"
+
 
+def _strict_cache_key(prefix: str, *args) -> str:
+    """Как cache_key, но TypeError для аргументов без канонического представления."""
+    digest = hashlib.blake2b(_canonical_bytes(args, strict=True), digest_size=16)
+    return f"{prefix}:{digest.hexdigest()}"
 
-def cached(prefix: str, ttl: int = 3600):
+
+def _should_refresh_early(envelope: dict, now: float, beta: float) -> bool:
+    """
+    Вероятностное раннее обновление (XFetch): чем ближе истечение и чем
+    дольше вычисление, тем вероятнее пересчёт; горячий ключ обновляет один из
+    многих запросов до истечения, холодный почти никогда.
+    """
+    if beta <= 0:
+        return False
+    delta = float(envelope.get("d") or 0.0)
+    return now - delta * beta * math.log(1.0 - random.random()) >= float(envelope.get("e") or 0.0)
+
+
+def cached(
+    prefix: str,
+    ttl: int = 3600,
+    negative_ttl: Optional[int] = None,
+    early_refresh_beta: Optional[float] = None,
+):
     """
     Декоратор для кэширования результатов функций.
 
+    Защита от «лавины» при истечении горячего ключа:
+    - промах вычисляет один вызов на процесс (SingleFlight) и один на все
+      воркеры (блокировка в Redis); остальные ждут его результата до
+      cache_lock_wait_s, потом вычисляют сами;
+    - раннее обновление (XFetch) пересчитывает горячий ключ до истечения —
+      один вызов, получивший блокировку; остальные получают текущее значение;
+    - ошибка кэшируется на negative_ttl: повторные вызовы сразу получают
+      CachedFailureError, а не нагружают упавшую зависимость.
+
+    Ключ — blake2b канонического представления аргументов после привязки к
+    сигнатуре (f(x) и f(x, k=default) дают один ключ). Вызовы с аргументами,
+    которые нельзя однозначно закодировать, не кэшируются.
+
     Args:
         prefix: Префикс для ключей кэша
         ttl: Время жизни в секундах
+        negative_ttl: Время жизни закэшированной ошибки (0 — не кэшировать), по умолчанию cache_negative_ttl_s
+        early_refresh_beta: Агрессивность раннего обновления (0 — выключено), по умолчанию cache_early_refresh_beta
     """
     def decorator(func):
+        signature = inspect.signature(func)
+        name = f"{func.__module__}.{func.__qualname__}"
+        flight = SingleFlight(f"cached:{prefix}")
+
+        def settings() -> tuple[float, float, int, float]:
+            lock_ttl = float(getattr(CONFIG, "cache_lock_ttl_s", 30.0))
+            lock_wait = float(getattr(CONFIG, "cache_lock_wait_s", 5.0))
+            neg_ttl = negative_ttl if negative_ttl is not None else int(getattr(CONFIG, "cache_negative_ttl_s", 5))
+            beta = (
+                early_refresh_beta if early_refresh_beta is not None
+                else float(getattr(CONFIG, "cache_early_refresh_beta", 1.0))
+            )
+            return lock_ttl, lock_wait, neg_ttl, beta
+
+        def lookup(key: str) -> Any:
+            """Значение из кэша; истёкшая ошибка — промах (копия в L1 другого воркера живёт до l1_ttl)."""
+            envelope = cache_manager.get(key)
+            if (
+                isinstance(envelope, dict) and envelope.get(_ENVELOPE_MARKER) == 1 and "error" in envelope
+                and float(envelope.get("e", math.inf)) <= time.time()
+            ):
+                return None
+            return envelope
+
+        def unwrap(envelope: Any, outcome: str) -> Any:
+            if not isinstance(envelope, dict) or envelope.get(_ENVELOPE_MARKER) != 1:
+                # Значение, записанное до появления конверта
+                cached_calls_total.labels(prefix=prefix, outcome=outcome).inc()
+                return envelope
+            if "error" in envelope:
+                cached_calls_total.labels(prefix=prefix, outcome="negative_hit").inc()
+                raise CachedFailureError(f"{name} failed recently: {envelope['error']}")
+            cached_calls_total.labels(prefix=prefix, outcome=outcome).inc()
+            return envelope.get("v")
+
+        def compute(key: str, args: tuple, kwargs: dict, neg_ttl: int) -> Any:
+            started = time.monotonic()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if neg_ttl > 0:
+                    failure = {_ENVELOPE_MARKER: 1, "error": f"{type(e).__name__}: {e}", "e": time.time() + neg_ttl}
+                    cache_manager.set(key, failure, neg_ttl)
+                raise
+            if result is not None:
+                envelope = {
+                    _ENVELOPE_MARKER: 1,
+                    "v": result,
+                    "d": round(time.monotonic() - started, 4),
+                    "e": time.time() + ttl,
+                }
+                cache_manager.set(key, envelope, ttl)
+            return result
+
+        def load(key: str, args: tuple, kwargs: dict) -> Any:
+            """Промах: вычисление под блокировкой или ожидание чужого результата."""
+            lock_ttl, lock_wait, neg_ttl, _beta = settings()
+            token = cache_manager.acquire_lock(key, lock_ttl)
+            if token is None:
+                # Ключ вычисляет другой воркер — ждём, пока результат появится в кэше
+                deadline = time.monotonic() + lock_wait
+                while time.monotonic() < deadline:
+                    time.sleep(_LOCK_POLL_S)
+                    envelope = lookup(key)
+                    if envelope is not None:
+                        return unwrap(envelope, "wait_hit")
+                cached_calls_total.labels(prefix=prefix, outcome="lock_timeout").inc()
+                return compute(key, args, kwargs, neg_ttl)
+            try:
+                # Значение могли записать между промахом и захватом блокировки
+                envelope = lookup(key)
+                if envelope is not None:
+                    return unwrap(envelope, "wait_hit")
+                cached_calls_total.labels(prefix=prefix, outcome="miss").inc()
+                return compute(key, args, kwargs, neg_ttl)
+            finally:
+                cache_manager.release_lock(key, token)
+
+        def refresh(key: str, envelope: dict, args: tuple, kwargs: dict) -> Any:
+            """Раннее обновление: пересчитывает один вызов, остальные получают текущее значение."""
+            lock_ttl, _lock_wait, _neg_ttl, _beta = settings()
+            token = cache_manager.acquire_lock(key, lock_ttl)
+            if token is None:
+                return unwrap(envelope, "hit")
+            try:
+                cached_calls_total.labels(prefix=prefix, outcome="early_refresh").inc()
+                return compute(key, args, kwargs, neg_ttl=0)
+            except Exception as e:
+                # Текущее значение ещё не истекло — отдаём его
+                logger.warning(f"Early cache refresh of {name} failed: {e}")
+                return envelope.get("v")
+            finally:
+                cache_manager.release_lock(key, token)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # Создаем ключ кэша из аргументов функции
-            key = cache_key(prefix, func.__name__, args, tuple(sorted(kwargs.items())))
-
-            # Пытаемся получить из кэша
-            cached_result = cache_manager.get(key)
-            if cached_result is not None:
+            try:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                key = _strict_cache_key(prefix, name, bound.arguments)
+            except TypeError as e:
+                # Неверные аргументы (ошибку покажет сама функция) или значения без канонического вида
+                logger.debug(f"Not caching call to {name}: {e}")
+                return func(*args, **kwargs)
+
+            envelope = lookup(key)
+            if envelope is not None:
+                if (
+                    isinstance(envelope, dict) and envelope.get(_ENVELOPE_MARKER) == 1 and "v" in envelope
+                    and _should_refresh_early(envelope, time.time(), settings()[3])
+                ):
+                    return refresh(key, envelope, args, kwargs)
                 logger.debug(f"Cache hit for {func.__name__}")
-                return cached_result
+                return unwrap(envelope, "hit")
 
-            # Выполняем функцию и кэшируем результат
             logger.debug(f"Cache miss for {func.__name__}")
-            result = func(*args, **kwargs)
-            cache_manager.set(key, result, ttl)
-
+            result, _shared = flight.do(key, lambda: load(key, args, kwargs), timeout=settings()[0])
             return result
         return wrapper
     return decorator
@@ -215,16 +845,49 @@ def invalidate_pattern(pattern: str) -> None:
             if keys:
                 cache_manager.redis_client.delete(*keys)
                 logger.info(f"Invalidated {len(keys)} cache keys matching {pattern}")
+            cache_manager.invalidate_local(pattern=pattern)
+            cache_manager._publish_invalidation(pattern=pattern)
         else:
-            # Для in-memory кэша удаляем все ключи, содержащие паттерн
-            keys_to_delete = [key for key in cache_manager.memory_cache.cache.keys() if pattern in key]
-            for key in keys_to_delete:
-                cache_manager.memory_cache.delete(key)
-            logger.info(f"Invalidated {len(keys_to_delete)} cache keys matching {pattern}")
+            # Для in-memory кэша: glob-шаблон или вхождение подстроки
+            removed = cache_manager.invalidate_local(pattern=pattern)
+            logger.info(f"Invalidated {removed} cache keys matching {pattern}")
     except Exception as e:
         logger.warning(f"Cache invalidation error: {e}")
 
 
+# Поколения коллекций: счётчик, который увеличивается после каждой индексации.
+# Входит в ключи объединения запросов и кэша ответов, поэтому после
+# переиндексации старые результаты перестают совпадать по ключу.
+_collection_generations: dict[str, int] = {}
+COLLECTION_GENERATION_PREFIX = "collection_generation"
+
+
+def get_collection_generation(collection: Optional[str] = None) -> int:
+    """Текущее поколение коллекции (общее для воркеров, если доступен Redis)."""
+    name = collection or CONFIG.qdrant_collection
+    if cache_manager.redis_client:
+        try:
+            value = cache_manager.redis_client.get(f"{COLLECTION_GENERATION_PREFIX}:{name}")
+            return int(value) if value else 0
+        except Exception as e:
+            logger.warning(f"Collection generation read error: {e}")
+    return _collection_generations.get(name, 0)
+
+
+def bump_collection_generation(collection: Optional[str] = None) -> int:
+    """Отмечает изменение данных коллекции. Возвращает новое поколение."""
+    name = collection or CONFIG.qdrant_collection
+    generation = _collection_generations.get(name, 0) + 1
+    if cache_manager.redis_client:
+        try:
+            generation = int(cache_manager.redis_client.incr(f"{COLLECTION_GENERATION_PREFIX}:{name}"))
+        except Exception as e:
+            logger.warning(f"Collection generation bump error: {e}")
+    _collection_generations[name] = generation
+    logger.info(f"Collection {name} generation -> {generation}")
+    return generation
+
+
 def get_cache_stats() -> dict[str, Any]:
     """Получить статистику кэша."""
     try:
@@ -236,13 +899,10 @@ def get_cache_stats() -> dict[str, Any]:
                 "connected_clients": info.get("connected_clients", 0),
                 "keyspace_hits": info.get("keyspace_hits", 0),
                 "keyspace_misses": info.get("keyspace_misses", 0),
+                "tiers": cache_manager.tier_stats(),
             }
         else:
-            return {
-                "type": "memory",
-                "items": len(cache_manager.memory_cache.cache),
-                "max_items": cache_manager.memory_cache.max_items,
-            }
+            return {"type": "memory", **cache_manager.memory_cache.stats()}
     except Exception as e:
         logger.warning(f"Cache stats error: {e}")
         return {"type": "unknown", "error": str(e)}
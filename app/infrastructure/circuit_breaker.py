@@ -3,9 +3,10 @@ Circuit Breaker для внешних сервисов RAG системы.
 """
 from __future__ import annotations
 
+import threading
 import time
 from enum import Enum
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Dict, Optional
 from loguru import logger
 
 
@@ -55,6 +56,7 @@ class CircuitBreaker:
         self.failure_count = 0
         self.last_failure_time: Optional[float] = None
         self.state = CircuitState.CLOSED
+        self._lock = threading.RLock()
 
         logger.info(f"Circuit breaker '{name}' initialized: threshold={failure_threshold}, timeout={timeout}s")
 
@@ -74,45 +76,87 @@ class CircuitBreaker:
             CircuitBreakerError: Если Circuit Breaker в состоянии OPEN
             Exception: Оригинальное исключение от функции
         """
-        # Проверяем состояние
-        if self.state == CircuitState.OPEN:
-            if self._should_attempt_reset():
-                self.state = CircuitState.HALF_OPEN
-                logger.info(f"Circuit breaker '{self.name}' transitioning to HALF_OPEN")
-            else:
-                raise CircuitBreakerError(f"Circuit breaker '{self.name}' is OPEN")
+        if not self.allow_request():
+            raise CircuitBreakerError(f"Circuit breaker '{self.name}' is OPEN")
 
         try:
             # Выполняем функцию
             result = func(*args, **kwargs)
+        except self.expected_exception as e:
+            # Обрабатываем ожидаемое исключение
+            self.record_failure()
+            logger.warning(f"Circuit breaker '{self.name}' recorded failure: {e}")
+            raise
+        except Exception as e:
+            # Неожиданное исключение - не считаем как failure
+            logger.error(f"Circuit breaker '{self.name}' unexpected error: {e}")
+            raise
 
-            # Успешный вызов - сбрасываем счетчик ошибок
-            if self.state == CircuitState.HALF_OPEN:
-                self.state = CircuitState.CLOSED
-                self.failure_count = 0
-                logger.info(f"Circuit breaker '{self.name}' reset to CLOSED")
-            elif self.state == CircuitState.CLOSED:
-                self.failure_count = 0
+        self.record_success()
+        return result
 
-            return result
+    async def call_async(self, func: Callable, *args, **kwargs) -> Any:
+        """Асинхронный вариант call() для корутин (async Qdrant, async HTTP)."""
+        if not self.allow_request():
+            raise CircuitBreakerError(f"Circuit breaker '{self.name}' is OPEN")
 
+        try:
+            result = await func(*args, **kwargs)
         except self.expected_exception as e:
-            # Обрабатываем ожидаемое исключение
-            self._record_failure()
+            self.record_failure()
             logger.warning(f"Circuit breaker '{self.name}' recorded failure: {e}")
             raise
         except Exception as e:
-            # Неожиданное исключение - не считаем как failure
             logger.error(f"Circuit breaker '{self.name}' unexpected error: {e}")
             raise
 
+        self.record_success()
+        return result
+
+    def allow_request(self) -> bool:
+        """
+        Можно ли выполнить вызов сейчас.
+
+        В состоянии OPEN по истечении timeout переводит breaker в HALF_OPEN
+        и разрешает пробный вызов.
+        """
+        with self._lock:
+            if self.state != CircuitState.OPEN:
+                return True
+            if not self._should_attempt_reset():
+                return False
+            self._set_state(CircuitState.HALF_OPEN)
+            logger.info(f"Circuit breaker '{self.name}' transitioning to HALF_OPEN")
+            return True
+
+    def is_open(self) -> bool:
+        """Breaker открыт и пробный вызов ещё не разрешён (без смены состояния)."""
+        with self._lock:
+            return self.state == CircuitState.OPEN and not self._should_attempt_reset()
+
+    def record_success(self) -> None:
+        """Записать успешный вызов: сбрасывает счётчик ошибок."""
+        with self._lock:
+            if self.state == CircuitState.HALF_OPEN:
+                self._set_state(CircuitState.CLOSED)
+                self.failure_count = 0
+                logger.info(f"Circuit breaker '{self.name}' reset to CLOSED")
+            elif self.state == CircuitState.CLOSED:
+                self.failure_count = 0
+
+    def record_failure(self) -> None:
+        """Записать ошибку вызова, выполненного в обход call()."""
+        with self._lock:
+            self._record_failure()
+
     def _record_failure(self) -> None:
         """Записать ошибку."""
         self.failure_count += 1
         self.last_failure_time = time.time()
 
-        if self.failure_count >= self.failure_threshold:
-            self.state = CircuitState.OPEN
+        # Проваленный пробный вызов в HALF_OPEN сразу возвращает breaker в OPEN
+        if self.state == CircuitState.HALF_OPEN or self.failure_count >= self.failure_threshold:
+            self._set_state(CircuitState.OPEN)
             logger.warning(f"Circuit breaker '{self.name}' opened after {self.failure_count} failures")
 
     def _should_attempt_reset(self) -> bool:
@@ -122,22 +166,35 @@ class CircuitBreaker:
 
         return time.time() - self.last_failure_time >= self.timeout
 
+    def _set_state(self, state: CircuitState) -> None:
+        if self.state == state:
+            return
+        self.state = state
+        try:
+            from app.infrastructure.metrics import get_metrics_collector
+
+            get_metrics_collector().record_circuit_breaker_state(self.name, state.value)
+        except Exception:  # pragma: no cover - метрики не должны ломать breaker
+            pass
+
     def reset(self) -> None:
         """Принудительно сбросить Circuit Breaker."""
-        self.state = CircuitState.CLOSED
-        self.failure_count = 0
-        self.last_failure_time = None
+        with self._lock:
+            self._set_state(CircuitState.CLOSED)
+            self.failure_count = 0
+            self.last_failure_time = None
         logger.info(f"Circuit breaker '{self.name}' manually reset")
 
     def get_state(self) -> dict[str, Any]:
         """Получить текущее состояние Circuit Breaker."""
-        return {
-            "state": self.state.value,
-            "failure_count": self.failure_count,
-            "last_failure_time": self.last_failure_time,
-            "threshold": self.failure_threshold,
-            "timeout": self.timeout
-        }
+        with self._lock:
+            return {
+                "state": self.state.value,
+                "failure_count": self.failure_count,
+                "last_failure_time": self.last_failure_time,
+                "threshold": self.failure_threshold,
+                "timeout": self.timeout
+            }
 
 
 # Глобальные Circuit Breakers для разных сервисов
@@ -160,6 +217,26 @@ qdrant_circuit_breaker = CircuitBreaker(
 )
 
 
+# Отдельные breakers для каждого LLM-провайдера (создаются лениво)
+_provider_breakers: Dict[str, CircuitBreaker] = {}
+_provider_breakers_lock = threading.Lock()
+
+
+def get_provider_circuit_breaker(provider: str) -> CircuitBreaker:
+    """Circuit Breaker конкретного LLM-провайдера (llm_<provider>)."""
+    key = provider.upper()
+    with _provider_breakers_lock:
+        breaker = _provider_breakers.get(key)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                failure_threshold=llm_circuit_breaker.failure_threshold,
+                timeout=llm_circuit_breaker.timeout,
+                name=f"llm_{key.lower()}",
+            )
+            _provider_breakers[key] = breaker
+        return breaker
+
+
 def with_circuit_breaker(circuit_breaker: CircuitBreaker):
     """
     Декоратор для применения Circuit Breaker к функции.
@@ -176,11 +253,16 @@ def with_circuit_breaker(circuit_breaker: CircuitBreaker):
 
 def get_all_circuit_breakers() -> dict[str, dict[str, Any]]:
     """Получить состояние всех Circuit Breakers."""
-    return {
+    states = {
         "llm": llm_circuit_breaker.get_state(),
         "embedding": embedding_circuit_breaker.get_state(),
         "qdrant": qdrant_circuit_breaker.get_state(),
     }
+    with _provider_breakers_lock:
+        providers = dict(_provider_breakers)
+    for key, breaker in providers.items():
+        states[f"llm_{key.lower()}"] = breaker.get_state()
+    return states
 
 
 def reset_all_circuit_breakers() -> None:
@@ -188,4 +270,8 @@ def reset_all_circuit_breakers() -> None:
     llm_circuit_breaker.reset()
     embedding_circuit_breaker.reset()
     qdrant_circuit_breaker.reset()
+    with _provider_breakers_lock:
+        providers = list(_provider_breakers.values())
+    for breaker in providers:
+        breaker.reset()
     logger.info("All circuit breakers reset")
@@ -0,0 +1,137 @@
+"""
+Дедлайн запроса: общий бюджет времени на весь пайплайн (REQUEST_DEADLINE_S).
+
+handle_query открывает deadline_scope(), и дедлайн через contextvar виден
+всем этапам (в том числе в потоках графа этапов и пула CPU-этапов). Когда
+оставшегося времени становится мало, этапы деградируют в заданном порядке —
+каждый шаг срабатывает, если к его началу осталось меньше своей доли бюджета:
+
+1. shrink_k — поиск с уменьшенным k;
+2. skip_rerank — порядок кандидатов после RRF вместо reranker;
+3. skip_auto_merge — без слияния соседних чанков;
+4. fastest_provider — один самый быстрый провайдер LLM без fallback.
+
+Шаги можно включить принудительно (forced) — так admission control
+удешевляет запросы, принятые при перегрузке (шаг cheap_strategy —
+облегчённая RetrievalStrategy). Сработавшие шаги записываются в лог
+запроса (degradations) и в метрику rag_request_degradations_total.
+Таймауты чтения HTTP-вызовов LLM и fallback на следующего провайдера
+ограничены оставшимся временем.
+"""
+from __future__ import annotations
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from loguru import logger
+
+from app.infrastructure.metrics import request_degradations_total
+
+# Доля бюджета, которая должна оставаться к началу шага, иначе шаг деградирует
+DEGRADATION_RESERVES: Dict[str, float] = {
+    "shrink_k": 0.8,
+    "skip_rerank": 0.65,
+    "skip_auto_merge": 0.55,
+    "fastest_provider": 0.45,
+}
+
+# Минимальный таймаут чтения HTTP: при почти истёкшем дедлайне запрос
+# получает шанс на быстрый ответ, а не падает сразу
+MIN_CALL_TIMEOUT_S = 1.0
+
+
+class Deadline:
+    """Бюджет времени одного запроса (math.inf — без ограничения) и сработавшие деградации."""
+
+    def __init__(self, budget_s: float, started_at: Optional[float] = None, forced: Iterable[str] = ()):
+        self.budget_s = float(budget_s)
+        self.started_at = time.monotonic() if started_at is None else started_at
+        self.forced = frozenset(forced)
+        self.degradations: List[str] = []
+        self._lock = threading.Lock()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def remaining(self) -> float:
+        return max(0.0, self.budget_s - self.elapsed())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def should_degrade(self, step: str, needed_s: float = 0.0) -> bool:
+        """
+        Нужно ли деградировать шаг step (см. DEGRADATION_RESERVES; шаги
+        из forced деградируют всегда, шаги без резерва — только принудительно).
+
+        Args:
+            step: имя шага
+            needed_s: сколько времени требует сам шаг (например, ожидаемая
+                задержка провайдера); шаг деградирует и при remaining < needed_s
+        """
+        if step in self.degradations:
+            return True
+        remaining = self.remaining()
+        if step not in self.forced:
+            reserve = DEGRADATION_RESERVES.get(step)
+            if reserve is None or remaining >= max(reserve * self.budget_s, needed_s):
+                return False
+        with self._lock:
+            if step in self.degradations:
+                return True
+            self.degradations.append(step)
+        request_degradations_total.labels(step=step).inc()
+        if step in self.forced:
+            logger.info(f"Request deadline: degrading {step} (forced)")
+        else:
+            logger.info(f"Request deadline: degrading {step} ({remaining:.2f}s of {self.budget_s:.1f}s left)")
+        return True
+
+    def cap_timeout(self, timeout: float) -> float:
+        """Таймаут вызова, не выходящий за дедлайн (но не меньше MIN_CALL_TIMEOUT_S)."""
+        return min(float(timeout), max(MIN_CALL_TIMEOUT_S, self.remaining()))
+
+
+_current: ContextVar[Optional[Deadline]] = ContextVar("request_deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """Дедлайн текущего запроса или None (дедлайн не задан)."""
+    return _current.get()
+
+
+def should_degrade(step: str, needed_s: float = 0.0) -> bool:
+    """Deadline.should_degrade для текущего запроса; без дедлайна — всегда False."""
+    deadline = _current.get()
+    return deadline is not None and deadline.should_degrade(step, needed_s)
+
+
+def deadline_expired() -> bool:
+    deadline = _current.get()
+    return deadline is not None and deadline.expired()
+
+
+@contextmanager
+def deadline_scope(budget_s: Optional[float], forced: Iterable[str] = ()) -> Iterator[Optional[Deadline]]:
+    """
+    Устанавливает дедлайн запроса на время блока.
+
+    budget_s <= 0 или None — без ограничения по времени; если при этом нет
+    и принудительных шагов forced, current_deadline() внутри блока — None.
+    """
+    forced = tuple(forced)
+    if budget_s and budget_s > 0:
+        deadline: Optional[Deadline] = Deadline(budget_s, forced=forced)
+    elif forced:
+        deadline = Deadline(math.inf, forced=forced)
+    else:
+        deadline = None
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
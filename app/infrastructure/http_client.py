@@ -0,0 +1,418 @@
+"""
+Пул HTTP-клиентов для LLM-провайдеров.
+
+Каждый провайдер получает собственный долгоживущий клиент с keep-alive пулом
+соединений, поэтому TCP+TLS рукопожатие платится один раз, а не на каждый
+ответ (и не повторно для тематического роутинга, который ходит к тем же
+провайдерам). Поддерживаются:
+- раздельные connect/read таймауты с переопределением по провайдеру;
+- повтор с экспоненциальной задержкой и full jitter для сетевых ошибок
+  и статусов 429/5xx;
+- опциональный HTTP/2 через httpx (если установлен пакет h2);
+- метрики запросов, новых соединений и повторов;
+- дедлайн запроса (app.infrastructure.deadline): таймаут чтения не выходит
+  за оставшееся время, после дедлайна повторы не выполняются;
+- спан трассировки http.post (статус, попытки, байты запроса и ответа).
+"""
+from __future__ import annotations
+
+import asyncio
+import importlib.util
+import random
+import threading
+import time
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from app.config import CONFIG
+from app.infrastructure.deadline import current_deadline, deadline_expired
+from app.infrastructure.tracing import span
+from app.infrastructure.metrics import (
+    llm_http_connections_total,
+    llm_http_requests_total,
+    llm_http_retries_total,
+)
+
+_HTTP2_AVAILABLE = (
+    importlib.util.find_spec("httpx") is not None and importlib.util.find_spec("h2") is not None
+)
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+def parse_provider_timeouts(raw: str) -> Dict[str, Tuple[float, float]]:
+    """
+    Разбирает LLM_HTTP_TIMEOUTS вида "YANDEX=3/60,GIGACHAT=5/90".
+
+    Returns:
+        {provider: (connect_timeout, read_timeout)}
+    """
+    result: Dict[str, Tuple[float, float]] = {}
+    for item in (raw or "").split(","):
+        if "=" not in item:
+            continue
+        name, _, value = item.partition("=")
+        connect, _, read = value.partition("/")
+        try:
+            result[name.strip().upper()] = (float(connect), float(read or connect))
+        except ValueError:
+            logger.warning(f"Ignoring malformed LLM_HTTP_TIMEOUTS entry: {item!r}")
+    return result
+
+
+def _counting_pool(base: type, provider: str) -> type:
+    """Пул urllib3, считающий открытие новых соединений для метрики переиспользования."""
+
+    class _Pool(base):  # type: ignore[misc, valid-type]
+        def _new_conn(self):  # noqa: D401 - переопределение urllib3
+            llm_http_connections_total.labels(provider=provider).inc()
+            return super()._new_conn()
+
+    _Pool.__name__ = f"Counting{base.__name__}"
+    return _Pool
+
+
+class _HttpxResponse:
+    """Адаптер httpx.Response к подмножеству интерфейса requests.Response."""
+
+    def __init__(self, response: Any):
+        self._response = response
+
+    @property
+    def status_code(self) -> int:
+        return self._response.status_code
+
+    @property
+    def headers(self) -> Any:
+        return self._response.headers
+
+    @property
+    def request(self) -> Any:
+        return self._response.request
+
+    @property
+    def text(self) -> str:
+        self._response.read()
+        return self._response.text
+
+    def json(self) -> Any:
+        self._response.read()
+        return self._response.json()
+
+    def raise_for_status(self) -> None:
+        self._response.raise_for_status()
+
+    def iter_lines(self, decode_unicode: bool = True) -> Iterator[str]:
+        return self._response.iter_lines()
+
+    def close(self) -> None:
+        self._response.close()
+
+
+class ProviderHTTPClient:
+    """Долгоживущий HTTP-клиент одного провайдера."""
+
+    def __init__(
+        self,
+        provider: str,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 60.0,
+        max_retries: int = 2,
+        backoff_base: float = 0.2,
+        backoff_max: float = 2.0,
+        pool_size: int = 16,
+        http2: bool = False,
+    ):
+        self.provider = provider
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http2 = http2 and _HTTP2_AVAILABLE
+        if http2 and not self.http2:
+            logger.warning(f"HTTP/2 requested for {provider}, but httpx[http2] is not installed; using HTTP/1.1")
+
+        self._session: Optional[requests.Session] = None
+        self._httpx_client: Any = None
+        if self.http2:
+            import httpx
+
+            self._httpx_client = httpx.Client(
+                http2=True,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+        else:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+            adapter.poolmanager.pool_classes_by_scheme = {
+                "http": _counting_pool(HTTPConnectionPool, provider),
+                "https": _counting_pool(HTTPSConnectionPool, provider),
+            }
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: равномерно в [0, base * 2^attempt], но не больше backoff_max
+        return random.uniform(0.0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _trace(self, event_name: str, _info: Dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            llm_http_connections_total.labels(provider=self.provider).inc()
+
+    def _send(self, url: str, headers: Dict[str, str], payload: Any, stream: bool) -> Any:
+        if self._httpx_client is not None:
+            import httpx
+
+            connect_timeout, read_timeout = _deadline_timeout(self.timeout)
+            request = self._httpx_client.build_request(
+                "POST", url, headers=headers, json=payload, extensions={"trace": self._trace},
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            )
+            return _HttpxResponse(self._httpx_client.send(request, stream=stream))
+        return self._session.post(
+            url, headers=headers, json=payload, timeout=_deadline_timeout(self.timeout), stream=stream
+        )
+
+    def post(self, url: str, headers: Dict[str, str], json: Any = None, stream: bool = False) -> Any:
+        """
+        POST с повтором для сетевых ошибок соединения и статусов 429/5xx.
+
+        Таймауты чтения не повторяются: ответ модели мог уже генерироваться,
+        а повтор удвоил бы ожидание (для этого есть hedging в llm_router).
+        """
+        with span("http.post", provider=self.provider, stream=stream) as call:
+            response = self._post(url, headers, json, stream, call)
+            call.set_attributes(**_transfer_attributes(response))
+            return response
+
+    def _post(self, url: str, headers: Dict[str, str], json: Any, stream: bool, call: Any) -> Any:
+        attempt = 0
+        while True:
+            try:
+                response = self._send(url, headers, json, stream)
+            except Exception as exc:
+                if attempt >= self.max_retries or not _is_retryable_error(exc) or deadline_expired():
+                    llm_http_requests_total.labels(provider=self.provider, status="error").inc()
+                    raise
+                reason = type(exc).__name__
+            else:
+                status = response.status_code
+                if status not in RETRY_STATUSES or attempt >= self.max_retries or deadline_expired():
+                    llm_http_requests_total.labels(provider=self.provider, status=str(status)).inc()
+                    return response
+                response.close()
+                reason = f"http_{status}"
+
+            delay = self._backoff(attempt)
+            attempt += 1
+            call.set("retries", attempt)
+            llm_http_retries_total.labels(provider=self.provider, reason=reason).inc()
+            logger.warning(
+                f"HTTP {self.provider}: retry {attempt}/{self.max_retries} after {reason}, sleeping {delay:.2f}s"
+            )
+            time.sleep(delay)
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+        if self._httpx_client is not None:
+            self._httpx_client.close()
+
+
+class AsyncProviderHTTPClient:
+    """
+    Асинхронный клиент провайдера для async-пайплайна (httpx.AsyncClient).
+
+    Политика повторов и метрики те же, что у ProviderHTTPClient; ожидание
+    ответа не занимает поток, поэтому один процесс держит сотни запросов,
+    ждущих LLM.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 60.0,
+        max_retries: int = 2,
+        backoff_base: float = 0.2,
+        backoff_max: float = 2.0,
+        pool_size: int = 16,
+        http2: bool = False,
+    ):
+        import httpx
+
+        self.provider = provider
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http2 = http2 and _HTTP2_AVAILABLE
+        self._client = httpx.AsyncClient(
+            http2=self.http2,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0.0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    async def _trace(self, event_name: str, _info: Dict[str, Any]) -> None:
+        if event_name == "connection.connect_tcp.complete":
+            llm_http_connections_total.labels(provider=self.provider).inc()
+
+    async def post(self, url: str, headers: Dict[str, str], json: Any = None) -> Any:
+        """POST с теми же правилами повтора, что ProviderHTTPClient.post; возвращает httpx.Response."""
+        with span("http.post", provider=self.provider) as call:
+            response = await self._post(url, headers, json, call)
+            call.set_attributes(**_transfer_attributes(response))
+            return response
+
+    async def _post(self, url: str, headers: Dict[str, str], json: Any, call: Any) -> Any:
+        import httpx
+
+        attempt = 0
+        while True:
+            connect_timeout, read_timeout = _deadline_timeout(self.timeout)
+            try:
+                response = await self._client.post(
+                    url, headers=headers, json=json, extensions={"trace": self._trace},
+                    timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                )
+            except Exception as exc:
+                if attempt >= self.max_retries or not _is_retryable_error(exc) or deadline_expired():
+                    llm_http_requests_total.labels(provider=self.provider, status="error").inc()
+                    raise
+                reason = type(exc).__name__
+            else:
+                status = response.status_code
+                if status not in RETRY_STATUSES or attempt >= self.max_retries or deadline_expired():
+                    llm_http_requests_total.labels(provider=self.provider, status=str(status)).inc()
+                    return response
+                reason = f"http_{status}"
+
+            delay = self._backoff(attempt)
+            attempt += 1
+            call.set("retries", attempt)
+            llm_http_retries_total.labels(provider=self.provider, reason=reason).inc()
+            logger.warning(
+                f"HTTP {self.provider}: retry {attempt}/{self.max_retries} after {reason}, sleeping {delay:.2f}s"
+            )
+            await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        await self._client.aclose()
+
+
+def _deadline_timeout(timeout: Tuple[float, float]) -> Tuple[float, float]:
+    """(connect, read) с таймаутом чтения, не выходящим за дедлайн запроса."""
+    deadline = current_deadline()
+    if deadline is None:
+        return timeout
+    connect_timeout, read_timeout = timeout
+    return connect_timeout, deadline.cap_timeout(read_timeout)
+
+
+def _transfer_attributes(response: Any) -> Dict[str, Any]:
+    """Статус и размеры тел запроса и ответа (по Content-Length, если он известен)."""
+    attributes: Dict[str, Any] = {"status": response.status_code}
+    request = getattr(response, "request", None)
+    for key, headers in (
+        ("request_bytes", getattr(request, "headers", None)),
+        ("response_bytes", getattr(response, "headers", None)),
+    ):
+        length = headers.get("content-length") if headers is not None else None
+        if length is not None and str(length).isdigit():
+            attributes[key] = int(length)
+    return attributes
+
+
+def _is_retryable_error(exc: Exception) -> bool:
+    if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout)):
+        # ReadTimeout не наследуется от ConnectionError, поэтому сюда не попадает
+        return True
+    name = type(exc).__name__
+    return name in {"ConnectError", "ConnectTimeout", "RemoteProtocolError"}
+
+
+_clients: Dict[str, ProviderHTTPClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_provider_http_client(provider: str) -> ProviderHTTPClient:
+    """Возвращает общий для процесса клиент провайдера (создаётся лениво)."""
+    key = provider.upper()
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            settings = _client_settings(key)
+            client = ProviderHTTPClient(key, **settings)
+            _clients[key] = client
+            logger.info(
+                f"HTTP client for {key} initialized (connect={settings['connect_timeout']}s, "
+                f"read={settings['read_timeout']}s, http2={client.http2})"
+            )
+    return client
+
+
+# Асинхронные клиенты привязаны к event loop, в котором созданы
+_async_clients: Dict[Tuple[str, int], AsyncProviderHTTPClient] = {}
+
+
+def get_async_provider_http_client(provider: str) -> AsyncProviderHTTPClient:
+    """Асинхронный клиент провайдера для текущего event loop (создаётся лениво)."""
+    key = (provider.upper(), id(asyncio.get_running_loop()))
+    client = _async_clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _async_clients.get(key)
+            if client is None:
+                client = AsyncProviderHTTPClient(key[0], **_client_settings(key[0]))
+                _async_clients[key] = client
+                logger.info(f"Async HTTP client for {key[0]} initialized (http2={client.http2})")
+    return client
+
+
+async def close_async_provider_http_clients() -> None:
+    """Закрывает асинхронные клиенты текущего event loop (при остановке ASGI-приложения)."""
+    loop_id = id(asyncio.get_running_loop())
+    with _clients_lock:
+        keys = [key for key in _async_clients if key[1] == loop_id]
+        clients = [_async_clients.pop(key) for key in keys]
+    for client in clients:
+        await client.aclose()
+
+
+def _client_settings(key: str) -> Dict[str, Any]:
+    overrides = parse_provider_timeouts(getattr(CONFIG, "llm_http_timeouts", ""))
+    connect_timeout, read_timeout = overrides.get(
+        key,
+        (
+            float(getattr(CONFIG, "llm_http_connect_timeout_s", 5.0)),
+            float(getattr(CONFIG, "llm_http_read_timeout_s", 60.0)),
+        ),
+    )
+    return dict(
+        connect_timeout=connect_timeout,
+        read_timeout=read_timeout,
+        max_retries=int(getattr(CONFIG, "llm_http_max_retries", 2)),
+        backoff_base=float(getattr(CONFIG, "llm_http_backoff_base_s", 0.2)),
+        pool_size=int(getattr(CONFIG, "llm_http_pool_size", 16)),
+        http2=bool(getattr(CONFIG, "llm_http2_enabled", False)),
+    )
+
+
+def close_provider_http_clients() -> None:
+    """Закрывает все клиенты (для тестов и корректного завершения процесса)."""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
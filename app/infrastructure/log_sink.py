@@ -0,0 +1,317 @@
+"""
+Фоновая запись JSONL-логов: лог запросов и диагностические события.
+
+Поток запроса только сериализует запись (orjson, если установлен) и кладёт
+её в ограниченную очередь — без обращения к диску. Один фоновый поток на
+лог:
+- пишет всё накопившееся одной пачкой (до batch_size записей за вызов
+  write) в постоянно открытый файл;
+- переходит на новый файл при смене даты (UTC) и при превышении
+  max_file_bytes; файлы, закрытые по размеру или за прошедший день,
+  сжимаются (gzip или zstd, если установлен zstandard);
+- переоткрывает файл, если его переименовали или удалили снаружи
+  (logrotate, ротация в другом воркере gunicorn).
+
+Если диск не успевает и очередь заполнена, новые записи отбрасываются.
+Исходы записей экспортируются в rag_log_sink_records_total{sink, outcome}
+(written | dropped | failed), глубина очереди — в rag_log_sink_queue_depth.
+"""
+from __future__ import annotations
+
+import atexit
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from app.config import CONFIG
+from app.infrastructure.metrics import log_sink_queue_depth, log_sink_records_total
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - без orjson используется стандартный json
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - без zstandard сжатие zstd заменяется gzip
+    zstandard = None
+
+COMPRESSIONS = ("none", "gzip", "zstd")
+_COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+_STOP = object()
+
+
+def encode_record(record: Dict[str, Any]) -> bytes:
+    """JSON-строка записи с переводом строки (UTF-8, без экранирования кириллицы)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(record, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+        except TypeError:
+            # Типы, которых orjson не знает (например, целые больше 64 бит)
+            pass
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _utc_date() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+class LogSink:
+    """
+    Ограниченная очередь записей одного лога и фоновый поток записи.
+
+    Файлы: <directory>/<prefix><YYYY-MM-DD><suffix>; закрытые по размеру —
+    <prefix><YYYY-MM-DD>.<n><suffix> (и сжатые копии с .gz/.zst).
+    """
+
+    def __init__(
+        self,
+        name: str,
+        directory: str,
+        prefix: str = "",
+        suffix: str = ".jsonl",
+        max_queue_size: int = 10000,
+        batch_size: int = 256,
+        max_file_bytes: int = 100 * 1024 * 1024,
+        compression: str = "none",
+    ):
+        if max_queue_size <= 0 or batch_size <= 0:
+            raise ValueError("max_queue_size and batch_size must be positive")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"compression must be one of {COMPRESSIONS}")
+        if compression == "zstd" and zstandard is None:
+            logger.warning(f"Log sink {name}: zstandard not installed, using gzip")
+            compression = "gzip"
+        self.name = name
+        self.directory = directory
+        self.prefix = prefix
+        self.suffix = suffix
+        self.batch_size = batch_size
+        self.max_file_bytes = max_file_bytes
+        self.compression = compression
+        self._queue: "queue.Queue[object]" = queue.Queue(maxsize=max_queue_size)
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._file: Any = None
+        self._path: Optional[str] = None
+        self._date: Optional[str] = None
+        self._size = 0
+        self._dropping = False
+
+    # ------------------------------------------------------------------ API
+
+    def write(self, record: Dict[str, Any]) -> bool:
+        """Поставить запись в очередь; False — запись отброшена (не JSON или очередь полна)."""
+        try:
+            line = encode_record(record)
+        except Exception as exc:
+            self._count("failed")
+            logger.warning(f"Log sink {self.name}: record is not JSON-serializable: {exc}")
+            return False
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            self._count("dropped")
+            if not self._dropping:
+                # Одно предупреждение на серию отбрасываний, а не на каждую запись
+                self._dropping = True
+                logger.warning(f"Log sink {self.name}: queue is full, dropping records")
+            return False
+        return True
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Дождаться записи уже поставленных записей; False — не успели за timeout."""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        """Дописать очередь и остановить поток записи."""
+        worker = self._worker
+        if worker is None:
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            logger.warning(f"Log sink {self.name}: queue is still full on shutdown")
+            return
+        worker.join(timeout=timeout)
+        self._worker = None
+
+    # ------------------------------------------------------------- internals
+
+    def _count(self, outcome: str, amount: int = 1) -> None:
+        log_sink_records_total.labels(sink=self.name, outcome=outcome).inc(amount)
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=f"{self.name}-log", daemon=True)
+                self._worker.start()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            batch: List[bytes] = []
+            taken = 1
+            if item is _STOP:
+                stopping = True
+            else:
+                batch.append(item)  # type: ignore[arg-type]
+            # Забираем без ожидания всё, что уже накопилось: под нагрузкой пачки растут сами
+            while not stopping and len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                taken += 1
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)  # type: ignore[arg-type]
+            if batch:
+                self._write_batch(batch)
+            log_sink_queue_depth.labels(sink=self.name).set(self._queue.qsize())
+            for _ in range(taken):
+                self._queue.task_done()
+        self._close()
+
+    def _write_batch(self, batch: List[bytes]) -> None:
+        data = b"".join(batch)
+        try:
+            self._file_for(len(data)).write(data)
+            self._file.flush()
+            self._size += len(data)
+        except Exception as exc:
+            self._count("failed", len(batch))
+            logger.warning(f"Log sink {self.name}: failed to write {len(batch)} records: {exc}")
+            self._close()
+            return
+        self._count("written", len(batch))
+        self._dropping = False
+
+    def _file_for(self, incoming: int) -> Any:
+        date = _utc_date()
+        if self._file is not None and date != self._date:
+            previous = self._path
+            self._close()
+            self._compress_later(previous)
+        elif self._file is not None and not self._is_current_file():
+            self._close()
+        if self._file is None:
+            self._open(date)
+        if self._size and self._size + incoming > self.max_file_bytes:
+            self._close()
+            self._compress_later(self._rotate(date))
+            self._open(date)
+        return self._file
+
+    def _path_for(self, date: str, index: Optional[int] = None) -> str:
+        part = f".{index}" if index is not None else ""
+        return os.path.join(self.directory, f"{self.prefix}{date}{part}{self.suffix}")
+
+    def _open(self, date: str) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        self._path = self._path_for(date)
+        self._date = date
+        self._file = open(self._path, "ab")
+        self._size = self._file.tell()
+
+    def _close(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.close()
+            except Exception:  # pragma: no cover - файл уже недоступен
+                pass
+        self._file = None
+
+    def _is_current_file(self) -> bool:
+        """Открытый файл всё ещё лежит по своему пути (его не переименовали и не удалили)."""
+        try:
+            return os.stat(self._path).st_ino == os.fstat(self._file.fileno()).st_ino
+        except OSError:
+            return False
+
+    def _rotate(self, date: str) -> Optional[str]:
+        """Переименовывает текущий файл в первый свободный <prefix><date>.<n><suffix>."""
+        index = 1
+        compressed = _COMPRESSED_SUFFIXES.get(self.compression, "")
+        while os.path.exists(self._path_for(date, index)) or (
+            compressed and os.path.exists(self._path_for(date, index) + compressed)
+        ):
+            index += 1
+        target = self._path_for(date, index)
+        try:
+            os.replace(self._path_for(date), target)
+        except FileNotFoundError:
+            # Файл уже ротировал другой процесс
+            return None
+        return target
+
+    def _compress_later(self, path: Optional[str]) -> None:
+        if self.compression == "none" or not path:
+            return
+        threading.Thread(
+            target=self._compress, args=(path,), name=f"{self.name}-log-compress", daemon=True
+        ).start()
+
+    def _compress(self, path: str) -> None:
+        target = path + _COMPRESSED_SUFFIXES[self.compression]
+        try:
+            with open(path, "rb") as src:
+                if self.compression == "zstd":
+                    with open(target, "wb") as dst:
+                        zstandard.ZstdCompressor().copy_stream(src, dst)
+                else:
+                    with gzip.open(target, "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+            os.remove(path)
+        except FileNotFoundError:
+            # Файл сжал другой процесс
+            return
+        except Exception as exc:
+            logger.warning(f"Log sink {self.name}: failed to compress {path}: {exc}")
+
+
+_sinks: Dict[str, LogSink] = {}
+_sinks_lock = threading.Lock()
+
+
+def get_log_sink(name: str, directory: str, prefix: str = "", suffix: str = ".jsonl") -> LogSink:
+    """Общий для процесса лог name (каталог и имя файла задаются при первом вызове)."""
+    sink = _sinks.get(name)
+    if sink is None:
+        with _sinks_lock:
+            sink = _sinks.get(name)
+            if sink is None:
+                sink = LogSink(
+                    name,
+                    directory,
+                    prefix=prefix,
+                    suffix=suffix,
+                    max_queue_size=int(getattr(CONFIG, "log_sink_queue_size", 10000)),
+                    batch_size=int(getattr(CONFIG, "log_sink_batch_size", 256)),
+                    max_file_bytes=int(float(getattr(CONFIG, "log_sink_max_file_mb", 100)) * 1024**2),
+                    compression=str(getattr(CONFIG, "log_sink_compression", "none")),
+                )
+                atexit.register(sink.shutdown)
+                _sinks[name] = sink
+    return sink
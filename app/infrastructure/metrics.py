@@ -206,6 +206,136 @@ cpu_usage_percent = Gauge(
     ['component']
 )
 
+# Метрики общего воркера реранкера
+rerank_queue_depth = Gauge(
+    'rag_rerank_queue_depth',
+    'Number of rerank jobs waiting in the shared batcher queue'
+)
+
+rerank_batch_size = Histogram(
+    'rag_rerank_batch_pairs',
+    'Number of (query, document) pairs scored per reranker batch',
+    buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256]
+)
+
+rerank_rejected_total = Counter(
+    'rag_rerank_rejected_total',
+    'Rerank jobs rejected by the batcher',
+    ['reason']
+)
+
+# Метрики hedged-запросов к LLM
+llm_hedge_requests_total = Counter(
+    'rag_llm_hedge_requests_total',
+    'LLM generations by hedging outcome (hedged or unhedged)',
+    ['outcome']
+)
+
+llm_hedge_wins_total = Counter(
+    'rag_llm_hedge_wins_total',
+    'Winning LLM provider responses by role (primary, hedge, fallback)',
+    ['provider', 'role']
+)
+
+llm_provider_saturated_total = Counter(
+    'rag_llm_provider_saturated_total',
+    'LLM provider calls skipped (hedge) or timed out waiting because the per-provider concurrency cap was reached',
+    ['provider']
+)
+
+# Single-flight: объединение одновременных одинаковых вызовов (роль: leader | follower | timeout)
+single_flight_calls_total = Counter(
+    'rag_single_flight_calls_total',
+    'Calls passed through single-flight groups',
+    ['name', 'role']
+)
+
+# Вызовы функций через @cached (исход: hit | miss | wait_hit | lock_timeout | early_refresh | negative_hit)
+cached_calls_total = Counter(
+    'rag_cached_calls_total',
+    'Calls through the @cached decorator by outcome',
+    ['prefix', 'outcome']
+)
+
+# Деградации этапов запроса при нехватке времени до дедлайна (shrink_k, skip_rerank, ...)
+request_degradations_total = Counter(
+    'rag_request_degradations_total',
+    'Pipeline stages degraded to meet the request deadline',
+    ['step']
+)
+
+# Admission control /v1/chat/query: решения (accept | degrade | reject) и запросы в работе
+admission_decisions_total = Counter(
+    'rag_admission_decisions_total',
+    'Chat query admission decisions (degrade = cheaper pipeline, reject = shed with 503)',
+    ['decision']
+)
+
+admission_in_flight = Gauge(
+    'rag_admission_in_flight',
+    'Chat queries admitted and currently in progress'
+)
+
+# Фоновая запись логов (лог запросов, диагностика): записи по исходу
+# (written | dropped | failed) и глубина очереди записи
+log_sink_records_total = Counter(
+    'rag_log_sink_records_total',
+    'Log records handled by background log sinks by outcome (written, dropped, failed)',
+    ['sink', 'outcome']
+)
+
+log_sink_queue_depth = Gauge(
+    'rag_log_sink_queue_depth',
+    'Log records waiting in the background log sink queue',
+    ['sink']
+)
+
+# Процессный кэш (InMemoryCache): вытеснения по причине (capacity | bytes | expired | rejected)
+memory_cache_evictions_total = Counter(
+    'rag_memory_cache_evictions_total',
+    'Entries removed from or not admitted to the in-process cache',
+    ['cache', 'reason']
+)
+
+# Размер контекста после упаковки (дедупликация + бюджет токенов)
+llm_context_tokens = Histogram(
+    'rag_llm_context_tokens',
+    'Tokens in the packed LLM context block',
+    buckets=[250, 500, 1000, 1500, 2000, 2500, 3000, 4000, 6000]
+)
+
+# Метрики пула HTTP-клиентов LLM-провайдеров (переиспользование соединений = 1 - connections / requests)
+llm_http_requests_total = Counter(
+    'rag_llm_http_requests_total',
+    'HTTP requests sent to LLM providers',
+    ['provider', 'status']
+)
+
+llm_http_connections_total = Counter(
+    'rag_llm_http_connections_total',
+    'New TCP connections opened to LLM providers',
+    ['provider']
+)
+
+llm_http_retries_total = Counter(
+    'rag_llm_http_retries_total',
+    'Retried HTTP requests to LLM providers',
+    ['provider', 'reason']
+)
+
+# Фоновая очередь задач качества (kind: save | evaluate)
+quality_queue_depth = Gauge(
+    'rag_quality_queue_depth',
+    'Quality tasks waiting in the background queue',
+    ['kind']
+)
+
+quality_tasks_total = Counter(
+    'rag_quality_tasks_total',
+    'Background quality tasks by outcome (processed, failed, dropped, sampled_out)',
+    ['kind', 'outcome']
+)
+
 # Информационные метрики
 app_info = Info(
     'rag_app_info',
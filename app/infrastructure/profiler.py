@@ -0,0 +1,286 @@
+"""
+Сэмплирующий профилировщик рабочего процесса (без внешних зависимостей).
+
+Профилировщик периодически снимает стеки всех потоков процесса через
+sys._current_frames() и считает, сколько раз встретился каждый стек. Код
+не инструментируется, сигналы и трассировка интерпретатора не используются,
+поэтому нагрузка ограничена частотой выборок и профилировщик безопасен в
+production:
+
+- profile_for() — профиль за N секунд для /v1/admin/profile; одновременно
+  идёт не больше одного такого профиля, длительность ограничена
+  PROFILER_MAX_DURATION_S. Результат отдаётся в collapsed-формате
+  (flamegraph.pl, speedscope) или в JSON-формате speedscope;
+- BackgroundSampler — опциональная постоянная выборка с низкой частотой
+  (PROFILER_BACKGROUND_ENABLED), агрегирующая горячие функции в скользящем
+  окне (/v1/admin/profile/summary).
+
+Потоки, ждущие блокировки, очереди или сокета, по умолчанию не учитываются:
+такие выборки показывают простой, а не расход CPU.
+"""
+from __future__ import annotations
+
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.config import CONFIG
+
+# (функция, файл, строка начала функции)
+Frame = Tuple[str, str, int]
+Stack = Tuple[Frame, ...]
+
+MIN_INTERVAL_S = 0.001
+MAX_STACK_DEPTH = 128
+
+# Листовые функции ожидания: поток с таким стеком простаивает
+_IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("socket.py", "accept"),
+    ("socket.py", "readinto"),
+    ("ssl.py", "read"),
+    ("thread.py", "_worker"),
+}
+
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_frame_cache: Dict[Any, Frame] = {}
+
+
+class ProfilerBusyError(RuntimeError):
+    """Профиль уже снимается другим запросом."""
+
+
+def _frame(code: Any) -> Frame:
+    frame = _frame_cache.get(code)
+    if frame is None:
+        path = code.co_filename
+        if path.startswith(_PROJECT_ROOT):
+            path = os.path.relpath(path, _PROJECT_ROOT)
+        frame = (getattr(code, "co_qualname", code.co_name), path, code.co_firstlineno)
+        _frame_cache[code] = frame
+    return frame
+
+
+def _stack(frame: Any) -> Stack:
+    """Стек от корня к листу."""
+    frames: List[Frame] = []
+    while frame is not None and len(frames) < MAX_STACK_DEPTH:
+        frames.append(_frame(frame.f_code))
+        frame = frame.f_back
+    frames.reverse()
+    return tuple(frames)
+
+
+def _is_idle(stack: Stack) -> bool:
+    if not stack:
+        return True
+    name, path, _line = stack[-1]
+    return (os.path.basename(path), name.rsplit(".", 1)[-1]) in _IDLE_LEAVES
+
+
+def sample_stacks(include_idle: bool = False) -> List[Stack]:
+    """Одна выборка: стеки всех потоков, кроме текущего."""
+    own = threading.get_ident()
+    stacks = []
+    for ident, frame in sys._current_frames().items():
+        if ident == own:
+            continue
+        stack = _stack(frame)
+        if include_idle or not _is_idle(stack):
+            stacks.append(stack)
+    return stacks
+
+
+def _label(frame: Frame) -> str:
+    name, path, line = frame
+    return f"{name} ({path}:{line})"
+
+
+@dataclass
+class Profile:
+    """Результат профилирования: число выборок каждого стека."""
+
+    interval_s: float
+    duration_s: float = 0.0
+    samples: int = 0
+    stacks: Counter = field(default_factory=Counter)
+
+    def to_collapsed(self) -> str:
+        """Формат collapsed stacks: «корень;...;лист число» на строку."""
+        return "\n".join(
+            f"{';'.join(_label(frame) for frame in stack)} {count}"
+            for stack, count in self.stacks.most_common()
+        )
+
+    def to_speedscope(self, name: str = "rag-service") -> Dict[str, Any]:
+        """Профиль в формате speedscope (sampled, вес выборки — интервал в секундах)."""
+        frames: List[Dict[str, Any]] = []
+        index: Dict[Frame, int] = {}
+        samples: List[List[int]] = []
+        weights: List[float] = []
+        for stack, count in self.stacks.most_common():
+            indices = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({"name": frame[0], "file": frame[1], "line": frame[2]})
+                indices.append(index[frame])
+            samples.append(indices)
+            weights.append(round(count * self.interval_s, 6))
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": round(sum(weights), 6),
+                "samples": samples,
+                "weights": weights,
+            }],
+            "exporter": "app.infrastructure.profiler",
+        }
+
+
+_profile_lock = threading.Lock()
+
+
+def profile_for(duration_s: float, interval_s: float = 0.01, include_idle: bool = False) -> Profile:
+    """
+    Снимает профиль в текущем потоке в течение duration_s.
+
+    Raises:
+        ProfilerBusyError: другой профиль ещё не закончен
+    """
+    duration_s = min(float(duration_s), float(getattr(CONFIG, "profiler_max_duration_s", 60.0)))
+    interval_s = min(max(MIN_INTERVAL_S, float(interval_s)), duration_s)
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusyError("profile is already running")
+    profile = Profile(interval_s=interval_s)
+    started = time.monotonic()
+    try:
+        logger.info(f"Profiler: sampling for {duration_s:.1f}s every {interval_s * 1000:.1f}ms")
+        while time.monotonic() - started < duration_s:
+            profile.stacks.update(sample_stacks(include_idle))
+            profile.samples += 1
+            time.sleep(interval_s)
+    finally:
+        profile.duration_s = time.monotonic() - started
+        _profile_lock.release()
+    return profile
+
+
+class BackgroundSampler:
+    """
+    Постоянная выборка с низкой частотой в фоновом потоке.
+
+    Хранит не стеки, а счётчики функций (собственное и включающее время)
+    по корзинам скользящего окна, поэтому память не растёт со временем.
+    """
+
+    BUCKETS = 10
+
+    def __init__(self, interval_s: float = 0.1, window_s: float = 300.0):
+        self.interval_s = max(MIN_INTERVAL_S, interval_s)
+        self.window_s = window_s
+        self._bucket_s = window_s / self.BUCKETS
+        self._buckets: Deque[Tuple[float, Counter, Counter, List[int]]] = deque()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rag-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Profiler: background sampler started, interval {self.interval_s * 1000:.0f}ms")
+
+    def stop(self, timeout: float = 5.0) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval_s):
+            try:
+                self.record(sample_stacks())
+            except Exception as exc:  # pragma: no cover - выборка не должна останавливать поток
+                logger.debug(f"Profiler: background sample failed: {exc}")
+
+    def record(self, stacks: List[Stack], now: Optional[float] = None) -> None:
+        """Учитывает одну выборку (стеки всех потоков)."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if not self._buckets or now - self._buckets[-1][0] >= self._bucket_s:
+                self._buckets.append((now, Counter(), Counter(), [0]))
+            while self._buckets and now - self._buckets[0][0] > self.window_s:
+                self._buckets.popleft()
+            _started, own, total, samples = self._buckets[-1]
+            samples[0] += 1
+            for stack in stacks:
+                own[stack[-1]] += 1
+                # Рекурсивная функция в одном стеке учитывается один раз
+                total.update(set(stack))
+
+    def summary(self, top: int = 20) -> Dict[str, Any]:
+        """Горячие функции за окно: доля выборок в самой функции (self) и в её поддереве (total)."""
+        own: Counter = Counter()
+        total: Counter = Counter()
+        samples = 0
+        with self._lock:
+            for _started, bucket_own, bucket_total, bucket_samples in self._buckets:
+                own.update(bucket_own)
+                total.update(bucket_total)
+                samples += bucket_samples[0]
+        busy = sum(own.values())
+        functions = [
+            {
+                "function": _label(frame),
+                "self_samples": own[frame],
+                "total_samples": total[frame],
+                "self_pct": round(100.0 * own[frame] / busy, 2) if busy else 0.0,
+                "total_pct": round(100.0 * total[frame] / busy, 2) if busy else 0.0,
+            }
+            for frame, _count in own.most_common(top)
+        ]
+        return {
+            "enabled": True,
+            "window_s": self.window_s,
+            "interval_s": self.interval_s,
+            "samples": samples,
+            "busy_thread_samples": busy,
+            "functions": functions,
+        }
+
+
+_background: Optional[BackgroundSampler] = None
+_background_lock = threading.Lock()
+
+
+def get_background_sampler() -> Optional[BackgroundSampler]:
+    """Фоновый сэмплер процесса, запускается при первом вызове (None, если он выключен)."""
+    global _background
+    if not getattr(CONFIG, "profiler_background_enabled", False):
+        return None
+    if _background is None:
+        with _background_lock:
+            if _background is None:
+                sampler = BackgroundSampler(
+                    interval_s=float(getattr(CONFIG, "profiler_background_interval_s", 0.1)),
+                    window_s=float(getattr(CONFIG, "profiler_background_window_s", 300.0)),
+                )
+                sampler.start()
+                _background = sampler
+    return _background
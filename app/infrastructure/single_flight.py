@@ -0,0 +1,79 @@
+"""
+Single-flight: объединение одновременных одинаковых вызовов.
+
+Первый вызов с данным ключом (лидер) выполняет функцию, остальные,
+пришедшие до его завершения (ведомые), ждут и получают тот же результат
+или то же исключение. После завершения ключ освобождается — это не кэш,
+а защита от дублирующихся дорогих вызовов во время всплесков трафика.
+"""
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from app.infrastructure.metrics import single_flight_calls_total
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "followers")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Группа single-flight вызовов с общим пространством ключей."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Any, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Any, fn: Callable[[], Any], timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        Выполняет fn один раз на все одновременные вызовы с ключом key.
+
+        Args:
+            key: хешируемый ключ
+            fn: функция без аргументов
+            timeout: сколько ведомый ждёт лидера; по истечении выполняет fn сам
+
+        Returns:
+            (результат, shared) — shared=True, если результат получен от лидера
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.followers += 1
+
+        if not leader:
+            if call.done.wait(timeout):
+                single_flight_calls_total.labels(name=self.name, role="follower").inc()
+                if call.error is not None:
+                    raise call.error
+                return call.result, True
+            single_flight_calls_total.labels(name=self.name, role="timeout").inc()
+            return fn(), False
+
+        single_flight_calls_total.labels(name=self.name, role="leader").inc()
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -0,0 +1,241 @@
+"""
+Иерархические спаны запроса (лёгкая трассировка без OpenTelemetry SDK).
+
+handle_query открывает trace_scope(); доля запросов TRACING_SAMPLE_RATE
+трассируется, и внутри такого запроса span("retrieval.dense", limit=k)
+открывает дочерний спан текущего. Текущий спан хранится в contextvar,
+поэтому вложенность сохраняется в потоках графа этапов, пула CPU-этапов
+и hedged-вызовов LLM. Атрибуты спанов — размеры батчей, число кандидатов,
+объём переданных байт.
+
+Вне трассируемого запроса span() возвращает общий пустой спан — цена
+вызова одно чтение contextvar, поэтому инструментирование остаётся в коде
+постоянно. Сэмплированный запрос пишет сводку спанов в лог запроса (trace),
+а при заданном TRACING_EXPORT_PATH — ещё и документ в формате OTLP JSON
+(одна строка на запрос), который принимает OpenTelemetry Collector.
+"""
+from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from loguru import logger
+
+from app.config import CONFIG
+
+SERVICE_NAME = "rag-service"
+
+_SPAN_KIND_INTERNAL = 1
+_STATUS_OK = 1
+_STATUS_ERROR = 2
+
+
+class Span:
+    """Интервал работы с атрибутами; закрывается выходом из with-блока."""
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "start_ns", "end_ns", "attributes", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def __enter__(self) -> "Span":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.end_ns = time.time_ns()
+        if exc is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+
+
+class _NoopSpan:
+    """Спан вне трассируемого запроса: атрибуты отбрасываются."""
+
+    __slots__ = ()
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def set_attributes(self, **attributes: Any) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("tracing_span", default=None)
+
+
+class Trace:
+    """Спаны одного запроса; сверх max_spans спаны не сохраняются, а считаются в dropped."""
+
+    def __init__(self, max_spans: int = 256):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.max_spans = max_spans
+        self.spans: List[Span] = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def start_span(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]) -> Optional[Span]:
+        with self._lock:
+            if len(self.spans) >= self.max_spans:
+                self.dropped += 1
+                return None
+            span = Span(self, name, parent_id, attributes)
+            self.spans.append(span)
+        return span
+
+    def summary(self) -> Dict[str, Any]:
+        """Компактное дерево спанов для лога запроса (мс от начала трассы)."""
+        origin = min((span.start_ns for span in self.spans), default=0)
+        summary: Dict[str, Any] = {
+            "trace_id": self.trace_id,
+            "spans": [
+                {
+                    "name": span.name,
+                    "span_id": span.span_id,
+                    "parent_id": span.parent_id,
+                    "start_ms": round((span.start_ns - origin) / 1e6, 2),
+                    "duration_ms": round(span.duration_ms, 2),
+                    **({"attributes": dict(span.attributes)} if span.attributes else {}),
+                    **({"error": span.error} if span.error else {}),
+                }
+                for span in self.spans
+            ],
+        }
+        if self.dropped:
+            summary["dropped_spans"] = self.dropped
+        return summary
+
+    def to_otlp(self) -> Dict[str, Any]:
+        """Трасса в формате OTLP JSON (ExportTraceServiceRequest)."""
+        now = time.time_ns()
+        spans = []
+        for span in self.spans:
+            otlp_span: Dict[str, Any] = {
+                "traceId": self.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": _SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": str(span.start_ns),
+                "endTimeUnixNano": str(span.end_ns or now),
+                "attributes": [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+                "status": (
+                    {"code": _STATUS_ERROR, "message": span.error} if span.error else {"code": _STATUS_OK}
+                ),
+            }
+            if span.parent_id:
+                otlp_span["parentSpanId"] = span.parent_id
+            spans.append(otlp_span)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [_otlp_attribute("service.name", SERVICE_NAME)]},
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+            }]
+        }
+
+
+def _otlp_attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        typed: Dict[str, Any] = {"boolValue": value}
+    elif isinstance(value, int):
+        # int64 в OTLP JSON передаётся строкой
+        typed = {"intValue": str(value)}
+    elif isinstance(value, float):
+        typed = {"doubleValue": value}
+    else:
+        typed = {"stringValue": str(value)}
+    return {"key": key, "value": typed}
+
+
+def current_trace() -> Optional[Trace]:
+    """Трасса текущего запроса или None (запрос не попал в выборку)."""
+    span = _current_span.get()
+    return span.trace if span is not None else None
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Union[Span, _NoopSpan]]:
+    """Дочерний спан текущего; вне трассируемого запроса — NOOP_SPAN."""
+    parent = _current_span.get()
+    if parent is None:
+        yield NOOP_SPAN
+        return
+    child = parent.trace.start_span(name, parent.span_id, attributes)
+    if child is None:
+        yield NOOP_SPAN
+        return
+    token = _current_span.set(child)
+    try:
+        with child:
+            yield child
+    finally:
+        _current_span.reset(token)
+
+
+@contextmanager
+def trace_scope(name: str, **attributes: Any) -> Iterator[Optional[Trace]]:
+    """
+    Корневой спан запроса. Запрос трассируется с вероятностью
+    TRACING_SAMPLE_RATE; иначе (и внутри уже идущей трассы) блок выполняется
+    без новой трассы, а current_trace() не меняется.
+    """
+    sample_rate = float(getattr(CONFIG, "tracing_sample_rate", 0.1))
+    if _current_span.get() is not None or sample_rate <= 0 or random.random() >= sample_rate:
+        yield None
+        return
+    trace = Trace(max_spans=max(1, int(getattr(CONFIG, "tracing_max_spans", 256))))
+    root = trace.start_span(name, None, attributes)
+    token = _current_span.set(root)
+    try:
+        with root:
+            yield trace
+    finally:
+        _current_span.reset(token)
+        export_trace(trace)
+
+
+_export_lock = threading.Lock()
+
+
+def export_trace(trace: Trace) -> None:
+    """Дописывает трассу в TRACING_EXPORT_PATH (OTLP JSON, строка на запрос); без пути — ничего."""
+    path = getattr(CONFIG, "tracing_export_path", "")
+    if not path:
+        return
+    try:
+        line = json.dumps(trace.to_otlp(), ensure_ascii=False)
+        target = Path(path)
+        with _export_lock:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            with target.open("a", encoding="utf-8") as fh:
+                fh.write(line + "\n")
+    except Exception as exc:  # pragma: no cover - экспорт не должен ломать запрос
+        logger.warning(f"Tracing: failed to export trace {trace.trace_id}: {exc}")
@@ -0,0 +1,305 @@
+"""
+Асинхронный пайплайн запроса для ASGI-сервера.
+
+Этапы те же, что у handle_query, но ожидание Qdrant и LLM-провайдеров не
+занимает поток: поиск идёт через AsyncQdrantClient, генерация — через
+generate_answer_async. CPU-этапы (обработка запроса, эмбеддинги, роутинг,
+rerank, оптимизация контекста) выполняются в ограниченном пуле потоков,
+чтобы не блокировать event loop и не плодить потоки сверх числа ядер.
+Графы этапов retrieval выполняются через StageGraph.run_async: в пул уходят
+сами этапы, и поток пула не ждёт другой пул, пока граф доработает.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.config import CONFIG
+from app.infrastructure import get_metrics_collector
+from app.infrastructure.admission import register_queue_probe
+from app.infrastructure.deadline import Deadline, deadline_scope
+from app.infrastructure.metrics import single_flight_calls_total
+from app.infrastructure.tracing import span, trace_scope
+from app.orchestration.orchestrator import (
+    NoResultsError,
+    _add_context_stages,
+    _add_preparation_stages,
+    _admission_degradations,
+    _answer_cache_status,
+    _coalescing_key,
+    _complete_coalesced_query,
+    _complete_query,
+    _handle_unexpected_error,
+    _init_query_log,
+    _init_timings,
+    _llm_failed,
+    _log_candidates,
+    _record_pipeline,
+    _record_search,
+    _search_failed,
+    _search_kwargs,
+    _snapshot_outcome,
+    _stage_error_response,
+)
+from app.orchestration.stage_graph import StageFailed, StageGraph
+from app.retrieval.retrieval import hybrid_search_async
+from app.services.core.answer_cache import build_answer_cache_key, get_cached_answer, store_answer
+from app.services.core.llm_router import generate_answer_async
+
+_cpu_executor: Optional[ThreadPoolExecutor] = None
+_cpu_executor_lock = threading.Lock()
+
+# Объединение одинаковых запросов в пределах event loop (аналог SingleFlight)
+_in_flight: Dict[Any, asyncio.Task] = {}
+
+
+def get_cpu_executor() -> ThreadPoolExecutor:
+    """Пул потоков для CPU-этапов пайплайна (размер: async_cpu_workers или число ядер)."""
+    global _cpu_executor
+    if _cpu_executor is None:
+        with _cpu_executor_lock:
+            if _cpu_executor is None:
+                workers = int(getattr(CONFIG, "async_cpu_workers", 0)) or (os.cpu_count() or 4)
+                _cpu_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-cpu")
+                register_queue_probe("async_cpu", _cpu_executor._work_queue.qsize)
+    return _cpu_executor
+
+
+def shutdown_cpu_executor() -> None:
+    global _cpu_executor
+    with _cpu_executor_lock:
+        executor, _cpu_executor = _cpu_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False)
+
+
+async def _run_cpu(fn, *args):
+    return await _in_cpu_pool(_cpu_stage, fn, *args)
+
+
+async def _in_cpu_pool(fn, *args):
+    # Как asyncio.to_thread: функция видит contextvars задачи (дедлайн запроса, спан трассировки)
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(get_cpu_executor(), context.run, fn, *args)
+
+
+def _cpu_stage(fn, *args):
+    with span(f"cpu.{fn.__name__.lstrip('_')}"):
+        return fn(*args)
+
+
+async def handle_query_async(channel: str, chat_id: str, message: str) -> Dict[str, Any]:
+    """
+    Асинхронный вариант handle_query: та же структура ответа, те же ошибки и лог.
+    """
+    with deadline_scope(getattr(CONFIG, "request_deadline_s", 0.0), forced=_admission_degradations()) as deadline:
+        with trace_scope("chat.query", channel=channel, pipeline="async"):
+            return await _handle_query_async(channel, chat_id, message, deadline)
+
+
+async def _handle_query_async(channel: str, chat_id: str, message: str, deadline: Optional[Deadline]) -> Dict[str, Any]:
+    start = time.time()
+    logger.info(f"Processing query (async): {message[:100]}...")
+
+    metrics = get_metrics_collector()
+    log_data = _init_query_log(channel, chat_id, message, deadline)
+    timings = _init_timings()
+
+    try:
+        if getattr(CONFIG, "query_coalescing_enabled", False):
+            outcome, shared = await _coalesce(
+                _coalescing_key(message, deadline),
+                lambda: _answer_query_async(channel, chat_id, message, log_data, timings, metrics, start),
+                timeout=float(getattr(CONFIG, "query_coalescing_wait_s", 60.0)),
+            )
+            if shared:
+                return await _run_cpu(
+                    _complete_coalesced_query, channel, chat_id, outcome, log_data, timings, metrics, start
+                )
+        else:
+            outcome = await _answer_query_async(channel, chat_id, message, log_data, timings, metrics, start)
+
+        if outcome["error_response"] is not None:
+            return outcome["error_response"]
+        return await _run_cpu(
+            _complete_query,
+            channel, chat_id, outcome["retrieval"], outcome["answer_payload"], log_data, timings, metrics, start,
+        )
+
+    except Exception as e:
+        return _handle_unexpected_error(e, channel, chat_id, log_data, timings, metrics, start)
+
+
+async def _coalesce(key: Any, factory, timeout: float) -> Tuple[Any, bool]:
+    """
+    Первый запрос с ключом выполняет factory(), одновременные дубликаты ждут
+    его результата (не дольше timeout, затем выполняют запрос сами).
+    """
+    task = _in_flight.get(key)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        try:
+            # shield: отмена ведомого (клиент отключился) не отменяет запрос лидера
+            result = await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            single_flight_calls_total.labels(name="chat_query", role="timeout").inc()
+            return await factory(), False
+        single_flight_calls_total.labels(name="chat_query", role="follower").inc()
+        return result, True
+
+    single_flight_calls_total.labels(name="chat_query", role="leader").inc()
+    task = asyncio.ensure_future(factory())
+    _in_flight[key] = task
+    try:
+        return await asyncio.shield(task), False
+    finally:
+        if _in_flight.get(key) is task:
+            del _in_flight[key]
+
+
+async def _answer_query_async(
+    channel: str,
+    chat_id: str,
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    """Асинхронный _answer_query: retrieval и генерация ответа."""
+    outcome: Dict[str, Any] = {"retrieval": None, "answer_payload": None, "error_response": None}
+    retrieval, error_response = await _run_retrieval_async(channel, chat_id, message, log_data, timings, metrics, start)
+    if error_response is not None:
+        outcome["error_response"] = error_response
+        return _snapshot_outcome(outcome, log_data, timings)
+
+    answer_key = build_answer_cache_key(retrieval)
+    # Кэш может быть в Redis — синхронный клиент не должен блокировать event loop
+    cached_answer = await _run_cpu(get_cached_answer, answer_key)
+    log_data["answer_cache"] = _answer_cache_status(answer_key, cached_answer)
+    if cached_answer is not None:
+        logger.info("Answer served from cache")
+        outcome["retrieval"] = retrieval
+        outcome["answer_payload"] = cached_answer
+        return _snapshot_outcome(outcome, log_data, timings)
+
+    llm_start = time.time()
+    try:
+        answer_payload = await generate_answer_async(
+            retrieval["normalized"], retrieval["optimized_docs"], policy=retrieval["policy"]
+        )
+    except Exception as e:
+        outcome["error_response"] = _llm_failed(e, llm_start, channel, chat_id, log_data, timings, metrics, start)
+        return _snapshot_outcome(outcome, log_data, timings)
+
+    llm_duration = time.time() - llm_start
+    logger.info(f"LLM generation in {llm_duration:.2f}s")
+    await _run_cpu(store_answer, answer_key, answer_payload)
+    metrics.record_llm_duration("default", llm_duration)
+    metrics.record_query_duration("llm_generation", llm_duration)
+    timings["llm_generation"] = llm_duration
+
+    outcome["retrieval"] = retrieval
+    outcome["answer_payload"] = answer_payload
+    return _snapshot_outcome(outcome, log_data, timings)
+
+
+async def _run_retrieval_async(
+    channel: str,
+    chat_id: str,
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    state, error_response = await _prepare_retrieval_async(channel, chat_id, message, log_data, timings, metrics, start)
+    if error_response is not None:
+        return None, error_response
+    try:
+        candidates = await _search_candidates_async(state, log_data, timings, metrics)
+    except Exception as e:
+        return None, _search_failed(e, channel, chat_id, log_data, timings, metrics, start)
+    return await _finish_retrieval_async(channel, chat_id, state, candidates, log_data, timings, metrics, start)
+
+
+async def _prepare_retrieval_async(
+    channel: str,
+    chat_id: str,
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Асинхронный _prepare_retrieval: обработка запроса, эмбеддинги и роутинг — отдельными задачами пула."""
+    graph = StageGraph("retrieval_prepare")
+    _add_preparation_stages(graph, message, log_data, timings, metrics)
+    results, failure = await _run_graph_async(graph, log_data)
+    if failure is not None:
+        return None, await _run_cpu(_stage_error_response, failure, channel, chat_id, log_data, timings, metrics, start)
+    return results["state"], None
+
+
+async def _finish_retrieval_async(
+    channel: str,
+    chat_id: str,
+    state: Dict[str, Any],
+    candidates: List[Dict[str, Any]],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Асинхронный _finish_retrieval: rerank, prefetch чанков и оптимизация контекста — отдельными задачами пула."""
+    try:
+        _log_candidates(candidates, log_data)
+    except NoResultsError as e:
+        failure = StageFailed("search", e)
+        return None, await _run_cpu(_stage_error_response, failure, channel, chat_id, log_data, timings, metrics, start)
+    graph = StageGraph("retrieval_finish")
+    _add_context_stages(graph, log_data, timings, metrics)
+    results, failure = await _run_graph_async(graph, log_data, {"state": state, "search": candidates})
+    if failure is not None:
+        return None, await _run_cpu(_stage_error_response, failure, channel, chat_id, log_data, timings, metrics, start)
+    return results["context"], None
+
+
+async def _run_graph_async(
+    graph: StageGraph,
+    log_data: Dict[str, Any],
+    initial: Optional[Dict[str, Any]] = None,
+) -> Tuple[Dict[str, Any], Optional[StageFailed]]:
+    """Граф этапов в CPU-пуле; интервалы этапов попадают в лог до того, как ответ об ошибке его запишет."""
+    try:
+        return await graph.run_async(_in_cpu_pool, initial), None
+    except StageFailed as failure:
+        return {}, failure
+    finally:
+        _record_pipeline(graph, log_data)
+
+
+async def _search_candidates_async(
+    state: Dict[str, Any],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> List[Dict[str, Any]]:
+    """Асинхронный аналог этапа search (с тем же fallback без фильтра по теме)."""
+    search_start = time.time()
+    candidates = await hybrid_search_async(**_search_kwargs(state, state["theme_filter"]))
+    _record_search("search", time.time() - search_start, candidates, state, log_data, timings, metrics)
+
+    if not candidates and state["theme_filter"] is not None:
+        logger.warning("No candidates found with theme filter, trying without filter")
+        search_start = time.time()
+        candidates = await hybrid_search_async(**_search_kwargs(state, None))
+        _record_search("search_no_filter", time.time() - search_start, candidates, state, log_data, timings, metrics)
+    return candidates
+
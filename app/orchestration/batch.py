@@ -0,0 +1,321 @@
+"""
+Пакетная обработка вопросов (/v1/chat/batch): регрессионные наборы,
+обновление FAQ и т.п.
+
+Вопросы обрабатываются порциями по chat_batch_chunk_size: эмбеддинги всей
+порции считаются одним батчем модели, поиск уходит в Qdrant одним
+search_batch, а пары для reranker всех вопросов упаковываются в общие
+батчи. Генерация ответов идёт в пуле из chat_batch_llm_concurrency потоков
+параллельно с retrieval следующей порции; результаты отдаются по мере
+готовности (в порядке завершения, с индексом вопроса).
+
+Для каждого вопроса пишется обычный лог запроса и метрики, а ответы и
+ошибки имеют тот же формат, что у handle_query.
+"""
+from __future__ import annotations
+
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+from loguru import logger
+
+from app.config import CONFIG
+from app.infrastructure import get_metrics_collector
+from app.infrastructure.circuit_breaker import embedding_circuit_breaker
+from app.orchestration.orchestrator import (
+    NoResultsError,
+    _boost_candidates,
+    _complete_query,
+    _context_stage,
+    _fuse,
+    _generate_answer,
+    _handle_unexpected_error,
+    _init_query_log,
+    _init_timings,
+    _lexical_to_sparse,
+    _log_candidates,
+    _log_reranked,
+    _query_processing_stage,
+    _record_search,
+    _routing_stage,
+    _search_failed,
+    _stage_error_response,
+)
+from app.orchestration.stage_graph import StageFailed
+from app.retrieval.rerank import rerank_many
+from app.retrieval.retrieval import hybrid_search_raw_batch
+from app.services.core.embeddings import embed_batch_optimized, embed_sparse_optimized
+
+
+@dataclass
+class _BatchItem:
+    index: int
+    message: str
+    channel: str
+    chat_id: str
+    start: float = field(default_factory=time.time)
+    log_data: Dict[str, Any] = field(default_factory=dict)
+    timings: Dict[str, Optional[float]] = field(default_factory=_init_timings)
+    state: Dict[str, Any] = field(default_factory=dict)
+    candidates: List[Dict[str, Any]] = field(default_factory=list)
+    retrieval: Optional[Dict[str, Any]] = None
+    response: Optional[Dict[str, Any]] = None
+
+
+def handle_batch(
+    channel: str,
+    chat_id: str,
+    messages: Sequence[str],
+    llm_concurrency: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Отвечает на список вопросов.
+
+    Args:
+        channel: Канал связи
+        chat_id: ID чата (общий для всех вопросов пакета)
+        messages: Тексты вопросов (уже провалидированные)
+        llm_concurrency: Одновременные вызовы LLM (по умолчанию chat_batch_llm_concurrency)
+        chunk_size: Размер порции retrieval (по умолчанию chat_batch_chunk_size)
+
+    Yields:
+        {"index": номер вопроса, **ответ или ошибка в формате handle_query}
+        по мере готовности
+    """
+    concurrency = max(1, int(llm_concurrency or getattr(CONFIG, "chat_batch_llm_concurrency", 4)))
+    chunk = max(1, int(chunk_size or getattr(CONFIG, "chat_batch_chunk_size", 32)))
+    metrics = get_metrics_collector()
+    batch_start = time.time()
+    logger.info(f"Processing batch of {len(messages)} queries (chunk={chunk}, llm_concurrency={concurrency})")
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="rag-batch-llm")
+    pending: Set[Future] = set()
+    try:
+        for offset in range(0, len(messages), chunk):
+            items = [
+                _new_item(offset + i, message, channel, chat_id)
+                for i, message in enumerate(messages[offset:offset + chunk])
+            ]
+            _retrieve_chunk(items, metrics)
+            for item in items:
+                if item.response is not None:
+                    yield _result(item)
+                else:
+                    pending.add(executor.submit(_answer_item, item, metrics))
+            # Готовые ответы отдаём, не дожидаясь retrieval следующей порции
+            done = {future for future in pending if future.done()}
+            pending -= done
+            for future in done:
+                yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        # Клиент отключился или пакет завершён: не начатые вызовы LLM не нужны
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.info(f"Batch of {len(messages)} queries processed in {time.time() - batch_start:.2f}s")
+
+
+def _new_item(index: int, message: str, channel: str, chat_id: str) -> _BatchItem:
+    item = _BatchItem(index=index, message=message, channel=channel, chat_id=chat_id)
+    item.log_data = _init_query_log(channel, chat_id, message)
+    item.log_data["batch_index"] = index
+    return item
+
+
+def _result(item: _BatchItem) -> Dict[str, Any]:
+    return {"index": item.index, **(item.response or {})}
+
+
+def _fail(item: _BatchItem, stage: str, error: Exception, metrics: Any) -> None:
+    item.response = _stage_error_response(
+        StageFailed(stage, error), item.channel, item.chat_id, item.log_data, item.timings, metrics, item.start
+    )
+
+
+def _live(items: List[_BatchItem]) -> List[_BatchItem]:
+    return [item for item in items if item.response is None]
+
+
+def _retrieve_chunk(items: List[_BatchItem], metrics: Any) -> None:
+    """Retrieval порции; у каждого вопроса заполняется retrieval или response (ошибка)."""
+    try:
+        _prepare(items, metrics)
+        _search(items, metrics)
+        _rerank_and_pack(items, metrics)
+    except Exception as e:
+        for item in _live(items):
+            item.response = _handle_unexpected_error(
+                e, item.channel, item.chat_id, item.log_data, item.timings, metrics, item.start
+            )
+
+
+def _prepare(items: List[_BatchItem], metrics: Any) -> None:
+    """Обработка запросов, эмбеддинги одним батчем и тематический роутинг."""
+    for item in items:
+        try:
+            item.state = _query_processing_stage(item.message, item.log_data, item.timings, metrics)
+        except Exception as e:
+            _fail(item, "query_processing", e, metrics)
+
+    live = _live(items)
+    if not live:
+        return
+    try:
+        vectors, embedding_duration = embedding_circuit_breaker.call(
+            _compute_batch_embeddings, [item.state["normalized"] for item in live], metrics
+        )
+    except Exception as e:
+        for item in live:
+            _fail(item, "embeddings", e, metrics)
+        return
+
+    vector_routing = CONFIG.theme_router_mode == "vector"
+    for item, (q_dense, q_sparse) in zip(live, vectors):
+        metrics.record_query_duration("embeddings", embedding_duration)
+        item.timings["embeddings"] = embedding_duration
+        try:
+            routing = _routing_stage(
+                item.state["normalized"], q_dense if vector_routing else None, item.log_data, item.timings, metrics
+            )
+        except Exception as e:
+            item.response = _handle_unexpected_error(
+                e, item.channel, item.chat_id, item.log_data, item.timings, metrics, item.start
+            )
+            continue
+        item.state.update({"q_dense": q_dense, "q_sparse": q_sparse, **routing})
+
+
+def _compute_batch_embeddings(texts: List[str], metrics: Any) -> Tuple[List[Tuple[List[float], Dict[str, Any]]], float]:
+    """
+    Dense и sparse эмбеддинги всех вопросов порции одним батчем модели.
+
+    Returns:
+        ([(q_dense, q_sparse), ...], embedding_duration)
+    """
+    embedding_start = time.time()
+    from app.services.core.embeddings import _get_optimal_backend_strategy
+    optimal_backend = _get_optimal_backend_strategy()
+
+    result = embed_batch_optimized(
+        texts,
+        max_length=CONFIG.embedding_max_length_query,
+        return_dense=True,
+        return_sparse=CONFIG.use_sparse,
+        context="query",
+    )
+    dense_vecs = result.get("dense_vecs") or [[] for _ in texts]
+    if not CONFIG.use_sparse:
+        sparse_vecs = [{"indices": [], "values": []} for _ in texts]
+    elif optimal_backend in ["bge", "hybrid"]:
+        lexical = result.get("lexical_weights") or [{} for _ in texts]
+        sparse_vecs = [_lexical_to_sparse(weights) for weights in lexical]
+    else:
+        # ONNX не считает sparse-веса в батче: как и для одиночного запроса, считаем их отдельно
+        sparse_vecs = [embed_sparse_optimized(text, max_length=CONFIG.embedding_max_length_query) for text in texts]
+
+    embedding_duration = time.time() - embedding_start
+    logger.info(f"Batch embeddings for {len(texts)} queries in {embedding_duration:.2f}s")
+    metrics.record_embedding_duration("batch", embedding_duration)
+    return list(zip(dense_vecs, sparse_vecs)), embedding_duration
+
+
+def _search(items: List[_BatchItem], metrics: Any) -> None:
+    """Поиск с фильтром по теме одним search_batch и общий fallback без фильтра."""
+    live = _live(items)
+    if not live:
+        return
+    found = _search_batch(live, "search", lambda item: item.state["theme_filter"], metrics)
+
+    # Fallback: если поиск с фильтром не дал результатов, пробуем без фильтра
+    retry = [item for item in found if not item.candidates and item.state["theme_filter"] is not None]
+    if retry:
+        logger.warning(f"No candidates found with theme filter for {len(retry)} batch queries, trying without filter")
+        _search_batch(retry, "search_no_filter", lambda item: None, metrics)
+
+    for item in found:
+        if item.response is not None:
+            continue
+        try:
+            _log_candidates(item.candidates, item.log_data)
+        except NoResultsError as e:
+            _fail(item, "search", e, metrics)
+
+
+def _search_batch(items: List[_BatchItem], stage: str, filter_for: Any, metrics: Any) -> List[_BatchItem]:
+    search_start = time.time()
+    try:
+        raws = hybrid_search_raw_batch([
+            (item.state["q_dense"], item.state["q_sparse"], item.state["strategy_k"], filter_for(item))
+            for item in items
+        ])
+    except Exception as e:
+        for item in items:
+            item.response = _search_failed(
+                e, item.channel, item.chat_id, item.log_data, item.timings, metrics, item.start
+            )
+        return []
+    duration = time.time() - search_start
+    for item, raw in zip(items, raws):
+        item.candidates = _fuse(item.state, raw)
+        _record_search(stage, duration, item.candidates, item.state, item.log_data, item.timings, metrics)
+    return items
+
+
+def _rerank_and_pack(items: List[_BatchItem], metrics: Any) -> None:
+    """Тематический буст, rerank всех вопросов в общих батчах, auto-merge и оптимизация контекста."""
+    live = _live(items)
+    if not live:
+        return
+    for item in live:
+        item.candidates = _boost_candidates(item.state, item.candidates, item.log_data)
+
+    rerank_start = time.time()
+    try:
+        # Усечение текста до 384 симв., top_n из стратегии каждого вопроса
+        reranked = rerank_many(
+            [(item.state["normalized"], item.candidates, item.state["strategy_rerank_top_n"]) for item in live],
+            max_length=384,
+        )
+        logger.info(f"Batch rerank for {len(live)} queries in {time.time() - rerank_start:.2f}s")
+    except Exception as e:
+        logger.warning(f"Batch reranking failed after {time.time() - rerank_start:.2f}s: {e}, using original candidates")
+        reranked = [item.candidates[:item.state["strategy_rerank_top_n"]] for item in live]
+    rerank_duration = time.time() - rerank_start
+
+    for item, top_docs in zip(live, reranked):
+        metrics.record_query_duration("rerank", rerank_duration)
+        item.timings["rerank"] = rerank_duration
+        _log_reranked(top_docs, item.log_data)
+        item.retrieval = _context_stage(
+            item.state,
+            {"candidates": item.candidates, "top_docs": top_docs},
+            item.log_data,
+            item.timings,
+            metrics,
+        )
+
+
+def _answer_item(item: _BatchItem, metrics: Any) -> Dict[str, Any]:
+    """Генерация ответа (или ответ из кэша) и завершение запроса — в пуле LLM."""
+    try:
+        answer_payload, error_response = _generate_answer(
+            item.retrieval, item.channel, item.chat_id, item.log_data, item.timings, metrics, item.start
+        )
+        if error_response is not None:
+            item.response = error_response
+        else:
+            item.response = _complete_query(
+                item.channel, item.chat_id, item.retrieval, answer_payload,
+                item.log_data, item.timings, metrics, item.start,
+            )
+    except Exception as e:
+        item.response = _handle_unexpected_error(
+            e, item.channel, item.chat_id, item.log_data, item.timings, metrics, item.start
+        )
+    return _result(item)
@@ -1,21 +1,30 @@
 ﻿from __future__ import annotations
 import time
-import asyncio
+from copy import deepcopy
 from datetime import datetime, timezone
 from loguru import logger
 
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from qdrant_client.models import Filter, FieldCondition, MatchValue
-from app.services.core.query_processing import process_query
+from app.services.core.query_processing import get_degraded_strategy, process_query
 from app.services.core.embeddings import embed_unified, embed_dense_optimized, embed_sparse_optimized, embed_dense
 from app.config import CONFIG
-from app.retrieval.retrieval import hybrid_search, auto_merge_neighbors
+from app.retrieval.retrieval import auto_merge_neighbors, fuse_hybrid_results, hybrid_search_raw, prefetch_doc_chunks
 from app.retrieval.rerank import rerank
-from app.services.core.llm_router import generate_answer
+from app.services.core.llm_router import generate_answer, stream_answer
+from app.services.core.answer_cache import build_answer_cache_key, get_cached_answer, store_answer
 from app.services.core.context_optimizer import context_optimizer
 from app.infrastructure import get_metrics_collector
+from app.infrastructure.caching import get_collection_generation
+from app.infrastructure.circuit_breaker import embedding_circuit_breaker
+from app.infrastructure.admission import DEGRADED_ADMISSION_STEPS, admission_degraded
+from app.infrastructure.deadline import Deadline, deadline_scope, should_degrade
+from app.infrastructure.single_flight import SingleFlight
+from app.infrastructure.tracing import current_trace, trace_scope
+from app.orchestration.stage_graph import StageFailed, StageGraph
 from app.infrastructure.query_logging import log_query_interaction
 from app.services.quality.quality_manager import quality_manager
+from app.services.quality.task_queue import QualityInteraction, get_quality_task_queue
 from app.retrieval import route_query
 from app.retrieval.theme_router import get_theme, infer_theme_label, infer_theme_id
 
@@ -55,12 +64,322 @@ def handle_query(channel: str, chat_id: str, message: str) -> dict[str, Any]:
     Raises:
         RAGError: При критических ошибках системы
     """
+    # Общий бюджет времени запроса: этапы деградируют при его нехватке (см. app.infrastructure.deadline)
+    with deadline_scope(getattr(CONFIG, "request_deadline_s", 0.0), forced=_admission_degradations()) as deadline:
+        # Сэмплированные запросы получают дерево спанов в логе (trace), см. app.infrastructure.tracing
+        with trace_scope("chat.query", channel=channel):
+            return _handle_query(channel, chat_id, message, deadline)
+
+
+def _admission_degradations() -> Tuple[str, ...]:
+    """Шаги, удешевляющие запрос, принятый admission control в режиме degrade."""
+    return DEGRADED_ADMISSION_STEPS if admission_degraded() else ()
+
+
+def _handle_query(channel: str, chat_id: str, message: str, deadline: Optional[Deadline]) -> dict[str, Any]:
     start = time.time()
     logger.info(f"Processing query: {message[:100]}...")
 
+    metrics = get_metrics_collector()
+    log_data = _init_query_log(channel, chat_id, message, deadline)
+    timings = _init_timings()
+
+    try:
+        if getattr(CONFIG, "query_coalescing_enabled", False):
+            # Одинаковые одновременные запросы (например, после рассылки) делят
+            # одно выполнение пайплайна; каждый получает свой interaction_id и лог
+            outcome, shared = _query_flight.do(
+                _coalescing_key(message, deadline),
+                lambda: _answer_query(channel, chat_id, message, log_data, timings, metrics, start),
+                timeout=float(getattr(CONFIG, "query_coalescing_wait_s", 60.0)),
+            )
+            if shared:
+                return _complete_coalesced_query(channel, chat_id, outcome, log_data, timings, metrics, start)
+        else:
+            outcome = _answer_query(channel, chat_id, message, log_data, timings, metrics, start)
+
+        if outcome["error_response"] is not None:
+            return outcome["error_response"]
+        return _complete_query(
+            channel, chat_id, outcome["retrieval"], outcome["answer_payload"], log_data, timings, metrics, start
+        )
+
+    except Exception as e:
+        return _handle_unexpected_error(e, channel, chat_id, log_data, timings, metrics, start)
+
+
+_query_flight = SingleFlight("chat_query")
+
+# Разделы лога, которые ведомый запрос копирует у лидера
+_SHARED_LOG_SECTIONS = (
+    "request", "routing", "search", "context", "pipeline", "degradations", "answer_cache", "status", "error_type",
+)
+
+
+def _answer_cache_status(answer_key: Optional[str], cached_answer: Optional[Dict[str, Any]]) -> str:
+    if answer_key is None:
+        return "bypass"
+    return "hit" if cached_answer is not None else "miss"
+
+
+def _coalescing_key(message: str, deadline: Optional[Deadline] = None) -> Tuple[Any, ...]:
+    """
+    Ключ объединения запросов: нормализованный текст, параметры, от которых
+    зависит ответ (но не канал), поколение коллекции и принудительные шаги
+    деградации (admission control) — запрос полного пайплайна не должен
+    получить удешевлённый ответ и наоборот.
+    """
+    return (
+        " ".join(message.lower().split()),
+        CONFIG.theme_router_mode,
+        CONFIG.default_llm,
+        get_collection_generation(),
+        tuple(sorted(deadline.forced)) if deadline is not None else (),
+    )
+
+
+def _answer_query(
+    channel: str,
+    chat_id: str,
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    """
+    Retrieval и генерация ответа (общая часть для объединённых запросов).
+
+    Returns:
+        {"retrieval", "answer_payload", "error_response", "log", "timings"} —
+        снимок лога и таймингов нужен ведомым запросам, так как лидер
+        продолжает дописывать свой лог параллельно с ними.
+    """
+    outcome: Dict[str, Any] = {"retrieval": None, "answer_payload": None, "error_response": None}
+    retrieval, error_response = _run_retrieval(channel, chat_id, message, log_data, timings, metrics, start)
+    if error_response is not None:
+        outcome["error_response"] = error_response
+        return _snapshot_outcome(outcome, log_data, timings)
+
+    answer_payload, error_response = _generate_answer(retrieval, channel, chat_id, log_data, timings, metrics, start)
+    if error_response is not None:
+        outcome["error_response"] = error_response
+        return _snapshot_outcome(outcome, log_data, timings)
+
+    outcome["retrieval"] = retrieval
+    outcome["answer_payload"] = answer_payload
+    return _snapshot_outcome(outcome, log_data, timings)
+
+
+def _generate_answer(
+    retrieval: Dict[str, Any],
+    channel: str,
+    chat_id: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    7. LLM Generation (или готовый ответ из кэша для того же запроса и контекста).
+
+    Returns:
+        (answer_payload, None) или (None, error_response) с уже записанным логом
+    """
+    answer_key = build_answer_cache_key(retrieval)
+    cached_answer = get_cached_answer(answer_key)
+    log_data["answer_cache"] = _answer_cache_status(answer_key, cached_answer)
+    if cached_answer is not None:
+        logger.info("Answer served from cache")
+        return cached_answer, None
+
+    try:
+        llm_start = time.time()
+        answer_payload = generate_answer(retrieval["normalized"], retrieval["optimized_docs"], policy=retrieval["policy"])
+        llm_duration = time.time() - llm_start
+        logger.info(f"LLM generation in {llm_duration:.2f}s")
+        store_answer(answer_key, answer_payload)
+        metrics.record_llm_duration("default", llm_duration)
+        metrics.record_query_duration("llm_generation", llm_duration)
+        timings["llm_generation"] = llm_duration
+    except Exception as e:
+        return None, _llm_failed(e, llm_start, channel, chat_id, log_data, timings, metrics, start)
+    return answer_payload, None
+
+
+def _llm_failed(
+    e: Exception,
+    llm_start: float,
+    channel: str,
+    chat_id: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    logger.error(f"LLM generation failed: {e}")
+    metrics.record_error("llm_failed", "llm_generation")
+    llm_duration = time.time() - llm_start
+    metrics.record_query_duration("llm_generation", llm_duration)
+    timings["llm_generation"] = llm_duration
+    log_data["status"] = "error"
+    log_data["error_type"] = "llm_failed"
+    timings["total"] = time.time() - start
+    _finalize_query_log(log_data, timings)
+    return {
+        "error": "llm_failed",
+        "message": "Сервис генерации ответов временно недоступен. Попробуйте позже.",
+        "sources": [],
+        "channel": channel,
+        "chat_id": chat_id
+    }
+
+
+def _snapshot_outcome(
+    outcome: Dict[str, Any],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+) -> Dict[str, Any]:
+    outcome["log"] = deepcopy({key: log_data.get(key) for key in _SHARED_LOG_SECTIONS})
+    outcome["timings"] = dict(timings)
+    return outcome
+
+
+def _complete_coalesced_query(
+    channel: str,
+    chat_id: str,
+    outcome: Dict[str, Any],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    """Завершает запрос, получивший результат от уже выполнявшегося одинакового запроса."""
+    logger.info(f"Query coalesced with in-flight duplicate in {time.time() - start:.2f}s")
+    log_data.update(deepcopy(outcome["log"]))
+    log_data["coalesced"] = True
+    timings.update({name: value for name, value in outcome["timings"].items() if name != "total"})
+
+    if outcome["error_response"] is not None:
+        timings["total"] = time.time() - start
+        _finalize_query_log(log_data, timings)
+        error_response = dict(outcome["error_response"])
+        error_response["channel"] = channel
+        error_response["chat_id"] = chat_id
+        return error_response
+
+    return _complete_query(
+        channel, chat_id, outcome["retrieval"], deepcopy(outcome["answer_payload"]), log_data, timings, metrics, start
+    )
+
+
+def stream_query(channel: str, chat_id: str, message: str) -> Iterator[Dict[str, Any]]:
+    """
+    Потоковый вариант handle_query для SSE.
+
+    Retrieval выполняется так же, как в handle_query, затем токены LLM
+    отдаются по мере генерации. События:
+    - {"event": "token", "data": {"text": ...}} — очередной фрагмент ответа;
+    - {"event": "done", "data": {...}} — итог в формате handle_query + timings;
+    - {"event": "error", "data": {...}} — ошибка в формате handle_query.
+    """
+    start = time.time()
+    logger.info(f"Processing streaming query: {message[:100]}...")
+
     metrics = get_metrics_collector()
     log_data = _init_query_log(channel, chat_id, message)
-    timings: Dict[str, Optional[float]] = {
+    log_data["streamed"] = True
+    timings = _init_timings()
+    timings["time_to_first_token"] = None
+
+    try:
+        # Дедлайн и трассировка охватывают retrieval; генерация отдаёт токены по мере готовности
+        with deadline_scope(getattr(CONFIG, "request_deadline_s", 0.0), forced=_admission_degradations()) as deadline:
+            if deadline is not None:
+                log_data["degradations"] = deadline.degradations
+            with trace_scope("chat.stream", channel=channel) as trace:
+                retrieval, error_response = _run_retrieval(
+                    channel, chat_id, message, log_data, timings, metrics, start
+                )
+        if trace is not None:
+            log_data["trace"] = trace.summary()
+    except Exception as e:
+        yield {"event": "error", "data": _handle_unexpected_error(e, channel, chat_id, log_data, timings, metrics, start)}
+        return
+    if error_response is not None:
+        yield {"event": "error", "data": error_response}
+        return
+
+    answer_key = build_answer_cache_key(retrieval)
+    cached_answer = get_cached_answer(answer_key)
+    log_data["answer_cache"] = _answer_cache_status(answer_key, cached_answer)
+    if cached_answer is not None:
+        # Ответ уже готов: отдаём его одним фрагментом без вызова LLM
+        logger.info("Streaming answer served from cache")
+        timings["time_to_first_token"] = time.time() - start
+        yield {"event": "token", "data": {"text": cached_answer.get("answer_markdown", "")}}
+        try:
+            result = _complete_query(channel, chat_id, retrieval, cached_answer, log_data, timings, metrics, start)
+        except Exception as e:
+            yield {"event": "error", "data": _handle_unexpected_error(e, channel, chat_id, log_data, timings, metrics, start)}
+            return
+        result["timings"] = {name: round(value, 4) for name, value in timings.items() if value is not None}
+        yield {"event": "done", "data": result}
+        return
+
+    llm_start = time.time()
+    answer_payload: Optional[Dict[str, Any]] = None
+    try:
+        for event in stream_answer(retrieval["normalized"], retrieval["optimized_docs"], policy=retrieval["policy"]):
+            if event["type"] == "delta":
+                if timings["time_to_first_token"] is None:
+                    ttft = time.time() - start
+                    timings["time_to_first_token"] = ttft
+                    metrics.record_query_duration("time_to_first_token", ttft)
+                    logger.info(f"Time to first token: {ttft:.2f}s")
+                yield {"event": "token", "data": {"text": event["text"]}}
+            elif event["type"] == "done":
+                answer_payload = event
+    except Exception as e:
+        logger.error(f"LLM streaming failed: {e}")
+        metrics.record_error("llm_failed", "llm_generation")
+        answer_payload = None
+
+    llm_duration = time.time() - llm_start
+    metrics.record_query_duration("llm_generation", llm_duration)
+    timings["llm_generation"] = llm_duration
+
+    if answer_payload is None:
+        log_data["status"] = "error"
+        log_data["error_type"] = "llm_failed"
+        timings["total"] = time.time() - start
+        _finalize_query_log(log_data, timings)
+        yield {
+            "event": "error",
+            "data": {
+                "error": "llm_failed",
+                "message": "Сервис генерации ответов временно недоступен. Попробуйте позже.",
+                "sources": [],
+                "channel": channel,
+                "chat_id": chat_id,
+            },
+        }
+        return
+
+    logger.info(f"LLM streaming generation in {llm_duration:.2f}s")
+    metrics.record_llm_duration("default", llm_duration)
+    store_answer(answer_key, answer_payload)
+    try:
+        result = _complete_query(channel, chat_id, retrieval, answer_payload, log_data, timings, metrics, start)
+    except Exception as e:
+        yield {"event": "error", "data": _handle_unexpected_error(e, channel, chat_id, log_data, timings, metrics, start)}
+        return
+    result["timings"] = {name: round(value, 4) for name, value in timings.items() if value is not None}
+    yield {"event": "done", "data": result}
+
+
+def _init_timings() -> Dict[str, Optional[float]]:
+    return {
         "total": None,
         "query_processing": None,
         "routing": None,
@@ -71,485 +390,816 @@ def handle_query(channel: str, chat_id: str, message: str) -> dict[str, Any]:
         "context_optimization": None,
         "llm_generation": None,
     }
-    max_log_candidates = CONFIG.query_log_max_candidates
-    text_prefix_len = CONFIG.query_log_text_prefix_len
 
-    error_type = None
-    status = "success"
 
-    try:
-        # 1. Query Processing (с Query Type Classification)
-        qp_start = time.time()
-        try:
-            qp = process_query(message)
-            normalized = qp["normalized_text"]
-            boosts = qp.get("boosts", {})
-            group_boosts = qp.get("group_boosts", {})
-
-            # Извлекаем стратегию retrieval на основе типа запроса
-            query_type = qp.get("query_type")
-            retrieval_strategy = qp.get("retrieval_strategy", {})
-            strategy_k = retrieval_strategy.get("k", 20)
-            strategy_rerank_top_n = retrieval_strategy.get("rerank_top_n", 6)
-            strategy_use_auto_merge = retrieval_strategy.get("use_auto_merge", True)
-
-            qp_duration = time.time() - qp_start
-            logger.info(
-                f"Query processed in {qp_duration:.2f}s, "
-                f"type={query_type.value if query_type else 'unknown'}, "
-                f"strategy: k={strategy_k}, rerank={strategy_rerank_top_n}, auto_merge={strategy_use_auto_merge}"
-            )
-            metrics.record_query_duration("query_processing", qp_duration)
-            timings["query_processing"] = qp_duration
-            log_data["request"].update({
-                "normalized": normalized,
-                "boosts": boosts,
-                "group_boosts": group_boosts,
-                "query_type": query_type.value if query_type else None,
-                "retrieval_strategy": retrieval_strategy,
-            })
-        except Exception as e:
-            logger.error(f"Query processing failed: {e}")
-            log_data["status"] = "error"
-            log_data["error_type"] = "query_processing_failed"
-            timings["total"] = time.time() - start
-            _finalize_query_log(log_data, timings)
-            return {
-                "error": "query_processing_failed",
-                "message": "Ошибка обработки запроса. Попробуйте переформулировать вопрос.",
-                "sources": [],
-                "channel": channel,
-                "chat_id": chat_id
-            }
-
-        routing_start = time.time()
-        routing_result = route_query(normalized, user_metadata=None)
-        routing_duration = time.time() - routing_start
-        logger.info(
-            f"Theme routing in {routing_duration:.2f}s "
-            f"(primary={routing_result.get('primary_theme')}, "
-            f"via_llm={routing_result.get('router', 'unknown')}, "
-            f"disambiguation={routing_result.get('requires_disambiguation')})"
+def _compute_query_embeddings(normalized: str, metrics: Any) -> Tuple[List[float], Dict[str, Any], float]:
+    """
+    Dense и sparse эмбеддинги запроса.
+
+    Returns:
+        (q_dense, q_sparse, embedding_duration)
+    """
+    embedding_start = time.time()
+
+    # Import optimal strategy detection
+    from app.services.core.embeddings import _get_optimal_backend_strategy
+    optimal_backend = _get_optimal_backend_strategy()
+
+    # Choose embedding strategy based on optimal backend
+    if optimal_backend in ["bge", "hybrid"]:
+        # Use unified BGE-M3 embedding generation
+        embedding_result = embed_unified(
+            normalized,
+            max_length=CONFIG.embedding_max_length_query,
+            return_dense=True,
+            return_sparse=CONFIG.use_sparse,
+            return_colbert=False,  # Not needed for search
+            context="query"
         )
-        metrics.record_query_duration("routing", routing_duration)
-        timings["routing"] = routing_duration
-        log_data["routing"] = _serialize_routing_result(routing_result)
-        theme_filter = _build_theme_filter(routing_result)
-        log_data["search"] = {
-            "theme_filter_applied": theme_filter is not None,
-            "theme_filter_conditions": _describe_theme_filter(theme_filter),
-            "fallback_without_filter": False,
-            "candidates_total": 0,
-            "candidates_before_theme_boost": [],
-            "candidates_after_theme_boost": [],
-            "candidates_after_rerank": [],
-        }
 
-        # 2. Unified Embeddings Generation
-        try:
-            embedding_start = time.time()
-
-            # Import optimal strategy detection
-            from app.services.core.embeddings import _get_optimal_backend_strategy
-            optimal_backend = _get_optimal_backend_strategy()
-
-            # Choose embedding strategy based on optimal backend
-            if optimal_backend in ["bge", "hybrid"]:
-                # Use unified BGE-M3 embedding generation
-                embedding_result = embed_unified(
-                    normalized,
-                    max_length=CONFIG.embedding_max_length_query,
-                    return_dense=True,
-                    return_sparse=CONFIG.use_sparse,
-                    return_colbert=False,  # Not needed for search
-                    context="query"
-                )
+        # Extract results
+        q_dense = embedding_result['dense_vecs'][0] if embedding_result.get('dense_vecs') else []
 
-                # Extract results
-                q_dense = embedding_result['dense_vecs'][0] if embedding_result.get('dense_vecs') else []
-
-                q_sparse = {"indices": [], "values": []}
-                if CONFIG.use_sparse and embedding_result.get('lexical_weights'):
-                    lex_weights = embedding_result['lexical_weights'][0]
-                    if lex_weights and isinstance(lex_weights, dict):  # Check if not empty and is dict
-                        # Convert BGE-M3 lexical_weights format to Qdrant format
-                        indices = [int(k) for k in lex_weights.keys()]  # Ensure integers
-                        values = [float(lex_weights[k]) for k in lex_weights.keys()]  # Ensure floats
-                        q_sparse = {
-                            "indices": indices,
-                            "values": values
-                        }
-
-                embedding_duration = time.time() - embedding_start
-                logger.info(f"Unified embeddings (dense+sparse) in {embedding_duration:.2f}s")
-                metrics.record_embedding_duration("unified", embedding_duration)
-
-            else:
-                # Legacy separate embedding generation (ONNX-only mode)
-                q_dense = embed_dense_optimized(normalized, max_length=CONFIG.embedding_max_length_query)
-                embedding_duration_dense = time.time() - embedding_start
-                metrics.record_embedding_duration("dense", embedding_duration_dense)
-
-                if CONFIG.use_sparse:
-                    sparse_start = time.time()
-                    q_sparse = embed_sparse_optimized(normalized, max_length=CONFIG.embedding_max_length_query)
-                    sparse_duration = time.time() - sparse_start
-                    metrics.record_embedding_duration("sparse", sparse_duration)
-                else:
-                    q_sparse = {"indices": [], "values": []}
-
-                embedding_duration = time.time() - embedding_start
-                logger.info(f"Legacy embeddings in {embedding_duration:.2f}s")
+        q_sparse = {"indices": [], "values": []}
+        if CONFIG.use_sparse and embedding_result.get('lexical_weights'):
+            q_sparse = _lexical_to_sparse(embedding_result['lexical_weights'][0])
 
-        except Exception as e:
-            logger.error(f"Embedding generation failed: {e}")
-            error_type = "embedding_failed"
-            metrics.record_error("embedding_failed", "embedding_generation")
-            log_data["status"] = "error"
-            log_data["error_type"] = "embedding_failed"
-            timings["total"] = time.time() - start
-            _finalize_query_log(log_data, timings)
-            return {
-                "error": "embedding_failed",
-                "message": "Сервис эмбеддингов временно недоступен. Попробуйте позже.",
-                "sources": [],
-                "channel": channel,
-                "chat_id": chat_id
-            }
-        metrics.record_query_duration("embeddings", embedding_duration)
-        timings["embeddings"] = embedding_duration
+        embedding_duration = time.time() - embedding_start
+        logger.info(f"Unified embeddings (dense+sparse) in {embedding_duration:.2f}s")
+        metrics.record_embedding_duration("unified", embedding_duration)
 
-        # 3. Hybrid Search (с параметрами из retrieval_strategy)
-        try:
-            search_start = time.time()
-            candidates = hybrid_search(
-                q_dense,
-                q_sparse,
-                k=strategy_k,  # Адаптивный k на основе типа запроса
-                boosts=boosts,
-                group_boosts=group_boosts,
-                routing_result=routing_result,
-                metadata_filter=theme_filter,
-            )
-            search_duration = time.time() - search_start
-            logger.info(f"Hybrid search in {search_duration:.2f}s (k={strategy_k})")
-            metrics.record_search_duration("hybrid", search_duration)
-            metrics.record_query_duration("search", search_duration)
-            timings["search"] = search_duration
-
-            # Fallback: если поиск с фильтром не дал результатов, пробуем без фильтра
-            if not candidates and theme_filter is not None:
-                logger.warning("No candidates found with theme filter, trying without filter")
-                search_start = time.time()
-                candidates = hybrid_search(
-                    q_dense,
-                    q_sparse,
-                    k=strategy_k,  # Используем тот же адаптивный k
-                    boosts=boosts,
-                    group_boosts=group_boosts,
-                    routing_result=routing_result,
-                    metadata_filter=None,
-                )
-                search_duration = time.time() - search_start
-                logger.info(f"Hybrid search (without filter) in {search_duration:.2f}s")
-                metrics.record_search_duration("hybrid_no_filter", search_duration)
-                metrics.record_query_duration("search_no_filter", search_duration)
-                timings["search_no_filter"] = search_duration
-                log_data["search"]["fallback_without_filter"] = True
-                if candidates:
-                    logger.info(f"Found {len(candidates)} candidates without theme filter")
-
-            candidate_count = len(candidates) if candidates else 0
-            log_data["search"]["candidates_total"] = candidate_count
-            log_data["search"]["candidates_before_theme_boost"] = _prepare_log_candidates(
-                candidates or [],
-                max_log_candidates,
-                text_prefix_len,
-            )
+    else:
+        # Legacy separate embedding generation (ONNX-only mode)
+        q_dense = embed_dense_optimized(normalized, max_length=CONFIG.embedding_max_length_query)
+        embedding_duration_dense = time.time() - embedding_start
+        metrics.record_embedding_duration("dense", embedding_duration_dense)
 
-            if not candidates:
-                logger.warning("No candidates found in search")
-                error_type = "no_results"
-                metrics.record_error("no_results", "search")
-                log_data["status"] = "no_results"
-                log_data["error_type"] = "no_results"
-                timings["total"] = time.time() - start
-                _finalize_query_log(log_data, timings)
-                return {
-                    "error": "no_results",
-                    "message": "К сожалению, не удалось найти релевантную информацию по вашему запросу. Попробуйте переформулировать вопрос или использовать другие ключевые слова.",
-                    "answer": "К сожалению, не удалось найти релевантную информацию по вашему запросу. Попробуйте переформулировать вопрос или использовать другие ключевые слова.",
-                    "answer_markdown": "К сожалению, не удалось найти релевантную информацию по вашему запросу. Попробуйте переформулировать вопрос или использовать другие ключевые слова.",
-                    "sources": [],
-                    "channel": channel,
-                    "chat_id": chat_id
-                }
-        except Exception as e:
-            logger.error(f"Hybrid search failed: {e}")
-            error_type = "search_failed"
-            metrics.record_error("search_failed", "hybrid_search")
-            log_data["status"] = "error"
-            log_data["error_type"] = "search_failed"
-            timings["total"] = time.time() - start
-            _finalize_query_log(log_data, timings)
-            return {
-                "error": "search_failed",
-                "message": "Ошибка поиска в базе знаний. Попробуйте позже.",
-                "sources": [],
-                "channel": channel,
-                "chat_id": chat_id
-            }
-
-        candidates = _apply_theme_boost(candidates, routing_result)
-        log_data["search"]["candidates_after_theme_boost"] = _prepare_log_candidates(
-            candidates,
-            max_log_candidates,
-            text_prefix_len,
-        )
+        if CONFIG.use_sparse:
+            sparse_start = time.time()
+            q_sparse = embed_sparse_optimized(normalized, max_length=CONFIG.embedding_max_length_query)
+            sparse_duration = time.time() - sparse_start
+            metrics.record_embedding_duration("sparse", sparse_duration)
+        else:
+            q_sparse = {"indices": [], "values": []}
 
-        # 5. Reranking (с параметрами из retrieval_strategy)
-        rerank_start = time.time()
-        try:
-            # Пакетная обработка reranker: batch_size=20, усечение текста до 384 симв.
-            # top_n адаптируется на основе типа запроса
-            top_docs = rerank(normalized, candidates, top_n=strategy_rerank_top_n, batch_size=20, max_length=384)
-            rerank_duration = time.time() - rerank_start
-            logger.info(f"Rerank completed in {rerank_duration:.2f}s (top_n={strategy_rerank_top_n})")
-            metrics.record_query_duration("rerank", rerank_duration)
-            timings["rerank"] = rerank_duration
-        except Exception as e:
-            rerank_duration = time.time() - rerank_start
-            logger.warning(f"Reranking failed after {rerank_duration:.2f}s: {e}, using original candidates")
-            metrics.record_query_duration("rerank", rerank_duration)
-            timings["rerank"] = rerank_duration
-            top_docs = candidates[:strategy_rerank_top_n]  # Fallback с адаптивным top_n
-
-        log_data["search"]["candidates_after_rerank"] = _prepare_log_candidates(
-            top_docs,
-            max_log_candidates,
-            text_prefix_len,
-        )
+        embedding_duration = time.time() - embedding_start
+        logger.info(f"Legacy embeddings in {embedding_duration:.2f}s")
 
-        # 5b. Авто-слияние соседних чанков (учитываем strategy_use_auto_merge)
-        # Используем И CONFIG флаг И стратегию для максимальной гибкости
-        should_auto_merge = CONFIG.retrieval_auto_merge_enabled and strategy_use_auto_merge
-        if should_auto_merge and top_docs:
-            try:
-                max_ctx_tokens = getattr(context_optimizer, "max_context_tokens", CONFIG.retrieval_auto_merge_max_tokens)
-                reserve = getattr(context_optimizer, "reserve_for_response", 0.35)
-                available = max(1, int(max_ctx_tokens * (1 - reserve)))
-                merge_limit = min(CONFIG.retrieval_auto_merge_max_tokens, available)
-            except Exception:
-                merge_limit = CONFIG.retrieval_auto_merge_max_tokens
-
-            merged_docs = auto_merge_neighbors(top_docs, max_window_tokens=merge_limit)
-            log_data["context"]["auto_merge_before"] = len(top_docs)
-            if merged_docs != top_docs:
-                reduction = len(top_docs) - len(merged_docs)
-                efficiency = 100 * (1 - len(merged_docs) / len(top_docs)) if top_docs else 0
-                logger.debug(
-                    f"Auto-merge: {len(top_docs)} -> {len(merged_docs)} окон "
-                    f"(лимит={merge_limit} токенов, экономия={reduction} чанков, эффективность={efficiency:.1f}%)"
-                )
-                log_data["context"]["auto_merge_applied"] = True
-                log_data["context"]["auto_merge_after"] = len(merged_docs)
-            top_docs = merged_docs
-            log_data["context"].setdefault("auto_merge_after", len(top_docs))
-        else:
-            log_data["context"]["auto_merge_before"] = len(top_docs) if top_docs else 0
-            log_data["context"]["auto_merge_after"] = len(top_docs) if top_docs else 0
-            # Логируем причину пропуска auto_merge
-            if not strategy_use_auto_merge:
-                logger.debug(f"Auto-merge skipped by retrieval strategy (query_type={query_type.value if query_type else 'unknown'})")
-
-        # 6. Context Optimization - управление размером токенов для LLM
-        context_start = time.time()
-        try:
-            optimized_docs = context_optimizer.optimize_context(normalized, top_docs)
-            context_duration = time.time() - context_start
-            logger.info(f"Context optimized: {len(top_docs)} -> {len(optimized_docs)} documents in {context_duration:.2f}s")
-            metrics.record_query_duration("context_optimization", context_duration)
-            timings["context_optimization"] = context_duration
-        except Exception as e:
-            context_duration = time.time() - context_start
-            logger.warning(f"Context optimization failed after {context_duration:.2f}s: {e}, using original documents")
-            metrics.record_query_duration("context_optimization", context_duration)
-            timings["context_optimization"] = context_duration
-            optimized_docs = top_docs
-        log_data["context"]["optimized_docs"] = len(optimized_docs) if optimized_docs else 0
+    return q_dense, q_sparse, embedding_duration
 
-        # 7. LLM Generation
-        _attach_theme_labels(top_docs)
 
-        theme_instruction = _build_theme_instruction(routing_result)
+def _lexical_to_sparse(lex_weights: Any) -> Dict[str, List]:
+    """Convert BGE-M3 lexical_weights format to Qdrant format."""
+    if not lex_weights or not isinstance(lex_weights, dict):  # Check if not empty and is dict
+        return {"indices": [], "values": []}
+    return {
+        "indices": [int(k) for k in lex_weights.keys()],  # Ensure integers
+        "values": [float(lex_weights[k]) for k in lex_weights.keys()],  # Ensure floats
+    }
 
-        try:
-            llm_start = time.time()
-            policy: Dict[str, Any] = {}
-            if theme_instruction:
-                policy["theme_instruction"] = theme_instruction
-            answer_payload = generate_answer(normalized, optimized_docs, policy=policy)
-            llm_duration = time.time() - llm_start
-            logger.info(f"LLM generation in {llm_duration:.2f}s")
-            metrics.record_llm_duration("default", llm_duration)
-            metrics.record_query_duration("llm_generation", llm_duration)
-            timings["llm_generation"] = llm_duration
-        except Exception as e:
-            logger.error(f"LLM generation failed: {e}")
-            error_type = "llm_failed"
-            metrics.record_error("llm_failed", "llm_generation")
-            llm_duration = time.time() - llm_start
-            metrics.record_query_duration("llm_generation", llm_duration)
-            timings["llm_generation"] = llm_duration
-            log_data["status"] = "error"
-            log_data["error_type"] = "llm_failed"
-            timings["total"] = time.time() - start
-            _finalize_query_log(log_data, timings)
-            return {
-                "error": "llm_failed",
-                "message": "Сервис генерации ответов временно недоступен. Попробуйте позже.",
-                "sources": [],
-                "channel": channel,
-                "chat_id": chat_id
-            }
-
-        total_time = time.time() - start
-        logger.info(f"Total processing time: {total_time:.2f}s")
-
-        # Записываем метрики успешного запроса
-        metrics.record_query(channel, status, error_type)
-        metrics.record_query_duration("total", total_time)
-        metrics.record_search_results("hybrid", len(candidates))
-
-        # Генерируем interaction_id для feedback (независимо от RAGAS)
-        interaction_id = None
-        contexts = [doc.get("payload", {}).get("text", "") for doc in top_docs]
-        source_urls = [source.get("url", "") for source in answer_payload.get("sources", [])]
-
-        # Если включена БД качества - сохраняем взаимодействие для feedback
-        if CONFIG.quality_db_enabled:
-            try:
-                interaction_id = quality_manager.generate_interaction_id()
-
-                # Сохраняем взаимодействие для feedback в фоне
-                import concurrent.futures
-
-                def save_interaction_sync():
-                    """Сохраняет взаимодействие синхронно в отдельном event loop"""
-                    try:
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        result = loop.run_until_complete(quality_manager.save_interaction_for_feedback(
-                            interaction_id=interaction_id,
-                            query=normalized,
-                            response=answer_payload.get("answer_markdown", ""),
-                            contexts=contexts,
-                            sources=source_urls
-                        ))
-                        return result
-                    except Exception as e:
-                        logger.error(f"Failed to save interaction for feedback: {e}")
-                        return False
-                    finally:
-                        try:
-                            if not loop.is_closed():
-                                loop.close()
-                        except Exception:
-                            pass
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                    executor.submit(save_interaction_sync)
-                    logger.info(f"Interaction saved for feedback (interaction_id={interaction_id})")
-
-            except Exception as e:
-                logger.warning(f"Failed to save interaction for feedback: {e}")
-
-        # Если включена RAGAS оценка - запускаем её в фоне
-        if CONFIG.enable_ragas_evaluation and interaction_id:
-            try:
-                import concurrent.futures
-
-                def run_ragas_evaluation():
-                    """Запускает RAGAS оценку в отдельном event loop"""
-                    try:
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-
-                        result = loop.run_until_complete(quality_manager.evaluate_interaction(
-                            query=normalized,
-                            response=answer_payload.get("answer_markdown", ""),
-                            contexts=contexts,
-                            sources=source_urls,
-                            interaction_id=interaction_id
-                        ))
-                        return result
-                    except Exception as e:
-                        logger.error(f"RAGAS evaluation failed in background: {e}")
-                        return None
-                    finally:
-                        try:
-                            if not loop.is_closed():
-                                pending = asyncio.all_tasks(loop=loop)
-                                for task in pending:
-                                    task.cancel()
-                                if pending:
-                                    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
-                                loop.close()
-                        except Exception as close_err:
-                            logger.warning(f"Error while closing RAGAS loop: {close_err}")
-
-                with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-                    executor.submit(run_ragas_evaluation)
-                    logger.info(f"RAGAS evaluation started in background (interaction_id={interaction_id})")
-
-            except Exception as e:
-                logger.warning(f"Failed to start RAGAS evaluation: {e}")
-
-        answer_markdown = answer_payload.get("answer_markdown", "")
-        sources = answer_payload.get("sources", [])
-        meta = answer_payload.get("meta", {})
-        log_data["answer"] = {
-            "text": answer_markdown,
-            "sources": sources,
-            "meta": meta,
-        }
-        log_data["status"] = "success"
-        log_data["error_type"] = None
-        timings["total"] = total_time
-        _finalize_query_log(log_data, timings)
 
+class NoResultsError(SearchError):
+    """Поиск не нашёл ни одного кандидата."""
+
+
+def _run_retrieval(
+    channel: str,
+    chat_id: str,
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Этапы 1–6 пайплайна: обработка запроса, роутинг, эмбеддинги, поиск,
+    rerank, auto-merge и оптимизация контекста.
+
+    Этапы выполняются как граф зависимостей (см. stage_graph): эмбеддинги
+    считаются параллельно с роутингом, поиск без фильтра стартует
+    спекулятивно сразу после эмбеддингов, а чанки для auto-merge
+    подгружаются во время rerank.
+
+    Returns:
+        (retrieval, None) при успехе или (None, error_response), если запрос
+        завершился ошибкой; лог запроса в этом случае уже записан.
+    """
+    graph = StageGraph("retrieval")
+    _add_preparation_stages(graph, message, log_data, timings, metrics)
+    _add_search_stages(graph, log_data, timings, metrics)
+    _add_context_stages(graph, log_data, timings, metrics)
+    try:
+        results = _run_graph(graph, log_data)
+    except StageFailed as failure:
+        return None, _stage_error_response(failure, channel, chat_id, log_data, timings, metrics, start)
+    return results["context"], None
+
+
+def _prepare_retrieval(
+    channel: str,
+    chat_id: str,
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """
+    Этапы до поиска: обработка запроса, эмбеддинги, роутинг, фильтр по теме.
+
+    Returns:
+        (state, None) или (None, error_response) с уже записанным логом
+    """
+    graph = StageGraph("retrieval_prepare")
+    _add_preparation_stages(graph, message, log_data, timings, metrics)
+    try:
+        results = _run_graph(graph, log_data)
+    except StageFailed as failure:
+        return None, _stage_error_response(failure, channel, chat_id, log_data, timings, metrics, start)
+    return results["state"], None
+
+
+def _run_graph(graph: StageGraph, log_data: Dict[str, Any], initial: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Выполняет граф; интервалы этапов попадают в лог и при ошибке — до того, как ответ об ошибке его запишет."""
+    try:
+        return graph.run(initial=initial)
+    finally:
+        _record_pipeline(graph, log_data)
+
+
+def _record_pipeline(graph: StageGraph, log_data: Dict[str, Any]) -> None:
+    """Интервалы этапов и критический путь в лог запроса (рядом с исходом спекулятивного поиска)."""
+    log_data.setdefault("pipeline", {}).update(graph.describe())
+
+
+def _finish_retrieval(
+    channel: str,
+    chat_id: str,
+    state: Dict[str, Any],
+    candidates: List[Dict[str, Any]],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Этапы после поиска: тематический буст, rerank (параллельно с prefetch чанков), auto-merge, оптимизация."""
+    try:
+        _log_candidates(candidates, log_data)
+    except NoResultsError as e:
+        return None, _stage_error_response(StageFailed("search", e), channel, chat_id, log_data, timings, metrics, start)
+    graph = StageGraph("retrieval_finish")
+    _add_context_stages(graph, log_data, timings, metrics)
+    try:
+        results = _run_graph(graph, log_data, {"state": state, "search": candidates})
+    except StageFailed as failure:
+        return None, _stage_error_response(failure, channel, chat_id, log_data, timings, metrics, start)
+    return results["context"], None
+
+
+def _stage_error_response(
+    failure: StageFailed,
+    channel: str,
+    chat_id: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    """
+    Ответ об ошибке для упавшего этапа. Ошибки этапов без собственного
+    ответа (роутинг, rerank-контекст) пробрасываются в _handle_unexpected_error.
+    """
+    e = failure.error
+    if isinstance(e, NoResultsError):
+        logger.warning("No candidates found in search")
+        metrics.record_error("no_results", "search")
+        log_data["status"] = "no_results"
+        log_data["error_type"] = "no_results"
+        timings["total"] = time.time() - start
+        _finalize_query_log(log_data, timings)
         return {
-            "answer": answer_markdown,  # временная совместимость с клиентами
-            "answer_markdown": answer_markdown,
-            "sources": sources,
-            "meta": meta,
+            "error": "no_results",
+            "message": "К сожалению, не удалось найти релевантную информацию по вашему запросу. Попробуйте переформулировать вопрос или использовать другие ключевые слова.",
+            "answer": "К сожалению, не удалось найти релевантную информацию по вашему запросу. Попробуйте переформулировать вопрос или использовать другие ключевые слова.",
+            "answer_markdown": "К сожалению, не удалось найти релевантную информацию по вашему запросу. Попробуйте переформулировать вопрос или использовать другие ключевые слова.",
+            "sources": [],
             "channel": channel,
-            "chat_id": chat_id,
-            "processing_time": total_time,
-            "interaction_id": interaction_id
+            "chat_id": chat_id
         }
 
-    except Exception as e:
-        logger.error(f"Unexpected error in handle_query: {e}", exc_info=True)
-
-        # Записываем метрики ошибки
-        error_type = type(e).__name__
-        status = "error"
-        metrics.record_query(channel, status, error_type)
-        metrics.record_error(error_type, "orchestrator")
+    if failure.stage == "query_processing":
+        logger.error(f"Query processing failed: {e}")
         log_data["status"] = "error"
-        log_data["error_type"] = error_type
+        log_data["error_type"] = "query_processing_failed"
         timings["total"] = time.time() - start
         _finalize_query_log(log_data, timings)
+        return {
+            "error": "query_processing_failed",
+            "message": "Ошибка обработки запроса. Попробуйте переформулировать вопрос.",
+            "sources": [],
+            "channel": channel,
+            "chat_id": chat_id
+        }
 
+    if failure.stage == "embeddings":
+        logger.error(f"Embedding generation failed: {e}")
+        metrics.record_error("embedding_failed", "embedding_generation")
+        log_data["status"] = "error"
+        log_data["error_type"] = "embedding_failed"
+        timings["total"] = time.time() - start
+        _finalize_query_log(log_data, timings)
         return {
-            "error": "internal_error",
-            "message": "Произошла внутренняя ошибка. Попробуйте позже или обратитесь в поддержку.",
+            "error": "embedding_failed",
+            "message": "Сервис эмбеддингов временно недоступен. Попробуйте позже.",
             "sources": [],
             "channel": channel,
             "chat_id": chat_id
         }
 
+    if failure.stage in ("search_filtered", "search"):
+        return _search_failed(e, channel, chat_id, log_data, timings, metrics, start)
+
+    raise e
+
+
+def _add_preparation_stages(
+    graph: StageGraph,
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> None:
+    graph.add("query_processing", lambda r: _query_processing_stage(message, log_data, timings, metrics))
+    graph.add(
+        "embeddings",
+        lambda r: _embeddings_stage(r["query_processing"]["normalized"], timings, metrics),
+        deps=("query_processing",),
+    )
+    # Роутинг ждёт эмбеддинги только в режиме THEME_ROUTER_MODE=vector:
+    # там он классифицирует уже вычисленный dense-вектор запроса
+    if CONFIG.theme_router_mode == "vector":
+        graph.add(
+            "routing",
+            lambda r: _routing_stage(r["query_processing"]["normalized"], r["embeddings"][0], log_data, timings, metrics),
+            deps=("query_processing", "embeddings"),
+        )
+    else:
+        graph.add(
+            "routing",
+            lambda r: _routing_stage(r["query_processing"]["normalized"], None, log_data, timings, metrics),
+            deps=("query_processing",),
+        )
+    graph.add(
+        "state",
+        lambda r: {
+            **r["query_processing"],
+            "q_dense": r["embeddings"][0],
+            "q_sparse": r["embeddings"][1],
+            **r["routing"],
+        },
+        deps=("query_processing", "embeddings", "routing"),
+    )
+
+
+def _add_search_stages(
+    graph: StageGraph,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> None:
+    speculative = bool(getattr(CONFIG, "speculative_search_enabled", True))
+    if speculative:
+        # Поиск без фильтра не зависит от роутинга: он нужен, если фильтра нет
+        # или поиск с фильтром ничего не нашёл, поэтому стартует сразу после эмбеддингов
+        graph.add(
+            "search_unfiltered",
+            lambda r: _timed_raw_search(r["query_processing"], r["embeddings"], None),
+            deps=("query_processing", "embeddings"),
+            background=True,
+        )
+    graph.add(
+        "search_filtered",
+        lambda r: (
+            _timed_raw_search(r["state"], (r["state"]["q_dense"], r["state"]["q_sparse"]), r["state"]["theme_filter"])
+            if r["state"]["theme_filter"] is not None
+            else None
+        ),
+        deps=("state",),
+    )
+    graph.add(
+        "search",
+        lambda r: _select_candidates(graph, r["state"], r["search_filtered"], speculative, log_data, timings, metrics),
+        deps=("state", "search_filtered"),
+    )
+
+
+def _add_context_stages(
+    graph: StageGraph,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> None:
+    graph.add("rerank", lambda r: _rerank_stage(r["state"], r["search"], log_data, timings, metrics), deps=("state", "search"))
+    # Чанки документов-кандидатов подгружаются в кэш, пока идёт rerank
+    graph.add("prefetch", lambda r: _prefetch_stage(r["state"], r["search"]), deps=("state", "search"), background=True)
+    graph.add(
+        "context",
+        lambda r: _context_stage(r["state"], r["rerank"], log_data, timings, metrics),
+        deps=("state", "rerank"),
+    )
+
+
+def _query_processing_stage(
+    message: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> Dict[str, Any]:
+    """1. Query Processing (с Query Type Classification)."""
+    qp_start = time.time()
+    qp = process_query(message)
+    normalized = qp["normalized_text"]
+    boosts = qp.get("boosts", {})
+    group_boosts = qp.get("group_boosts", {})
+
+    # Извлекаем стратегию retrieval на основе типа запроса
+    query_type = qp.get("query_type")
+    retrieval_strategy = qp.get("retrieval_strategy", {})
+    if should_degrade("cheap_strategy"):
+        retrieval_strategy = get_degraded_strategy(retrieval_strategy)
+    strategy_k = retrieval_strategy.get("k", 20)
+    strategy_rerank_top_n = retrieval_strategy.get("rerank_top_n", 6)
+    strategy_use_auto_merge = retrieval_strategy.get("use_auto_merge", True)
+
+    qp_duration = time.time() - qp_start
+    logger.info(
+        f"Query processed in {qp_duration:.2f}s, "
+        f"type={query_type.value if query_type else 'unknown'}, "
+        f"strategy: k={strategy_k}, rerank={strategy_rerank_top_n}, auto_merge={strategy_use_auto_merge}"
+    )
+    metrics.record_query_duration("query_processing", qp_duration)
+    timings["query_processing"] = qp_duration
+    log_data["request"].update({
+        "normalized": normalized,
+        "boosts": boosts,
+        "group_boosts": group_boosts,
+        "query_type": query_type.value if query_type else None,
+        "retrieval_strategy": retrieval_strategy,
+    })
+    return {
+        "normalized": normalized,
+        "boosts": boosts,
+        "group_boosts": group_boosts,
+        "query_type": query_type,
+        "retrieval_strategy": retrieval_strategy,
+        "strategy_k": strategy_k,
+        "strategy_rerank_top_n": strategy_rerank_top_n,
+        "strategy_use_auto_merge": strategy_use_auto_merge,
+    }
+
+
+def _embeddings_stage(
+    normalized: str,
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> Tuple[List[float], Dict[str, Any]]:
+    """
+    2. Unified Embeddings Generation (через circuit breaker: при недоступном
+    сервисе эмбеддингов запрос сразу получает embedding_failed).
+    """
+    q_dense, q_sparse, embedding_duration = embedding_circuit_breaker.call(
+        _compute_query_embeddings, normalized, metrics
+    )
+    metrics.record_query_duration("embeddings", embedding_duration)
+    timings["embeddings"] = embedding_duration
+    return q_dense, q_sparse
+
+
+def _routing_stage(
+    normalized: str,
+    q_dense: Optional[List[float]],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> Dict[str, Any]:
+    """Тематический роутинг и фильтр по теме."""
+    routing_start = time.time()
+    routing_result = route_query(normalized, user_metadata=None, query_vector=q_dense)
+    routing_duration = time.time() - routing_start
+    logger.info(
+        f"Theme routing in {routing_duration:.2f}s "
+        f"(primary={routing_result.get('primary_theme')}, "
+        f"via_llm={routing_result.get('router', 'unknown')}, "
+        f"disambiguation={routing_result.get('requires_disambiguation')})"
+    )
+    metrics.record_query_duration("routing", routing_duration)
+    timings["routing"] = routing_duration
+    log_data["routing"] = _serialize_routing_result(routing_result)
+    theme_filter = _build_theme_filter(routing_result)
+    log_data["search"] = {
+        "theme_filter_applied": theme_filter is not None,
+        "theme_filter_conditions": _describe_theme_filter(theme_filter),
+        "fallback_without_filter": False,
+        "candidates_total": 0,
+        "candidates_before_theme_boost": [],
+        "candidates_after_theme_boost": [],
+        "candidates_after_rerank": [],
+    }
+    return {"routing_result": routing_result, "theme_filter": theme_filter}
+
+
+def _search_kwargs(state: Dict[str, Any], metadata_filter: Optional[Filter]) -> Dict[str, Any]:
+    """Аргументы hybrid_search / hybrid_search_async для состояния запроса."""
+    return dict(
+        query_dense=state["q_dense"],
+        query_sparse=state["q_sparse"],
+        k=_search_k(state),  # Адаптивный k на основе типа запроса
+        boosts=state["boosts"],
+        group_boosts=state["group_boosts"],
+        routing_result=state["routing_result"],
+        metadata_filter=metadata_filter,
+    )
+
+
+def _timed_raw_search(
+    strategy: Dict[str, Any],
+    embeddings: Tuple[List[float], Dict[str, Any]],
+    metadata_filter: Optional[Filter],
+) -> Tuple[Tuple[list, list], float]:
+    """Запросы к Qdrant без фьюжна (он зависит от роутинга) и их длительность."""
+    search_start = time.time()
+    q_dense, q_sparse = embeddings
+    raw = hybrid_search_raw(q_dense, q_sparse, k=_search_k(strategy), metadata_filter=metadata_filter)
+    return raw, time.time() - search_start
+
+
+def _search_k(strategy: Dict[str, Any]) -> int:
+    """k поиска; при нехватке времени до дедлайна (shrink_k) — вдвое меньше, но не меньше top_n rerank."""
+    k = strategy["strategy_k"]
+    if should_degrade("shrink_k"):
+        return max(strategy["strategy_rerank_top_n"], k // 2)
+    return k
+
+
+def _fuse(state: Dict[str, Any], raw: Tuple[list, list]) -> List[Dict[str, Any]]:
+    return fuse_hybrid_results(
+        raw,
+        k=state["strategy_k"],
+        boosts=state["boosts"],
+        group_boosts=state["group_boosts"],
+        routing_result=state["routing_result"],
+    )
+
+
+def _select_candidates(
+    graph: StageGraph,
+    state: Dict[str, Any],
+    filtered: Optional[Tuple[Tuple[list, list], float]],
+    speculative: bool,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> List[Dict[str, Any]]:
+    """
+    3. Hybrid Search (с параметрами из retrieval_strategy): результат поиска
+    с фильтром по теме, а если фильтра нет или он ничего не нашёл — поиска без фильтра.
+    """
+    stage = "search"
+    if filtered is not None:
+        raw, duration = filtered
+        candidates = _fuse(state, raw)
+        _record_search("search", duration, candidates, state, log_data, timings, metrics)
+        if candidates:
+            log_data.setdefault("pipeline", {})["speculative_search"] = "discarded" if speculative else "off"
+            _log_candidates(candidates, log_data)
+            return candidates
+        # Fallback: если поиск с фильтром не дал результатов, пробуем без фильтра
+        logger.warning("No candidates found with theme filter, trying without filter")
+        stage = "search_no_filter"
+
+    if speculative:
+        raw, duration = graph.wait_for("search_unfiltered")
+    else:
+        raw, duration = _timed_raw_search(state, (state["q_dense"], state["q_sparse"]), None)
+    candidates = _fuse(state, raw)
+    _record_search(stage, duration, candidates, state, log_data, timings, metrics)
+    log_data.setdefault("pipeline", {})["speculative_search"] = "used" if speculative else "off"
+    _log_candidates(candidates, log_data)
+    return candidates
+
+
+def _record_search(
+    stage: str,
+    duration: float,
+    candidates: List[Dict[str, Any]],
+    state: Dict[str, Any],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> None:
+    if stage == "search":
+        logger.info(f"Hybrid search in {duration:.2f}s (k={state['strategy_k']})")
+        metrics.record_search_duration("hybrid", duration)
+    else:
+        logger.info(f"Hybrid search (without filter) in {duration:.2f}s")
+        metrics.record_search_duration("hybrid_no_filter", duration)
+        log_data["search"]["fallback_without_filter"] = True
+        if candidates:
+            logger.info(f"Found {len(candidates)} candidates without theme filter")
+    metrics.record_query_duration(stage, duration)
+    timings[stage] = duration
+
+
+def _log_candidates(candidates: List[Dict[str, Any]], log_data: Dict[str, Any]) -> None:
+    """Записывает кандидатов поиска в лог; без кандидатов — NoResultsError."""
+    log_data["search"]["candidates_total"] = len(candidates) if candidates else 0
+    log_data["search"]["candidates_before_theme_boost"] = _prepare_log_candidates(
+        candidates or [],
+        CONFIG.query_log_max_candidates,
+        CONFIG.query_log_text_prefix_len,
+    )
+    if not candidates:
+        raise NoResultsError("no candidates found")
+
+
+def _search_failed(
+    e: Exception,
+    channel: str,
+    chat_id: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    logger.error(f"Hybrid search failed: {e}")
+    metrics.record_error("search_failed", "hybrid_search")
+    log_data["status"] = "error"
+    log_data["error_type"] = "search_failed"
+    timings["total"] = time.time() - start
+    _finalize_query_log(log_data, timings)
+    return {
+        "error": "search_failed",
+        "message": "Ошибка поиска в базе знаний. Попробуйте позже.",
+        "sources": [],
+        "channel": channel,
+        "chat_id": chat_id
+    }
+
+
+def _should_auto_merge(state: Dict[str, Any]) -> bool:
+    # Используем И CONFIG флаг И стратегию для максимальной гибкости
+    return bool(CONFIG.retrieval_auto_merge_enabled and state["strategy_use_auto_merge"])
+
+
+def _rerank_stage(
+    state: Dict[str, Any],
+    candidates: List[Dict[str, Any]],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> Dict[str, Any]:
+    """Тематический буст и 5. Reranking (с параметрами из retrieval_strategy)."""
+    strategy_rerank_top_n = state["strategy_rerank_top_n"]
+    candidates = _boost_candidates(state, candidates, log_data)
+
+    if should_degrade("skip_rerank"):
+        logger.info(f"Rerank skipped to meet request deadline (top_n={strategy_rerank_top_n})")
+        top_docs = candidates[:strategy_rerank_top_n]
+        _log_reranked(top_docs, log_data)
+        return {"candidates": candidates, "top_docs": top_docs}
+
+    rerank_start = time.time()
+    try:
+        # Пакетная обработка reranker: batch_size=20, усечение текста до 384 симв.
+        # top_n адаптируется на основе типа запроса
+        top_docs = rerank(state["normalized"], candidates, top_n=strategy_rerank_top_n, batch_size=20, max_length=384)
+        rerank_duration = time.time() - rerank_start
+        logger.info(f"Rerank completed in {rerank_duration:.2f}s (top_n={strategy_rerank_top_n})")
+        metrics.record_query_duration("rerank", rerank_duration)
+        timings["rerank"] = rerank_duration
+    except Exception as e:
+        rerank_duration = time.time() - rerank_start
+        logger.warning(f"Reranking failed after {rerank_duration:.2f}s: {e}, using original candidates")
+        metrics.record_query_duration("rerank", rerank_duration)
+        timings["rerank"] = rerank_duration
+        top_docs = candidates[:strategy_rerank_top_n]  # Fallback с адаптивным top_n
+
+    _log_reranked(top_docs, log_data)
+    return {"candidates": candidates, "top_docs": top_docs}
+
+
+def _boost_candidates(
+    state: Dict[str, Any],
+    candidates: List[Dict[str, Any]],
+    log_data: Dict[str, Any],
+) -> List[Dict[str, Any]]:
+    candidates = _apply_theme_boost(candidates, state["routing_result"])
+    log_data["search"]["candidates_after_theme_boost"] = _prepare_log_candidates(
+        candidates,
+        CONFIG.query_log_max_candidates,
+        CONFIG.query_log_text_prefix_len,
+    )
+    return candidates
+
+
+def _log_reranked(top_docs: List[Dict[str, Any]], log_data: Dict[str, Any]) -> None:
+    log_data["search"]["candidates_after_rerank"] = _prepare_log_candidates(
+        top_docs,
+        CONFIG.query_log_max_candidates,
+        CONFIG.query_log_text_prefix_len,
+    )
+
+
+def _prefetch_stage(state: Dict[str, Any], candidates: List[Dict[str, Any]]) -> int:
+    max_docs = int(getattr(CONFIG, "retrieval_auto_merge_prefetch_docs", 10))
+    if max_docs <= 0 or not _should_auto_merge(state):
+        return 0
+    return prefetch_doc_chunks(candidates, max_docs)
+
+
+def _context_stage(
+    state: Dict[str, Any],
+    reranked: Dict[str, Any],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+) -> Dict[str, Any]:
+    """5b. Auto-merge соседних чанков и 6. оптимизация контекста."""
+    normalized = state["normalized"]
+    query_type = state["query_type"]
+    routing_result = state["routing_result"]
+    top_docs = reranked["top_docs"]
+
+    # 5b. Авто-слияние соседних чанков (учитываем strategy_use_auto_merge)
+    if _should_auto_merge(state) and top_docs and not should_degrade("skip_auto_merge"):
+        try:
+            max_ctx_tokens = getattr(context_optimizer, "max_context_tokens", CONFIG.retrieval_auto_merge_max_tokens)
+            reserve = getattr(context_optimizer, "reserve_for_response", 0.35)
+            available = max(1, int(max_ctx_tokens * (1 - reserve)))
+            merge_limit = min(CONFIG.retrieval_auto_merge_max_tokens, available)
+        except Exception:
+            merge_limit = CONFIG.retrieval_auto_merge_max_tokens
+
+        merged_docs = auto_merge_neighbors(top_docs, max_window_tokens=merge_limit)
+        log_data["context"]["auto_merge_before"] = len(top_docs)
+        if merged_docs != top_docs:
+            reduction = len(top_docs) - len(merged_docs)
+            efficiency = 100 * (1 - len(merged_docs) / len(top_docs)) if top_docs else 0
+            logger.debug(
+                f"Auto-merge: {len(top_docs)} -> {len(merged_docs)} окон "
+                f"(лимит={merge_limit} токенов, экономия={reduction} чанков, эффективность={efficiency:.1f}%)"
+            )
+            log_data["context"]["auto_merge_applied"] = True
+            log_data["context"]["auto_merge_after"] = len(merged_docs)
+        top_docs = merged_docs
+        log_data["context"].setdefault("auto_merge_after", len(top_docs))
+    else:
+        log_data["context"]["auto_merge_before"] = len(top_docs) if top_docs else 0
+        log_data["context"]["auto_merge_after"] = len(top_docs) if top_docs else 0
+        # Логируем причину пропуска auto_merge
+        if not state["strategy_use_auto_merge"]:
+            logger.debug(f"Auto-merge skipped by retrieval strategy (query_type={query_type.value if query_type else 'unknown'})")
+
+    # 6. Context Optimization - управление размером токенов для LLM
+    context_start = time.time()
+    try:
+        optimized_docs = context_optimizer.optimize_context(normalized, top_docs)
+        context_duration = time.time() - context_start
+        logger.info(f"Context optimized: {len(top_docs)} -> {len(optimized_docs)} documents in {context_duration:.2f}s")
+        metrics.record_query_duration("context_optimization", context_duration)
+        timings["context_optimization"] = context_duration
+    except Exception as e:
+        context_duration = time.time() - context_start
+        logger.warning(f"Context optimization failed after {context_duration:.2f}s: {e}, using original documents")
+        metrics.record_query_duration("context_optimization", context_duration)
+        timings["context_optimization"] = context_duration
+        optimized_docs = top_docs
+    log_data["context"]["optimized_docs"] = len(optimized_docs) if optimized_docs else 0
+
+    _attach_theme_labels(top_docs)
+
+    theme_instruction = _build_theme_instruction(routing_result)
+    policy: Dict[str, Any] = {}
+    if theme_instruction:
+        policy["theme_instruction"] = theme_instruction
+
+    return {
+        "normalized": normalized,
+        "query_type": query_type,
+        "retrieval_strategy": state["retrieval_strategy"],
+        "routing_result": routing_result,
+        "candidates": reranked["candidates"],
+        "top_docs": top_docs,
+        "optimized_docs": optimized_docs,
+        "policy": policy,
+    }
+
+
+def _complete_query(
+    channel: str,
+    chat_id: str,
+    retrieval: Dict[str, Any],
+    answer_payload: Dict[str, Any],
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    """Метрики, сохранение взаимодействия для feedback/RAGAS и итоговый лог успешного запроса."""
+    normalized = retrieval["normalized"]
+    top_docs = retrieval["top_docs"]
+    candidates = retrieval["candidates"]
+
+    total_time = time.time() - start
+    logger.info(f"Total processing time: {total_time:.2f}s")
+
+    # Записываем метрики успешного запроса
+    metrics.record_query(channel, "success", None)
+    metrics.record_query_duration("total", total_time)
+    metrics.record_search_results("hybrid", len(candidates))
+
+    # Генерируем interaction_id для feedback (независимо от RAGAS)
+    interaction_id = None
+    contexts = [doc.get("payload", {}).get("text", "") for doc in top_docs]
+    source_urls = [source.get("url", "") for source in answer_payload.get("sources", [])]
+
+    # Если включена БД качества - сохраняем взаимодействие для feedback.
+    # Сохранение и RAGAS-оценка идут через фоновую очередь и не задерживают ответ.
+    if CONFIG.quality_db_enabled:
+        try:
+            interaction_id = quality_manager.generate_interaction_id()
+            interaction = QualityInteraction(
+                interaction_id=interaction_id,
+                query=normalized,
+                response=answer_payload.get("answer_markdown", ""),
+                contexts=contexts,
+                sources=source_urls,
+            )
+            task_queue = get_quality_task_queue()
+            if task_queue.enqueue_interaction(interaction):
+                logger.info(f"Interaction queued for feedback (interaction_id={interaction_id})")
+
+            # Если включена RAGAS оценка - ставим её в очередь (с учётом доли выборки)
+            if CONFIG.enable_ragas_evaluation and task_queue.enqueue_evaluation(interaction):
+                logger.info(f"RAGAS evaluation queued (interaction_id={interaction_id})")
+
+        except Exception as e:
+            logger.warning(f"Failed to queue interaction for feedback: {e}")
+
+    answer_markdown = answer_payload.get("answer_markdown", "")
+    sources = answer_payload.get("sources", [])
+    meta = answer_payload.get("meta", {})
+    log_data["answer"] = {
+        "text": answer_markdown,
+        "sources": sources,
+        "meta": meta,
+    }
+    log_data["status"] = "success"
+    log_data["error_type"] = None
+    timings["total"] = total_time
+    _finalize_query_log(log_data, timings)
+
+    return {
+        "answer": answer_markdown,  # временная совместимость с клиентами
+        "answer_markdown": answer_markdown,
+        "sources": sources,
+        "meta": meta,
+        "channel": channel,
+        "chat_id": chat_id,
+        "processing_time": total_time,
+        "interaction_id": interaction_id
+    }
+
+
+def _handle_unexpected_error(
+    e: Exception,
+    channel: str,
+    chat_id: str,
+    log_data: Dict[str, Any],
+    timings: Dict[str, Optional[float]],
+    metrics: Any,
+    start: float,
+) -> Dict[str, Any]:
+    logger.error(f"Unexpected error in handle_query: {e}", exc_info=True)
+
+    # Записываем метрики ошибки
+    error_type = type(e).__name__
+    status = "error"
+    metrics.record_query(channel, status, error_type)
+    metrics.record_error(error_type, "orchestrator")
+    log_data["status"] = "error"
+    log_data["error_type"] = error_type
+    timings["total"] = time.time() - start
+    _finalize_query_log(log_data, timings)
+
+    return {
+        "error": "internal_error",
+        "message": "Произошла внутренняя ошибка. Попробуйте позже или обратитесь в поддержку.",
+        "sources": [],
+        "channel": channel,
+        "chat_id": chat_id
+    }
+
 
 def _build_theme_filter(routing_result: Dict[str, Any] | None) -> Optional[Filter]:
     if not routing_result:
@@ -580,8 +1230,16 @@ def _is_theme_filter_allowed(routing_result: Dict[str, Any]) -> bool:
     router_kind = routing_result.get("router")
     top_score = float(routing_result.get("top_score") or 0.0)
     second_score = float(routing_result.get("second_score") or 0.0)
-    if router_kind == "llm":
+    if router_kind in ("llm", "vector+llm"):
+        # vector+llm: неоднозначность центроидов разрешила LLM — доверяем её уверенности
         return top_score >= 0.9
+    if router_kind == "vector":
+        vector_margin = float(routing_result.get("vector_margin") or 0.0)
+        return (
+            not routing_result.get("requires_disambiguation")
+            and top_score >= float(getattr(CONFIG, "theme_filter_vector_min_score", 0.8))
+            and vector_margin >= float(getattr(CONFIG, "theme_filter_vector_min_margin", 0.08))
+        )
     if router_kind == "heuristic":
         return top_score >= 0.85 and (top_score - second_score) >= 0.35
     return False
@@ -641,7 +1299,12 @@ def _apply_theme_boost(docs: List[Dict[str, Any]], routing_result: Dict[str, Any
     return docs
 
 
-def _init_query_log(channel: str, chat_id: str, raw_message: str) -> Dict[str, Any]:
+def _init_query_log(
+    channel: str,
+    chat_id: str,
+    raw_message: str,
+    deadline: Optional[Deadline] = None,
+) -> Dict[str, Any]:
     return {
         "timestamp": datetime.now(timezone.utc).isoformat(),
         "channel": channel,
@@ -671,6 +1334,8 @@ def _init_query_log(channel: str, chat_id: str, raw_message: str) -> Dict[str, A
             "auto_merge_after": 0,
             "optimized_docs": 0,
         },
+        # Общий список с дедлайном: этапы дописывают в него сработавшие деградации
+        "degradations": deadline.degradations if deadline is not None else [],
         "answer": {},
         "timings": {},
     }
@@ -764,6 +1429,9 @@ def _finalize_query_log(log_data: Dict[str, Any], timings: Dict[str, Optional[fl
         }
         if not log_data.get("timestamp"):
             log_data["timestamp"] = datetime.now(timezone.utc).isoformat()
+        trace = current_trace()
+        if trace is not None:
+            log_data["trace"] = trace.summary()
         log_query_interaction(log_data)
     except Exception as exc:
         logger.warning(f"Failed to finalize query log: {exc}")
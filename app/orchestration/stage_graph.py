@@ -0,0 +1,276 @@
+"""
+Граф этапов пайплайна запроса.
+
+Этап объявляется функцией от результатов своих зависимостей и запускается,
+как только все они готовы, поэтому независимые этапы (эмбеддинги и роутинг,
+поиск с фильтром и без, rerank и подгрузка соседних чанков) выполняются
+параллельно. Фоновые этапы (спекулятивный поиск, prefetch) граф не ждёт:
+их результат забирает другой этап через wait_for, если он понадобился.
+Для каждого этапа сохраняется интервал выполнения, по которым
+восстанавливается критический путь — цепочка этапов, определившая общую
+длительность. Каждый этап — спан трассировки stage.<имя> (app.infrastructure.tracing).
+
+В event loop граф выполняется через run_async: каждый этап отдаётся в
+переданный пул отдельной задачей, и ни один поток не ждёт остальные этапы.
+"""
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.config import CONFIG
+from app.infrastructure.admission import register_queue_probe
+from app.infrastructure.tracing import span
+
+StageFn = Callable[[Dict[str, Any]], Any]
+
+
+class StageFailed(Exception):
+    """Этап завершился исключением; оригинал доступен в __cause__ и error."""
+
+    def __init__(self, stage: str, error: BaseException):
+        super().__init__(f"stage '{stage}' failed: {error}")
+        self.stage = stage
+        self.error = error
+
+
+@dataclass
+class _Stage:
+    name: str
+    fn: StageFn
+    deps: Tuple[str, ...]
+    optional: bool = False
+    background: bool = False
+
+
+@dataclass
+class StageGraph:
+    """
+    Небольшой DAG этапов одного запроса.
+
+    optional-этапы не прерывают граф при ошибке: их результатом становится
+    None. background-этапы запускаются, когда готовы их зависимости, но
+    run() их не ждёт, и от них нельзя зависеть — только wait_for.
+    """
+
+    name: str = "pipeline"
+    executor: Optional[ThreadPoolExecutor] = None
+    _stages: Dict[str, _Stage] = field(default_factory=dict)
+    _submitted: Dict[str, Tuple[Future, Dict[str, Any]]] = field(default_factory=dict)
+    _origin: float = 0.0
+    # Фоновые этапы, результат которых этап получил через wait_for (для критического пути)
+    _waits: Dict[str, List[str]] = field(default_factory=dict)
+    _local: threading.local = field(default_factory=threading.local)
+    timeline: Dict[str, Tuple[float, float]] = field(default_factory=dict)
+
+    def add(
+        self,
+        name: str,
+        fn: StageFn,
+        deps: Iterable[str] = (),
+        optional: bool = False,
+        background: bool = False,
+    ) -> "StageGraph":
+        deps = tuple(deps)
+        background_deps = [dep for dep in deps if dep in self._stages and self._stages[dep].background]
+        if background_deps:
+            raise ValueError(f"stage '{name}' cannot depend on background stages: {background_deps}")
+        self._stages[name] = _Stage(name, fn, deps, optional, background)
+        return self
+
+    def run(self, initial: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Выполняет граф; возвращает результаты всех этапов по именам.
+
+        Raises:
+            StageFailed: первый упавший обязательный этап (ещё не начатые этапы не запускаются)
+        """
+        executor = self.executor or get_stage_executor()
+        results: Dict[str, Any] = dict(initial or {})
+        pending = dict(self._stages)
+        running: Dict[Future, str] = {}
+        self._origin = time.perf_counter()
+
+        def submit(stage: _Stage) -> None:
+            snapshot = {dep: results[dep] for dep in stage.deps}
+            # Этапы видят contextvars запроса (например, его дедлайн)
+            future = executor.submit(contextvars.copy_context().run, self._timed, stage, snapshot)
+            self._submitted[stage.name] = (future, snapshot)
+            if stage.background:
+                future.add_done_callback(lambda f, name=stage.name: self._record_background(name, f))
+            else:
+                running[future] = stage.name
+
+        try:
+            while any(not stage.background for stage in pending.values()) or running:
+                ready = [stage for stage in pending.values() if all(dep in results for dep in stage.deps)]
+                for stage in ready:
+                    del pending[stage.name]
+                    submit(stage)
+                if not running:
+                    raise RuntimeError(f"stage graph '{self.name}' has unsatisfiable stages: {list(pending)}")
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    stage = self._stages[name]
+                    value, interval, error = future.result()
+                    self.timeline[name] = interval
+                    if error is not None:
+                        if not stage.optional:
+                            raise StageFailed(name, error) from error
+                        value = None
+                    results[name] = value
+        finally:
+            # Ещё не начатые этапы больше не нужны; начатые доработают в фоне
+            for future, _snapshot in self._submitted.values():
+                future.cancel()
+        return results
+
+    async def run_async(
+        self,
+        submit: Callable[..., Awaitable[Any]],
+        initial: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Вариант run() для event loop: submit(fn, *args) выполняет функцию этапа
+        в пуле потоков (контекст задачи он копирует сам). Этапы графа в таком
+        режиме не могут вызывать wait_for.
+
+        Raises:
+            StageFailed: первый упавший обязательный этап (ещё не начатые этапы не запускаются)
+        """
+        results: Dict[str, Any] = dict(initial or {})
+        pending = dict(self._stages)
+        running: Dict["asyncio.Future[Any]", str] = {}
+        launched: List["asyncio.Future[Any]"] = []
+        self._origin = time.perf_counter()
+
+        def launch(stage: _Stage) -> None:
+            snapshot = {dep: results[dep] for dep in stage.deps}
+            task = asyncio.ensure_future(submit(self._timed, stage, snapshot))
+            launched.append(task)
+            if stage.background:
+                task.add_done_callback(lambda t, name=stage.name: self._record_background(name, t))
+            else:
+                running[task] = stage.name
+
+        try:
+            while any(not stage.background for stage in pending.values()) or running:
+                ready = [stage for stage in pending.values() if all(dep in results for dep in stage.deps)]
+                for stage in ready:
+                    del pending[stage.name]
+                    launch(stage)
+                if not running:
+                    raise RuntimeError(f"stage graph '{self.name}' has unsatisfiable stages: {list(pending)}")
+                done, _ = await asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    stage = self._stages[name]
+                    value, interval, error = task.result()
+                    self.timeline[name] = interval
+                    if error is not None:
+                        if not stage.optional:
+                            raise StageFailed(name, error) from error
+                        value = None
+                    results[name] = value
+        finally:
+            # Как в run(): ещё не начатые этапы снимаются с очереди пула, начатые доработают в фоне
+            for task in launched:
+                task.cancel()
+        return results
+
+    def wait_for(self, name: str, timeout: Optional[float] = None) -> Any:
+        """
+        Результат фонового этапа (вызывается из другого этапа).
+
+        Если этап ещё ждёт свободного потока, он выполняется в текущем —
+        этап не блокируется на задаче, стоящей в очереди того же пула.
+
+        Raises:
+            KeyError: этап не был запущен
+            Exception: исключение самого этапа
+        """
+        future, snapshot = self._submitted[name]
+        caller = getattr(self._local, "stage", None)
+        if caller is not None:
+            self._waits.setdefault(caller, []).append(name)
+        if future.cancel():
+            value, interval, error = self._timed(self._stages[name], snapshot)
+        else:
+            value, interval, error = future.result(timeout=timeout)
+        self.timeline[name] = interval
+        if error is not None:
+            raise error
+        return value
+
+    def _record_background(self, name: str, future: Future) -> None:
+        if not future.cancelled():
+            self.timeline.setdefault(name, future.result()[1])
+
+    def _timed(self, stage: _Stage, deps: Dict[str, Any]):
+        outer = getattr(self._local, "stage", None)
+        self._local.stage = stage.name
+        started = time.perf_counter() - self._origin
+        try:
+            with span(f"stage.{stage.name}"):
+                value, error = stage.fn(deps), None
+        except BaseException as exc:  # noqa: BLE001 - передаём в run()/wait_for()
+            value, error = None, exc
+        finally:
+            self._local.stage = outer
+        return value, (started, time.perf_counter() - self._origin), error
+
+    def critical_path(self, target: Optional[str] = None) -> List[str]:
+        """
+        Цепочка этапов, закончившаяся последним обязательным этапом (или
+        target): от этапа идём к той зависимости, которая завершилась
+        последней. Фоновые этапы учитываются, если их ждали через wait_for.
+        """
+        foreground = [name for name in self.timeline if not self._stages[name].background]
+        if not foreground:
+            return []
+        current = target or max(foreground, key=lambda name: self.timeline[name][1])
+        path = [current]
+        while True:
+            deps = [
+                dep for dep in (*self._stages[current].deps, *self._waits.get(current, ()))
+                if dep in self.timeline
+            ]
+            if not deps:
+                break
+            current = max(deps, key=lambda dep: self.timeline[dep][1])
+            path.append(current)
+        return list(reversed(path))
+
+    def describe(self) -> Dict[str, Any]:
+        """Интервалы этапов (мс от старта графа) и критический путь для лога запроса."""
+        return {
+            "stages": {
+                name: [round(start * 1000, 1), round(end * 1000, 1)]
+                for name, (start, end) in sorted(self.timeline.items(), key=lambda item: item[1][0])
+            },
+            "critical_path": self.critical_path(),
+        }
+
+
+_stage_executor: Optional[ThreadPoolExecutor] = None
+_stage_executor_lock = threading.Lock()
+
+
+def get_stage_executor() -> ThreadPoolExecutor:
+    """Общий пул для этапов графа (размер: pipeline_stage_workers)."""
+    global _stage_executor
+    if _stage_executor is None:
+        with _stage_executor_lock:
+            if _stage_executor is None:
+                workers = int(getattr(CONFIG, "pipeline_stage_workers", 0)) or min(32, (os.cpu_count() or 4) * 4)
+                _stage_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag-stage")
+                # Этапы, ждущие свободного потока, — нагрузка для admission control
+                register_queue_probe("pipeline_stages", _stage_executor._work_queue.qsize)
+    return _stage_executor
@@ -7,6 +7,9 @@ from FlagEmbedding import FlagReranker
 from sentence_transformers import CrossEncoder
 from app.config import CONFIG
 from app.hardware import get_device, optimize_for_gpu, clear_gpu_cache
+from app.infrastructure.admission import register_queue_probe
+from app.infrastructure.tracing import span
+from app.retrieval.rerank_batcher import RerankBatcher, RerankOverloadedError
 from loguru import logger
 from pathlib import Path
 import onnxruntime as ort
@@ -76,31 +79,9 @@ def _get_reranker() -> Any:
     return _reranker
 
 
-def rerank(query: str, candidates: list[dict], top_n: int = 10, batch_size: int | None = None, max_length: int | None = None) -> list[dict]:
-    """Реализация bge-reranker-v2-m3 на CPU с пакетной обработкой.
-    - batch_size: размер батча для ускорения токенизации/инференса
-    - max_length: максимальная длина токенов документа (усечение текста)
-    Возвращает top_n документов, отсортированных по релевантности к запросу.
-    """
-    if not candidates:
-        return []
+def _score_pairs(pairs: list[list[str]], bs: int) -> list[float]:
+    """Скоры модели для пар (query, doc) батчами по bs; при сбое батча — одним проходом."""
     reranker = _get_reranker()
-
-    # Подготовка пар (с отсечением)
-    def get_doc_text(c: dict) -> str:
-        payload = (c.get("payload", {}) or {})
-        text = payload.get("text") or payload.get("title") or ""
-        if not text:
-            return ""
-        if max_length and isinstance(max_length, int) and max_length > 0:
-            # Простое усечение по символам (чтобы не тянуть лишнее в токенайзер)
-            return text[: max_length]
-        return text
-
-    pairs = [[query, get_doc_text(c)] for c in candidates]
-
-    # Пакетная обработка
-    bs = batch_size or getattr(CONFIG, "reranker_batch_size", 16)
     all_scores: list[float] = []
     try:
         # Если есть ONNX ORT сессия (DML)
@@ -109,7 +90,11 @@ def rerank(query: str, candidates: list[dict], top_n: int = 10, batch_size: int
                 chunk = pairs[i : i + bs]
                 texts_a = [a for a, _ in chunk]
                 texts_b = [b for _, b in chunk]
-                enc = _ort_tokenizer(texts_a, texts_b, padding=True, truncation=True, return_tensors="pt")
+                with span("rerank.tokenize", batch_size=len(chunk)) as tokenize_span:
+                    enc = _ort_tokenizer(
+                        texts_a, texts_b, padding=True, truncation=True, return_tensors="pt"
+                    )
+                    tokenize_span.set("tokens", int(enc["input_ids"].numel()))
                 feed = {}
                 input_names = {i.name for i in _ort_sess.get_inputs()}
                 if "input_ids" in input_names:
@@ -118,34 +103,143 @@ def rerank(query: str, candidates: list[dict], top_n: int = 10, batch_size: int
                     feed["attention_mask"] = enc["attention_mask"].cpu().numpy()
                 if "token_type_ids" in enc and "token_type_ids" in input_names:
                     feed["token_type_ids"] = enc["token_type_ids"].cpu().numpy()
-                outputs = _ort_sess.run(None, feed)
+                with span("rerank.inference", batch_size=len(chunk)):
+                    outputs = _ort_sess.run(None, feed)
                 logits = torch.from_numpy(outputs[0]).squeeze(-1)
                 scores = torch.sigmoid(logits).cpu().numpy().tolist()
                 all_scores.extend([float(s) for s in scores])
         elif isinstance(reranker, CrossEncoder):
             for i in range(0, len(pairs), bs):
                 chunk = pairs[i : i + bs]
-                chunk_scores = reranker.predict(chunk, batch_size=bs)
+                with span("rerank.batch", batch_size=len(chunk)):
+                    chunk_scores = reranker.predict(chunk, batch_size=bs)
                 all_scores.extend([float(s) for s in chunk_scores])
         else:
             # FlagReranker
             for i in range(0, len(pairs), bs):
                 chunk = pairs[i : i + bs]
-                chunk_scores = reranker.compute_score(chunk, normalize=True)
+                with span("rerank.batch", batch_size=len(chunk)):
+                    chunk_scores = reranker.compute_score(chunk, normalize=True)
                 all_scores.extend([float(s) for s in chunk_scores])
     except Exception as e:
         logger.warning(f"Reranker batch scoring failed: {e}; falling back to single-batch")
-        try:
-            if isinstance(reranker, CrossEncoder):
-                all_scores = [float(s) for s in reranker.predict(pairs, batch_size=bs)]
-            else:
-                all_scores = [float(s) for s in reranker.compute_score(pairs, normalize=True)]
-        except Exception as e2:
-            logger.error(f"Reranker scoring failed completely: {e2}")
-            return candidates[:top_n]
+        if isinstance(reranker, CrossEncoder):
+            all_scores = [float(s) for s in reranker.predict(pairs, batch_size=bs)]
+        else:
+            all_scores = [float(s) for s in reranker.compute_score(pairs, normalize=True)]
+    return all_scores
+
+
+_batcher: RerankBatcher | None = None
+_batcher_lock = threading.Lock()
+
+
+def get_rerank_batcher() -> RerankBatcher:
+    """Общий для процесса воркер, упаковывающий пары разных запросов в один батч модели."""
+    global _batcher
+    if _batcher is None:
+        with _batcher_lock:
+            if _batcher is None:
+                _batcher = RerankBatcher(
+                    score_fn=lambda chunk: _score_pairs(chunk, len(chunk)),
+                    max_batch_size=getattr(CONFIG, "reranker_batch_size", 32),
+                    max_wait_ms=getattr(CONFIG, "reranker_max_wait_ms", 5),
+                    max_queue_size=getattr(CONFIG, "reranker_queue_size", 64),
+                    queue_timeout_ms=getattr(CONFIG, "reranker_queue_timeout_ms", 100),
+                )
+                register_queue_probe("rerank", _batcher.queue_depth)
+    return _batcher
+
+
+def rerank(query: str, candidates: list[dict], top_n: int = 10, batch_size: int | None = None, max_length: int | None = None) -> list[dict]:
+    """Реализация bge-reranker-v2-m3 на CPU с пакетной обработкой.
+    - batch_size: размер батча для ускорения токенизации/инференса
+    - max_length: максимальная длина токенов документа (усечение текста)
+    Возвращает top_n документов, отсортированных по релевантности к запросу.
+
+    При RERANKER_BATCHING_ENABLED пары уходят в общий воркер (см. get_rerank_batcher),
+    batch_size тогда задаётся воркером. Если очередь воркера переполнена,
+    поднимается RerankOverloadedError — вызывающий решает, пропустить ли rerank.
+    """
+    if not candidates:
+        return []
+
+    pairs = [[query, _doc_text(c, max_length)] for c in candidates]
+
+    # Пакетная обработка
+    try:
+        all_scores = _score(pairs, batch_size, getattr(CONFIG, "reranker_job_timeout_s", 30.0))
+    except RerankOverloadedError:
+        raise
+    except Exception as e:
+        logger.error(f"Reranker scoring failed completely: {e}")
+        return candidates[:top_n]
+
+    return _apply_scores(candidates, all_scores, top_n)
+
+
+def rerank_many(
+    jobs: list[tuple[str, list[dict], int]],
+    max_length: int | None = None,
+) -> list[list[dict]]:
+    """Rerank сразу для нескольких запросов (пакетный /v1/chat/batch).
+
+    Пары всех запросов упаковываются в одно задание, которое модель проходит
+    полными батчами reranker_batch_size, вместо частично заполненного батча
+    на каждый запрос. Для каждого запроса результат тот же, что у rerank.
+
+    Args:
+        jobs: (query, candidates, top_n) для каждого запроса
+    """
+    pairs = [[query, _doc_text(c, max_length)] for query, candidates, _top_n in jobs for c in candidates]
+    if not pairs:
+        return [[] for _ in jobs]
+
+    # Таймаут одного задания рассчитан на один запрос, здесь их len(jobs)
+    timeout = getattr(CONFIG, "reranker_job_timeout_s", 30.0) * max(1, len(jobs))
+    try:
+        all_scores = _score(pairs, None, timeout)
+    except RerankOverloadedError:
+        raise
+    except Exception as e:
+        logger.error(f"Reranker scoring failed completely: {e}")
+        return [candidates[:top_n] for _query, candidates, top_n in jobs]
+
+    results: list[list[dict]] = []
+    offset = 0
+    for _query, candidates, top_n in jobs:
+        scores = all_scores[offset : offset + len(candidates)]
+        offset += len(candidates)
+        results.append(_apply_scores(candidates, scores, top_n) if candidates else [])
+    return results
+
+
+def _doc_text(c: dict, max_length: int | None) -> str:
+    """Текст документа для пары (с отсечением)."""
+    payload = (c.get("payload", {}) or {})
+    text = payload.get("text") or payload.get("title") or ""
+    if not text:
+        return ""
+    if max_length and isinstance(max_length, int) and max_length > 0:
+        # Простое усечение по символам (чтобы не тянуть лишнее в токенайзер)
+        return text[: max_length]
+    return text
+
+
+def _score(pairs: list[list[str]], batch_size: int | None, timeout: float) -> list[float]:
+    bs = batch_size or getattr(CONFIG, "reranker_batch_size", 16)
+    batched = getattr(CONFIG, "reranker_batching_enabled", True)
+    # Батчи общего воркера не входят в спан запроса: время ожидания очереди видно здесь
+    with span("rerank.score", pairs=len(pairs), batch_size=bs, batched=bool(batched)):
+        if batched:
+            _get_reranker()
+            return get_rerank_batcher().score(pairs, timeout=timeout)
+        return _score_pairs(pairs, bs)
+
 
+def _apply_scores(candidates: list[dict], scores: list[float], top_n: int) -> list[dict]:
     # Присваиваем и сортируем
-    for i, s in enumerate(all_scores):
+    for i, s in enumerate(scores):
         candidates[i]["rerank_score"] = s
     candidates.sort(key=lambda x: x.get("rerank_score", 0.0), reverse=True)
     return candidates[:top_n]
@@ -0,0 +1,210 @@
+"""
+Общий воркер реранкера с микро-батчингом.
+
+Параллельные запросы кладут свои пары (query, doc) в ограниченную очередь,
+единственный фоновый поток собирает их в общий батч (до max_batch_size пар или
+max_wait_ms ожидания), прогоняет модель один раз и раздаёт скоры обратно
+по запросам. При переполнении очереди запрос сразу получает
+RerankOverloadedError вместо бесконечного ожидания.
+"""
+from __future__ import annotations
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Sequence
+
+from loguru import logger
+
+from app.infrastructure.metrics import rerank_batch_size, rerank_queue_depth, rerank_rejected_total
+
+
+ScoreFn = Callable[[List[List[str]]], List[float]]
+
+
+class RerankOverloadedError(RuntimeError):
+    """Очередь реранкера переполнена или ожидание результата превысило лимит."""
+
+
+@dataclass
+class _RerankJob:
+    pairs: List[List[str]]
+    future: Future = field(default_factory=Future)
+    enqueued_at: float = field(default_factory=time.perf_counter)
+
+
+_STOP = object()
+
+
+class RerankBatcher:
+    """Упаковывает пары от разных запросов в общие батчи для одной модели."""
+
+    def __init__(
+        self,
+        score_fn: ScoreFn,
+        max_batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        max_queue_size: int = 64,
+        queue_timeout_ms: float = 100.0,
+        name: str = "reranker",
+    ):
+        if max_batch_size <= 0:
+            raise ValueError("max_batch_size must be positive")
+        if max_queue_size <= 0:
+            raise ValueError("max_queue_size must be positive")
+        self.score_fn = score_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.queue_timeout = max(0.0, queue_timeout_ms) / 1000.0
+        self.name = name
+        self._queue: "queue.Queue[object]" = queue.Queue(maxsize=max_queue_size)
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"batches": 0, "pairs": 0, "jobs": 0, "rejected": 0, "failed_batches": 0}
+
+    # ------------------------------------------------------------------ API
+
+    def submit(self, pairs: Sequence[Sequence[str]]) -> Future:
+        """Поставить пары в очередь; возвращает Future со списком скоров."""
+        job = _RerankJob(pairs=[list(p) for p in pairs])
+        if not job.pairs:
+            job.future.set_result([])
+            return job.future
+
+        self._ensure_worker()
+        try:
+            if self.queue_timeout > 0:
+                self._queue.put(job, timeout=self.queue_timeout)
+            else:
+                self._queue.put_nowait(job)
+        except queue.Full:
+            self._reject("queue_full")
+            raise RerankOverloadedError(
+                f"{self.name} queue is full ({self._queue.maxsize} jobs waiting)"
+            ) from None
+        rerank_queue_depth.set(self._queue.qsize())
+        return job.future
+
+    def score(self, pairs: Sequence[Sequence[str]], timeout: Optional[float] = None) -> List[float]:
+        """Синхронно получить скоры для пар через общий батч."""
+        future = self.submit(pairs)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._reject("timeout")
+            raise RerankOverloadedError(f"{self.name} did not answer within {timeout}s") from None
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self.queue_depth()
+        stats["avg_batch_pairs"] = round(stats["pairs"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        """Остановить воркер; необработанные задания завершаются с ошибкой."""
+        worker = self._worker
+        if worker is None:
+            return
+        self._queue.put(_STOP)
+        worker.join(timeout=timeout)
+        self._worker = None
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, _RerankJob) and not item.future.done():
+                item.future.set_exception(RerankOverloadedError(f"{self.name} is shut down"))
+
+    # ------------------------------------------------------------- internals
+
+    def _reject(self, reason: str) -> None:
+        with self._stats_lock:
+            self._stats["rejected"] += 1
+        rerank_rejected_total.labels(reason=reason).inc()
+        logger.warning(f"Rerank job rejected by {self.name}: {reason}")
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(
+                    target=self._run, name=f"{self.name}-batcher", daemon=True
+                )
+                self._worker.start()
+
+    def _collect_batch(self, first: _RerankJob) -> tuple[list[_RerankJob], bool]:
+        """Добрать задания к первому, пока не заполнен батч или не истекло окно."""
+        jobs = [first]
+        total = len(first.pairs)
+        deadline = time.perf_counter() + self.max_wait
+        while total < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return jobs, True
+            jobs.append(item)  # type: ignore[arg-type]
+            total += len(item.pairs)  # type: ignore[union-attr]
+        return jobs, False
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            jobs, stop = self._collect_batch(item)  # type: ignore[arg-type]
+            rerank_queue_depth.set(self._queue.qsize())
+            self._process(jobs)
+            if stop:
+                return
+
+    def _process(self, jobs: list[_RerankJob]) -> None:
+        # Задания, отменённые по таймауту, не тратят время модели
+        live = [job for job in jobs if job.future.set_running_or_notify_cancel()]
+        if not live:
+            return
+
+        flat: List[List[str]] = []
+        for job in live:
+            flat.extend(job.pairs)
+
+        try:
+            scores: List[float] = []
+            for i in range(0, len(flat), self.max_batch_size):
+                chunk = flat[i : i + self.max_batch_size]
+                rerank_batch_size.observe(len(chunk))
+                chunk_scores = [float(s) for s in self.score_fn(chunk)]
+                if len(chunk_scores) != len(chunk):
+                    raise RuntimeError(
+                        f"score_fn returned {len(chunk_scores)} scores for {len(chunk)} pairs"
+                    )
+                scores.extend(chunk_scores)
+        except Exception as e:
+            logger.warning(f"Rerank batch of {len(flat)} pairs failed: {e}")
+            with self._stats_lock:
+                self._stats["failed_batches"] += 1
+            for job in live:
+                job.future.set_exception(e)
+            return
+
+        with self._stats_lock:
+            self._stats["batches"] += 1
+            self._stats["pairs"] += len(flat)
+            self._stats["jobs"] += len(live)
+
+        offset = 0
+        for job in live:
+            job.future.set_result(scores[offset : offset + len(job.pairs)])
+            offset += len(job.pairs)
@@ -9,16 +9,21 @@
 """
 
 from typing import Any, Callable, TypedDict
+import asyncio
+import threading
 from copy import deepcopy
 import importlib
 import importlib.util
 
 from qdrant_client import QdrantClient
-from qdrant_client.models import PointStruct, Filter, SparseVector, SearchParams, NamedSparseVector, FieldCondition, MatchValue
+from qdrant_client.models import PointStruct, Filter, SparseVector, SearchParams, NamedSparseVector, NamedVector, SearchRequest, FieldCondition, MatchValue
 from loguru import logger
 
 from app.config import CONFIG
 from app.config.boosting_config import get_boosting_config
+from app.infrastructure.circuit_breaker import CircuitBreakerError, qdrant_circuit_breaker
+from app.infrastructure.single_flight import SingleFlight
+from app.infrastructure.tracing import span
 from app.retrieval.boosting import boost_hits
 
 # Optional tiktoken import (для оценки токенов при auto-merge)
@@ -86,6 +91,9 @@ if CACHETOOLS_AVAILABLE:
 else:
     _doc_chunk_cache: Any = {}
     logger.debug("Using simple dict cache without TTL (install cachetools for TTL support)")
+# TTLCache не потокобезопасен, а чанки подгружаются и фоновым prefetch
+_doc_chunk_cache_lock = threading.Lock()
+_doc_chunk_flight = SingleFlight("doc_chunks")
 
 
 def clear_chunk_cache():
@@ -135,6 +143,104 @@ def to_hit(res) -> list[dict]:
     return out
 
 
+def _search_requests(
+    query_dense: list[float],
+    query_sparse: dict,
+    k: int,
+    metadata_filter: Filter | None = None,
+) -> tuple[dict[str, Any], dict[str, Any] | None]:
+    """
+    Параметры dense- и sparse-запросов к Qdrant (общие для sync и async поиска).
+
+    Returns:
+        (kwargs dense-поиска, kwargs sparse-поиска или None, если sparse не нужен)
+    """
+    params = SearchParams(hnsw_ef=EF_SEARCH)
+    # Увеличиваем k для лучшего recall в RRF
+    k_dense = int(k * 2)
+    k_sparse = int(k * 2)
+    logger.debug(f"Hybrid search: k={k}, k_dense={k_dense}, k_sparse={k_sparse}, sparse_enabled={CONFIG.use_sparse}")
+
+    dense_request = dict(
+        collection_name=COLLECTION,
+        query_vector=("dense", query_dense),
+        with_payload=True,
+        limit=k_dense,
+        search_params=params,
+        query_filter=metadata_filter,
+    )
+
+    indices = list((query_sparse or {}).get("indices", []))
+    values = list((query_sparse or {}).get("values", []))
+    if not (indices and values and CONFIG.use_sparse):
+        logger.debug("Skipping sparse search: no indices/values or disabled")
+        return dense_request, None
+
+    sparse_request = dict(
+        collection_name=COLLECTION,
+        query_vector=NamedSparseVector(
+            name="sparse",
+            vector=SparseVector(indices=indices, values=values)
+        ),
+        with_payload=True,
+        limit=k_sparse,
+        search_params=params,
+        query_filter=metadata_filter,
+    )
+    return dense_request, sparse_request
+
+
+def _fuse_and_boost(
+    dense_res: list,
+    sparse_res: list,
+    k: int,
+    boosts: dict[str, float] | None = None,
+    group_boosts: dict[str, float] | None = None,
+    routing_result: dict | None = None,
+) -> list[dict]:
+    """RRF-фьюжн dense/sparse результатов и boosting (общая часть sync и async поиска)."""
+    hits = {"dense_hits": len(dense_res), "sparse_hits": len(sparse_res)}
+    with span("retrieval.fuse", k=k, **hits) as fuse_span:
+        fused = _fuse_and_boost_hits(dense_res, sparse_res, boosts, group_boosts, routing_result)
+        fuse_span.set("candidates", len(fused))
+    logger.debug(f"Final results: {len(fused[:k])} items")
+    return fused[:k]
+
+
+def _fuse_and_boost_hits(
+    dense_res: list,
+    sparse_res: list,
+    boosts: dict[str, float] | None,
+    group_boosts: dict[str, float] | None,
+    routing_result: dict | None,
+) -> list[dict]:
+    normalized_group_boosts: dict[str, float] = {}
+    if group_boosts:
+        normalized_group_boosts = {
+            str(key).lower().strip(): float(value)
+            for key, value in group_boosts.items()
+            if value
+        }
+
+    # RRF fusion
+    try:
+        fused = rrf_fuse(to_hit(dense_res), to_hit(sparse_res))
+        logger.debug(f"RRF fusion returned {len(fused)} results")
+    except Exception as e:
+        logger.error(f"RRF fusion failed: {e}")
+        # Fallback to dense only
+        fused = to_hit(dense_res)
+
+    boosting_cfg = get_boosting_config()
+    boost_context = {
+        "boosts": boosts or {},
+        "group_boosts": normalized_group_boosts,
+    }
+    if routing_result:
+        boost_context["routing_result"] = routing_result
+    return boost_hits(fused, boosting_cfg, boost_context)
+
+
 def hybrid_search(
     query_dense: list[float],
     query_sparse: dict,
@@ -162,97 +268,222 @@ def hybrid_search(
     - routing_result: результат тематического роутера (домен/секция/платформа);
     - metadata_filter: предрасчитанный фильтр по метаданным от оркестратора.
     """
-    try:
-        from loguru import logger
-    except ImportError:
-        import logging
-        logger = logging.getLogger(__name__)
+    dense_res, sparse_res = hybrid_search_raw(query_dense, query_sparse, k, metadata_filter)
+    return _fuse_and_boost(dense_res, sparse_res, k, boosts, group_boosts, routing_result)
 
-    boosts = boosts or {}
-    normalized_group_boosts: dict[str, float] = {}
-    if group_boosts:
-        normalized_group_boosts = {
-            str(key).lower().strip(): float(value)
-            for key, value in group_boosts.items()
-            if value
-        }
-    params = SearchParams(hnsw_ef=EF_SEARCH)
-    qfilter = metadata_filter
 
-    # Увеличиваем k для лучшего recall в RRF
-    k_dense = int(k * 2)
-    k_sparse = int(k * 2)
+def hybrid_search_raw(
+    query_dense: list[float],
+    query_sparse: dict,
+    k: int,
+    metadata_filter: Filter | None = None,
+) -> tuple[list, list]:
+    """
+    Запросы hybrid_search к Qdrant без фьюжна и boosting.
 
-    if hasattr(logger, 'debug'):
-        logger.debug(f"Hybrid search: k={k}, k_dense={k_dense}, k_sparse={k_sparse}, sparse_enabled={CONFIG.use_sparse}")
+    Не зависит от результата роутинга, поэтому оркестратор может запустить
+    его, не дожидаясь роутера (спекулятивный поиск без фильтра), и затем
+    применить fuse_hybrid_results.
 
-    # Dense search
+    Returns:
+        (dense-результаты, sparse-результаты)
+    """
+    dense_request, sparse_request = _search_requests(query_dense, query_sparse, k, metadata_filter)
+
+    # Dense search. Вызовы Qdrant идут через circuit breaker: при открытом
+    # breaker CircuitBreakerError пробрасывается, и запрос сразу завершается
+    # ошибкой поиска вместо ожидания таймаутов недоступного кластера.
     try:
-        dense_res = client.search(
-            collection_name=COLLECTION,
-            query_vector=("dense", query_dense),
-            with_payload=True,
-            limit=k_dense,
-            search_params=params,
-            query_filter=qfilter,
-        )
-        if hasattr(logger, 'debug'):
-            logger.debug(f"Dense search returned {len(dense_res)} results")
+        with span("retrieval.dense", limit=dense_request["limit"]) as dense_span:
+            dense_res = qdrant_circuit_breaker.call(client.search, **dense_request)
+            dense_span.set("hits", len(dense_res))
+        logger.debug(f"Dense search returned {len(dense_res)} results")
+    except CircuitBreakerError:
+        raise
     except Exception as e:
         logger.error(f"Dense search failed: {e}")
         dense_res = []
 
-    # Sparse search - правильная реализация
     sparse_res = []
-    indices = list((query_sparse or {}).get("indices", []))
-    values = list((query_sparse or {}).get("values", []))
-
-    if indices and values and CONFIG.use_sparse:
+    if sparse_request is not None:
         try:
-            # Создаем правильный NamedSparseVector
-            sparse_vector = NamedSparseVector(
-                name="sparse",
-                vector=SparseVector(indices=indices, values=values)
-            )
-            sparse_res = client.search(
-                collection_name=COLLECTION,
-                query_vector=sparse_vector,
-                with_payload=True,
-                limit=k_sparse,
-                search_params=params,
-                query_filter=qfilter,
-            )
-            if hasattr(logger, 'debug'):
-                logger.debug(f"Sparse search returned {len(sparse_res)} results")
+            with span("retrieval.sparse", limit=sparse_request["limit"]) as sparse_span:
+                sparse_res = qdrant_circuit_breaker.call(client.search, **sparse_request)
+                sparse_span.set("hits", len(sparse_res))
+            logger.debug(f"Sparse search returned {len(sparse_res)} results")
+        except CircuitBreakerError:
+            raise
         except Exception as e:
             logger.warning(f"Sparse search failed: {e}")
             sparse_res = []
-    else:
-        if hasattr(logger, 'debug'):
-            logger.debug("Skipping sparse search: no indices/values or disabled")
 
-    # RRF fusion
+    return dense_res, sparse_res
+
+
+def hybrid_search_raw_batch(
+    queries: list[tuple[list[float], dict, int, Filter | None]],
+) -> list[tuple[list, list]]:
+    """
+    Пакетный hybrid_search_raw: dense- и sparse-запросы всех вопросов уходят
+    в Qdrant одним вызовом search_batch вместо двух запросов на вопрос.
+
+    Args:
+        queries: (query_dense, query_sparse, k, metadata_filter) для каждого вопроса
+
+    Returns:
+        (dense-результаты, sparse-результаты) в порядке queries
+    """
+    requests: list[SearchRequest] = []
+    slots: list[tuple[int, int | None]] = []
+    for query_dense, query_sparse, k, metadata_filter in queries:
+        dense_request, sparse_request = _search_requests(query_dense, query_sparse, k, metadata_filter)
+        dense_slot = len(requests)
+        requests.append(_to_search_request(dense_request))
+        sparse_slot = None
+        if sparse_request is not None:
+            sparse_slot = len(requests)
+            requests.append(_to_search_request(sparse_request))
+        slots.append((dense_slot, sparse_slot))
+    if not requests:
+        return []
+
+    # Как и в hybrid_search: открытый breaker пробрасывается, прочие ошибки дают пустой результат
     try:
-        fused = rrf_fuse(to_hit(dense_res), to_hit(sparse_res))
-        if hasattr(logger, 'debug'):
-            logger.debug(f"RRF fusion returned {len(fused)} results")
+        with span("retrieval.search_batch", queries=len(queries), requests=len(requests)) as batch:
+            responses = qdrant_circuit_breaker.call(
+                client.search_batch, collection_name=COLLECTION, requests=requests
+            )
+            batch.set("hits", sum(len(response) for response in responses))
+        logger.debug(f"Batch search returned results for {len(requests)} requests ({len(queries)} queries)")
+    except CircuitBreakerError:
+        raise
     except Exception as e:
-        logger.error(f"RRF fusion failed: {e}")
-        # Fallback to dense only
-        fused = to_hit(dense_res)
+        logger.error(f"Batch search failed: {e}")
+        return [([], []) for _ in queries]
 
-    boosting_cfg = get_boosting_config()
-    boost_context = {
-        "boosts": boosts or {},
-        "group_boosts": normalized_group_boosts,
-    }
-    if routing_result:
-        boost_context["routing_result"] = routing_result
-    fused = boost_hits(fused, boosting_cfg, boost_context)
+    return [
+        (responses[dense_slot], responses[sparse_slot] if sparse_slot is not None else [])
+        for dense_slot, sparse_slot in slots
+    ]
 
-    if hasattr(logger, 'debug'):
-        logger.debug(f"Final results: {len(fused[:k])} items")
-    return fused[:k]
+
+def _to_search_request(request: dict[str, Any]) -> SearchRequest:
+    """Параметры client.search из _search_requests в формате search_batch."""
+    vector = request["query_vector"]
+    if isinstance(vector, tuple):
+        name, values = vector
+        vector = NamedVector(name=name, vector=values)
+    return SearchRequest(
+        vector=vector,
+        filter=request["query_filter"],
+        params=request["search_params"],
+        limit=request["limit"],
+        with_payload=request["with_payload"],
+    )
+
+
+def fuse_hybrid_results(
+    raw: tuple[list, list],
+    k: int,
+    boosts: dict[str, float] | None = None,
+    group_boosts: dict[str, float] | None = None,
+    routing_result: dict | None = None,
+) -> list[dict]:
+    """RRF-фьюжн и boosting для результата hybrid_search_raw."""
+    dense_res, sparse_res = raw
+    return _fuse_and_boost(dense_res, sparse_res, k, boosts, group_boosts, routing_result)
+
+
+# --- Асинхронный поиск ---------------------------------------------------------
+
+_async_client: Any = None
+_async_client_loop: Any = None
+_async_client_lock = threading.Lock()
+
+
+async def get_async_client() -> Any:
+    """
+    AsyncQdrantClient для текущего event loop.
+
+    Клиент привязан к loop, в котором создан (его HTTP-соединения живут в
+    этом loop), поэтому при смене loop создаётся заново, а прежний закрывается.
+    """
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    stale = None
+    with _async_client_lock:
+        if _async_client is None or _async_client_loop is not loop:
+            from qdrant_client import AsyncQdrantClient
+
+            stale = (_async_client, _async_client_loop)
+            _async_client = AsyncQdrantClient(url=CONFIG.qdrant_url, api_key=CONFIG.qdrant_api_key or None)
+            _async_client_loop = loop
+        client = _async_client
+    if stale is not None and stale[0] is not None:
+        await _close_async_client(*stale)
+    return client
+
+
+async def close_async_client() -> None:
+    """Закрывает AsyncQdrantClient (при остановке ASGI-приложения)."""
+    global _async_client, _async_client_loop
+    with _async_client_lock:
+        client, loop = _async_client, _async_client_loop
+        _async_client = _async_client_loop = None
+    if client is not None:
+        await _close_async_client(client, loop)
+
+
+async def _close_async_client(client: Any, loop: Any) -> None:
+    try:
+        if loop is not None and loop is not asyncio.get_running_loop() and loop.is_running():
+            # Соединения живут в другом работающем loop — закрываем там же, не дожидаясь
+            asyncio.run_coroutine_threadsafe(client.close(), loop)
+        else:
+            await client.close()
+    except Exception as e:
+        logger.debug(f"Failed to close AsyncQdrantClient: {e}")
+
+
+async def hybrid_search_async(
+    query_dense: list[float],
+    query_sparse: dict,
+    k: int,
+    boosts: dict[str, float] | None = None,
+    group_boosts: dict[str, float] | None = None,
+    routing_result: dict | None = None,
+    metadata_filter: Filter | None = None,
+) -> list[dict]:
+    """
+    Асинхронный hybrid_search: dense и sparse запросы идут в Qdrant
+    одновременно через AsyncQdrantClient, не занимая поток на время ожидания.
+    Семантика ошибок та же, что у hybrid_search.
+    """
+    dense_request, sparse_request = _search_requests(query_dense, query_sparse, k, metadata_filter)
+    async_client = await get_async_client()
+
+    searches = [qdrant_circuit_breaker.call_async(async_client.search, **dense_request)]
+    if sparse_request is not None:
+        searches.append(qdrant_circuit_breaker.call_async(async_client.search, **sparse_request))
+    limit = dense_request["limit"]
+    with span("retrieval.search_async", limit=limit, requests=len(searches)) as search_span:
+        results = await asyncio.gather(*searches, return_exceptions=True)
+        search_span.set("hits", sum(len(r) for r in results if not isinstance(r, BaseException)))
+
+    for result in results:
+        if isinstance(result, CircuitBreakerError):
+            raise result
+
+    dense_res = results[0]
+    if isinstance(dense_res, BaseException):
+        logger.error(f"Dense search failed: {dense_res}")
+        dense_res = []
+    sparse_res = results[1] if len(results) > 1 else []
+    if isinstance(sparse_res, BaseException):
+        logger.warning(f"Sparse search failed: {sparse_res}")
+        sparse_res = []
+
+    return _fuse_and_boost(dense_res, sparse_res, k, boosts, group_boosts, routing_result)
 
 
 def _estimate_tokens(text: str) -> int:
@@ -292,16 +523,25 @@ def _fetch_doc_chunks(doc_id: str, fetch_fn: Callable[[str], list[dict[str, Any]
     if fetch_fn is not None:
         return fetch_fn(doc_id)
 
-    if doc_id in _doc_chunk_cache:
-        return _doc_chunk_cache[doc_id]
+    with _doc_chunk_cache_lock:
+        cached = _doc_chunk_cache.get(doc_id)
+    if cached is not None:
+        return cached
+
+    # prefetch и auto-merge могут запросить один документ одновременно
+    chunks, _shared = _doc_chunk_flight.do(doc_id, lambda: _scroll_doc_chunks(doc_id))
+    return chunks
+
 
+def _scroll_doc_chunks(doc_id: str) -> list[dict[str, Any]]:
     qfilter = Filter(must=[FieldCondition(key="doc_id", match=MatchValue(value=doc_id))])
     offset = None
     collected: list[Any] = []
 
     try:
         while True:
-            batch, offset = client.scroll(
+            batch, offset = qdrant_circuit_breaker.call(
+                client.scroll,
                 collection_name=COLLECTION,
                 scroll_filter=qfilter,
                 with_payload=True,
@@ -327,10 +567,29 @@ def _fetch_doc_chunks(doc_id: str, fetch_fn: Callable[[str], list[dict[str, Any]
         })
 
     chunks.sort(key=lambda x: x["payload"].get("chunk_index", 0))
-    _doc_chunk_cache[doc_id] = chunks
+    with _doc_chunk_cache_lock:
+        _doc_chunk_cache[doc_id] = chunks
     return chunks
 
 
+def prefetch_doc_chunks(hits: list[dict], max_docs: int) -> int:
+    """
+    Заранее загружает в кэш чанки документов первых max_docs hit'ов, чтобы
+    auto_merge_neighbors после rerank не ждал Qdrant.
+
+    Returns:
+        Число документов, для которых чанки загружены
+    """
+    doc_ids: list[str] = []
+    for hit in hits:
+        doc_id = (hit.get("payload") or {}).get("doc_id")
+        if doc_id and doc_id not in doc_ids:
+            doc_ids.append(doc_id)
+            if len(doc_ids) >= max_docs:
+                break
+    return sum(1 for doc_id in doc_ids if _fetch_doc_chunks(doc_id))
+
+
 def _build_merged_doc(base_doc: dict, doc_chunks: list[dict[str, Any]], indices: list[int]) -> dict:
     """
     Строит новый документ на основе базового hit'а и списка индексов чанков.
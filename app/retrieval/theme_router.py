@@ -1,10 +1,14 @@
 from __future__ import annotations
 
 import json
+import math
 import os
+import threading
+import time
+from copy import deepcopy
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Sequence
 
 import yaml
 from loguru import logger
@@ -16,9 +20,19 @@ from app.services.core.llm_router import (
     _deepseek_complete,
 )
 from app.config import CONFIG
+from app.infrastructure.caching import InMemoryCache, cache_key
+from app.infrastructure.single_flight import SingleFlight
 
 
 THEMES_CONFIG_ENV = "THEMES_CONFIG_PATH"
+# Как часто проверять mtime themes.yaml (секунды)
+THEMES_RELOAD_CHECK_INTERVAL = 5.0
+# Режимы, результаты которых кэшируются (в них возможен вызов LLM)
+ROUTING_CACHE_MODES = ("llm", "vector")
+# Сколько одинаковый запрос ждёт уже идущего роутинга, прежде чем пойти в LLM сам
+ROUTING_WAIT_TIMEOUT = 30.0
+# Температура softmax для перевода косинусной близости в score ∈ [0, 1] в режиме vector
+VECTOR_SCORE_TEMPERATURE = 0.05
 DEFAULT_THEMES_CONFIG = Path(__file__).resolve().parent.parent / "config" / "themes.yaml"
 
 
@@ -59,7 +73,40 @@ class ThemesProvider:
     def __init__(self, config_path: Optional[Path] = None):
         path_env = os.getenv(THEMES_CONFIG_ENV)
         self.config_path = Path(path_env) if path_env else (config_path or DEFAULT_THEMES_CONFIG)
+        self._mtime = self._stat_mtime()
         self._themes = self._load()
+        self._checked_at = time.monotonic()
+        self._reload_lock = threading.Lock()
+        self.version = 0
+
+    def _stat_mtime(self) -> Optional[float]:
+        try:
+            return self.config_path.stat().st_mtime
+        except OSError:
+            return None
+
+    def refresh_if_changed(self, min_interval: float = THEMES_RELOAD_CHECK_INTERVAL) -> int:
+        """
+        Перечитывает themes.yaml, если файл изменился (stat не чаще раза в min_interval секунд).
+
+        Returns:
+            версия тем; увеличивается при каждой перезагрузке и используется
+            для инвалидации кэша роутинга
+        """
+        now = time.monotonic()
+        if now - self._checked_at < min_interval:
+            return self.version
+        with self._reload_lock:
+            if now - self._checked_at < min_interval:
+                return self.version
+            self._checked_at = now
+            mtime = self._stat_mtime()
+            if mtime != self._mtime:
+                self._mtime = mtime
+                self._themes = self._load()
+                self.version += 1
+                logger.info(f"Themes config {self.config_path} changed, reloaded {len(self._themes)} themes")
+        return self.version
 
     def _load(self) -> Dict[str, Theme]:
         if not self.config_path.exists():
@@ -102,16 +149,23 @@ KEYWORD_MAP = {
 }
 
 
-def route_query(query: str, user_metadata: Optional[Dict[str, Any]] = None) -> ThemeRoutingResult:
+def route_query(
+    query: str,
+    user_metadata: Optional[Dict[str, Any]] = None,
+    query_vector: Optional[Sequence[float]] = None,
+) -> ThemeRoutingResult:
     """
     Маршрутизирует пользовательский запрос к одной или нескольким тематикам.
 
     Режимы:
     - none: роутинг отключён, возвращается пустой результат;
     - heuristic: только эвристики;
-    - llm: LLM + fallback на эвристику.
+    - llm: LLM + fallback на эвристику;
+    - vector: близость dense-вектора запроса (query_vector) к центроидам тем,
+      LLM только при малом отрыве топ-1 от топ-2, без вектора — эвристика.
     """
     mode = (CONFIG.theme_router_mode or "heuristic").lower()
+    themes_version = THEMES_PROVIDER.refresh_if_changed()
     if mode == "none":
         result = ThemeRoutingResult(
             themes=[],
@@ -123,11 +177,138 @@ def route_query(query: str, user_metadata: Optional[Dict[str, Any]] = None) -> T
         result["top_score"] = 0.0
         result["second_score"] = 0.0
         return result
+    if mode in ROUTING_CACHE_MODES and getattr(CONFIG, "theme_router_cache_enabled", False):
+        return _route_cached(mode, query, user_metadata, query_vector, themes_version)
+    return _route_uncached(mode, query, user_metadata, query_vector)
+
+
+def _route_uncached(
+    mode: str,
+    query: str,
+    user_metadata: Optional[Dict[str, Any]],
+    query_vector: Optional[Sequence[float]],
+) -> ThemeRoutingResult:
     if mode == "llm":
         return _route_llm_mode(query, user_metadata)
+    if mode == "vector":
+        return _route_vector_mode(query, user_metadata, query_vector)
     return _heuristic_routing(query, user_metadata)
 
 
+# --- Кэш роутинга --------------------------------------------------------------
+
+_routing_cache: Optional[InMemoryCache] = None
+_routing_cache_version: Optional[Any] = None
+_routing_cache_lock = threading.Lock()
+_routing_flight = SingleFlight("theme_routing")
+_routing_stats = {"hits": 0, "misses": 0, "coalesced": 0}
+
+
+def normalize_routing_query(query: str) -> str:
+    """Ключ запроса для кэша: нижний регистр, схлопнутые пробелы, без пунктуации по краям."""
+    return " ".join((query or "").lower().split()).strip(" ?!.,;:")
+
+
+def _get_routing_cache(version: Any) -> InMemoryCache:
+    global _routing_cache, _routing_cache_version
+    with _routing_cache_lock:
+        if _routing_cache is None:
+            _routing_cache = InMemoryCache(int(getattr(CONFIG, "theme_router_cache_max_items", 2000)))
+        if version != _routing_cache_version:
+            # themes.yaml изменился (или сменился провайдер тем) — старые решения невалидны
+            _routing_cache.clear()
+            _routing_cache_version = version
+        return _routing_cache
+
+
+def _count_routing(name: str) -> None:
+    # Счётчики обновляются из потоков запросов: += без блокировки теряет инкременты
+    with _routing_cache_lock:
+        _routing_stats[name] += 1
+
+
+def _record_routing_cache(hit: bool) -> None:
+    _count_routing("hits" if hit else "misses")
+    try:
+        from app.infrastructure.metrics import get_metrics_collector
+
+        collector = get_metrics_collector()
+        if hit:
+            collector.record_cache_hit("theme_routing")
+        else:
+            collector.record_cache_miss("theme_routing")
+    except Exception:  # pragma: no cover - метрики не должны ломать роутинг
+        pass
+
+
+def _route_cached(
+    mode: str,
+    query: str,
+    user_metadata: Optional[Dict[str, Any]],
+    query_vector: Optional[Sequence[float]],
+    themes_version: int,
+) -> ThemeRoutingResult:
+    """
+    Роутинг через TTL-кэш и single-flight.
+
+    Ключ — режим, нормализованный запрос и user_metadata. Одновременные
+    одинаковые запросы делят один вызов LLM. Результаты с fallback на
+    эвристику не кэшируются, чтобы следующий запрос снова попробовал LLM.
+    """
+    version = (id(THEMES_PROVIDER), themes_version)
+    cache = _get_routing_cache(version)
+    key = cache_key(
+        "theme_route",
+        mode,
+        normalize_routing_query(query),
+        json.dumps(user_metadata or {}, sort_keys=True, ensure_ascii=False, default=str),
+    )
+    with _routing_cache_lock:
+        cached_result = cache.get(key)
+    if cached_result is not None:
+        _record_routing_cache(hit=True)
+        result = deepcopy(cached_result)
+        result["cache_hit"] = True
+        return result
+
+    _record_routing_cache(hit=False)
+
+    def compute() -> ThemeRoutingResult:
+        computed = _route_uncached(mode, query, user_metadata, query_vector)
+        if "fallback_from" not in computed:
+            with _routing_cache_lock:
+                cache.set(key, computed, int(getattr(CONFIG, "theme_router_cache_ttl_s", 600)))
+        return computed
+
+    result, shared = _routing_flight.do(key, compute, timeout=ROUTING_WAIT_TIMEOUT)
+    if shared:
+        _count_routing("coalesced")
+    return deepcopy(result)
+
+
+def get_routing_cache_stats() -> Dict[str, Any]:
+    """Статистика кэша роутинга: попадания, промахи, объединённые вызовы, hit rate."""
+    with _routing_cache_lock:
+        stats = dict(_routing_stats)
+        items = len(_routing_cache) if _routing_cache is not None else 0
+    total = stats["hits"] + stats["misses"]
+    return {
+        **stats,
+        "hit_rate": round(stats["hits"] / total, 4) if total else 0.0,
+        "items": items,
+        "in_flight": _routing_flight.in_flight(),
+    }
+
+
+def clear_routing_cache() -> None:
+    """Сбрасывает кэш и статистику роутинга."""
+    with _routing_cache_lock:
+        if _routing_cache is not None:
+            _routing_cache.clear()
+        for name in _routing_stats:
+            _routing_stats[name] = 0
+
+
 def _score_by_keywords(query_lower: str, theme: Theme) -> float:
     """
     Считает вклад ключевых слов в общий скор тематики.
@@ -285,6 +466,77 @@ def _route_llm_mode(query: str, user_metadata: Optional[Dict[str, Any]]) -> Them
     return result
 
 
+def _route_vector_mode(
+    query: str,
+    user_metadata: Optional[Dict[str, Any]],
+    query_vector: Optional[Sequence[float]],
+) -> ThemeRoutingResult:
+    """
+    Роутинг по центроидам тем (см. app.retrieval.vector_theme_router).
+
+    Если отрыв косинусной близости топ-1 от топ-2 меньше
+    THEME_ROUTER_VECTOR_MIN_MARGIN, решение передаётся LLM (при
+    THEME_ROUTER_VECTOR_LLM_FALLBACK), иначе выставляется requires_disambiguation.
+    """
+    ranked = []
+    if query_vector is not None:
+        try:
+            from app.retrieval.vector_theme_router import get_vector_theme_router
+
+            ranked = get_vector_theme_router().rank(query_vector, THEMES_PROVIDER)
+        except Exception as exc:
+            logger.warning(f"Vector theme routing failed, fallback to heuristics: {exc}")
+            ranked = []
+    if not ranked:
+        result = _heuristic_routing(query, user_metadata)
+        result.setdefault("fallback_from", "vector")
+        return result
+
+    top_similarity = ranked[0][1]
+    second_similarity = ranked[1][1] if len(ranked) > 1 else -1.0
+    margin = top_similarity - second_similarity
+    min_margin = float(getattr(CONFIG, "theme_router_vector_min_margin", 0.03))
+
+    if margin < min_margin and getattr(CONFIG, "theme_router_vector_llm_fallback", True):
+        llm_result = _try_llm_routing(query, user_metadata)
+        if llm_result:
+            llm_result["router"] = "vector+llm"
+            llm_result["vector_margin"] = margin
+            return llm_result
+
+    weights = [math.exp((similarity - top_similarity) / VECTOR_SCORE_TEMPERATURE) for _, similarity in ranked]
+    total = sum(weights) or 1.0
+    scores = {theme_id: weight / total for (theme_id, _), weight in zip(ranked, weights)}
+    primary_theme = ranked[0][0]
+
+    preferred_sections = []
+    preferred_platforms = []
+    preferred_domains = []
+    theme_obj = THEMES_PROVIDER.get_theme(primary_theme)
+    if theme_obj:
+        if theme_obj.section:
+            preferred_sections = [theme_obj.section]
+        if theme_obj.platform:
+            preferred_platforms = [theme_obj.platform]
+        if theme_obj.domain:
+            preferred_domains = [theme_obj.domain]
+
+    result = ThemeRoutingResult(
+        themes=[theme_id for theme_id, _ in ranked],
+        primary_theme=primary_theme,
+        scores=scores,
+        requires_disambiguation=margin < min_margin,
+        preferred_sections=preferred_sections,
+        preferred_platforms=preferred_platforms,
+        preferred_domains=preferred_domains,
+    )
+    result["router"] = "vector"
+    result["top_score"] = scores[primary_theme]
+    result["second_score"] = scores[ranked[1][0]] if len(ranked) > 1 else 0.0
+    result["vector_margin"] = margin
+    return result
+
+
 def _is_llm_routing_enabled() -> bool:
     """
     Проверяет, включён ли режим LLM для тематического роутинга.
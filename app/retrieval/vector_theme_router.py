@@ -0,0 +1,281 @@
+"""
+Векторный тематический роутер.
+
+Для каждой темы из themes.yaml заранее строится центроид в пространстве
+dense-эмбеддингов BGE-M3:
+- эмбеддинг описания темы (display_name, description, section/platform/role);
+- средний dense-вектор проиндексированных чанков темы (берутся из Qdrant
+  как есть, без повторного кодирования).
+
+Запрос классифицируется по косинусной близости его dense-вектора, который
+пайплайн всё равно вычисляет для поиска, поэтому роутинг не стоит ни
+одного вызова LLM и занимает микросекунды.
+
+Центроиды строятся вне пути запроса — при старте приложения (warmup) и в
+фоновом потоке, когда меняется themes.yaml или поколение коллекции
+(переиндексация). Пока идёт сборка, запросы используют прежние центроиды,
+а до первой сборки rank возвращает пустой список (роутинг по эвристикам).
+Сборка, в которой не удалось получить чанки хотя бы одной темы (например,
+открыт circuit breaker Qdrant), используется, но не считается готовой и
+повторяется не чаще раза в retry_interval_s.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from loguru import logger
+
+from app.config import CONFIG
+
+EmbedTextsFn = Callable[[List[str]], List[Sequence[float]]]
+FetchThemeVectorsFn = Callable[[Any, int], List[Sequence[float]]]
+RunInBackgroundFn = Callable[[Callable[[], None]], None]
+# Готовые центроиды: идентификаторы тем и матрица (строка i — центроид темы i), публикуются одним кортежем
+Centroids = Tuple[Tuple[str, ...], np.ndarray]
+
+# Как часто rank сверяет версию тем и поколение коллекции (секунды)
+SIGNATURE_CHECK_INTERVAL = 5.0
+
+# Поля payload, по которым чанк относится к теме (см. theme_router.infer_theme_id)
+_THEME_PAYLOAD_FIELDS = ("domain", "section", "platform", "role")
+
+
+def theme_description(theme: Any) -> str:
+    """Текст темы для эмбеддинга описания."""
+    parts = [theme.display_name]
+    if theme.description:
+        parts.append(theme.description)
+    details = ", ".join(
+        str(value) for value in (theme.section, theme.platform, theme.role) if value
+    )
+    if details:
+        parts.append(details)
+    return ". ".join(parts)
+
+
+def _default_embed_texts(texts: List[str]) -> List[Sequence[float]]:
+    from app.services.core.embeddings import embed_batch_optimized
+
+    result = embed_batch_optimized(texts, return_dense=True, return_sparse=False, context="query")
+    return list(result.get("dense_vecs") or [])
+
+
+def _default_fetch_theme_vectors(theme: Any, limit: int) -> List[Sequence[float]]:
+    """Dense-векторы проиндексированных чанков темы из Qdrant."""
+    from qdrant_client.models import FieldCondition, Filter, MatchValue
+
+    from app.infrastructure.circuit_breaker import qdrant_circuit_breaker
+    from app.retrieval.retrieval import COLLECTION, client
+
+    conditions = [
+        FieldCondition(key=field, match=MatchValue(value=getattr(theme, field)))
+        for field in _THEME_PAYLOAD_FIELDS
+        if getattr(theme, field, None)
+    ]
+    if not conditions:
+        return []
+    records, _offset = qdrant_circuit_breaker.call(
+        client.scroll,
+        collection_name=COLLECTION,
+        scroll_filter=Filter(must=conditions),
+        with_payload=False,
+        with_vectors=["dense"],
+        limit=limit,
+    )
+    vectors: List[Sequence[float]] = []
+    for record in records:
+        vector = getattr(record, "vector", None)
+        if isinstance(vector, dict):
+            vector = vector.get("dense")
+        if vector:
+            vectors.append(vector)
+    return vectors
+
+
+def _collection_generation() -> int:
+    try:
+        from app.infrastructure.caching import get_collection_generation
+
+        return get_collection_generation()
+    except Exception:  # pragma: no cover - без кэша переиндексация не отслеживается
+        return 0
+
+
+def _run_in_thread(job: Callable[[], None]) -> None:
+    threading.Thread(target=job, name="vector-theme-centroids", daemon=True).start()
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class VectorThemeRouter:
+    """Центроиды тем и классификация dense-вектора запроса."""
+
+    def __init__(
+        self,
+        embed_texts: Optional[EmbedTextsFn] = None,
+        fetch_theme_vectors: Optional[FetchThemeVectorsFn] = None,
+        samples_per_theme: int = 64,
+        description_weight: float = 0.3,
+        retry_interval_s: float = 30.0,
+        run_in_background: Optional[RunInBackgroundFn] = None,
+    ):
+        """
+        Args:
+            embed_texts: пакетное кодирование описаний тем (по умолчанию BGE-M3)
+            fetch_theme_vectors: dense-векторы чанков темы (по умолчанию scroll из Qdrant)
+            samples_per_theme: сколько чанков темы усреднять
+            description_weight: вес эмбеддинга описания в центроиде, если чанки найдены
+            retry_interval_s: пауза перед повтором неполной или упавшей сборки
+            run_in_background: запуск сборки вне запроса (по умолчанию — daemon-поток)
+        """
+        self._embed_texts = embed_texts or _default_embed_texts
+        self._fetch_theme_vectors = fetch_theme_vectors or _default_fetch_theme_vectors
+        self.samples_per_theme = samples_per_theme
+        self.description_weight = description_weight
+        self.retry_interval_s = retry_interval_s
+        self._run_in_background = run_in_background or _run_in_thread
+        self._centroids: Optional[Centroids] = None
+        self._signature: Optional[Tuple[Any, ...]] = None
+        self._checked_at = -float("inf")
+        self._retry_at = 0.0
+        self._building = False
+        self._lock = threading.Lock()
+
+    def build(self, themes: List[Any]) -> Tuple[Optional[Centroids], bool]:
+        """
+        Строит центроиды для списка тем.
+
+        Returns:
+            (центроиды или None, если тем нет; получены ли чанки всех тем)
+        """
+        if not themes:
+            return None, True
+        descriptions = self._embed_texts([theme_description(theme) for theme in themes])
+        complete = True
+        centroids: List[np.ndarray] = []
+        for theme, description_vec in zip(themes, descriptions):
+            description = _normalize(np.asarray(description_vec, dtype=np.float32))
+            try:
+                chunk_vectors = self._fetch_theme_vectors(theme, self.samples_per_theme)
+            except Exception as exc:
+                logger.warning(f"Vector theme router: failed to fetch chunks for {theme.theme_id}: {exc}")
+                chunk_vectors = []
+                complete = False
+            if chunk_vectors:
+                chunks_mean = _normalize(_normalize(np.asarray(chunk_vectors, dtype=np.float32)).mean(axis=0))
+                centroid = self.description_weight * description + (1 - self.description_weight) * chunks_mean
+            else:
+                centroid = description
+            centroids.append(_normalize(centroid))
+        logger.info(f"Vector theme router: built centroids for {len(themes)} themes (complete={complete})")
+        return (tuple(theme.theme_id for theme in themes), np.vstack(centroids)), complete
+
+    def _current_signature(self, themes_provider: Any) -> Tuple[Any, ...]:
+        refresh = getattr(themes_provider, "refresh_if_changed", None)
+        version = refresh() if refresh is not None else getattr(themes_provider, "version", 0)
+        theme_ids = tuple(theme.theme_id for theme in themes_provider.list_themes())
+        return (id(themes_provider), version, theme_ids, _collection_generation())
+
+    def warmup(self, themes_provider: Any) -> bool:
+        """
+        Синхронно строит и публикует центроиды (старт приложения, фоновая сборка).
+
+        Returns:
+            True — сборка полная; иначе она будет повторена
+        """
+        signature = self._current_signature(themes_provider)
+        try:
+            centroids, complete = self.build(themes_provider.list_themes())
+        except Exception as exc:
+            logger.warning(f"Vector theme router: failed to build centroids: {exc}")
+            with self._lock:
+                self._retry_at = time.monotonic() + self.retry_interval_s
+            return False
+        with self._lock:
+            self._centroids = centroids
+            self._signature = signature if complete else None
+            self._retry_at = 0.0 if complete else time.monotonic() + self.retry_interval_s
+        return complete
+
+    def schedule_build(self, themes_provider: Any) -> None:
+        """Запускает сборку в фоне (если она не идёт и не отложена после неудачи)."""
+        with self._lock:
+            if self._building or time.monotonic() < self._retry_at:
+                return
+            self._building = True
+
+        def job() -> None:
+            try:
+                self.warmup(themes_provider)
+            finally:
+                with self._lock:
+                    self._building = False
+
+        try:
+            self._run_in_background(job)
+        except Exception as exc:  # pragma: no cover - не удалось запустить поток
+            logger.warning(f"Vector theme router: failed to start centroid build: {exc}")
+            with self._lock:
+                self._building = False
+
+    def _refresh_if_stale(self, themes_provider: Any) -> None:
+        """Не чаще раза в SIGNATURE_CHECK_INTERVAL сверяет темы и поколение коллекции с собранными."""
+        now = time.monotonic()
+        fresh = self._centroids is not None and self._signature is not None
+        if fresh and now - self._checked_at < SIGNATURE_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if self._signature is None or self._current_signature(themes_provider) != self._signature:
+            self.schedule_build(themes_provider)
+
+    def rank(self, query_vector: Sequence[float], themes_provider: Any) -> List[Tuple[str, float]]:
+        """
+        Темы по убыванию косинусной близости к запросу.
+
+        Returns:
+            [(theme_id, cosine)], пустой список, если центроиды ещё не собраны
+        """
+        if query_vector is None or len(query_vector) == 0:
+            return []
+        self._refresh_if_stale(themes_provider)
+        centroids = self._centroids
+        if centroids is None:
+            return []
+        theme_ids, matrix = centroids
+        query = _normalize(np.asarray(query_vector, dtype=np.float32))
+        if query.shape[-1] != matrix.shape[-1]:
+            logger.warning("Vector theme router: query vector dimension does not match centroids")
+            return []
+        similarities = matrix @ query
+        order = np.argsort(-similarities)
+        return [(theme_ids[i], float(similarities[i])) for i in order]
+
+    def invalidate(self) -> None:
+        """Следующий rank запустит пересборку; до её окончания используются текущие центроиды."""
+        with self._lock:
+            self._signature = None
+            self._retry_at = 0.0
+
+
+_router: Optional[VectorThemeRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_vector_theme_router() -> VectorThemeRouter:
+    """Общий для процесса векторный роутер."""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = VectorThemeRouter(
+                    samples_per_theme=int(getattr(CONFIG, "theme_router_vector_samples", 64)),
+                    description_weight=float(getattr(CONFIG, "theme_router_vector_description_weight", 0.3)),
+                )
+    return _router
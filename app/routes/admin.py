@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 from loguru import logger
 from ingestion.run import run_unified_indexing
 from app.infrastructure import get_metrics_summary, reset_metrics, get_all_circuit_breakers, reset_all_circuit_breakers, get_cache_stats
@@ -9,6 +9,7 @@ from adapters.telegram import RateLimiter
 # Создаем глобальный экземпляр rate limiter
 rate_limiter = RateLimiter()
 from app.infrastructure import security_monitor
+from app.infrastructure.profiler import ProfilerBusyError, get_background_sampler, profile_for
 
 bp = Blueprint("admin", __name__)
 
@@ -393,6 +394,117 @@ def metrics_reset():
         return jsonify({"error": "metrics_reset_failed", "message": str(e)}), 500
 
 
+@bp.get("/profile")
+def profile():
+    """
+    Снять профиль CPU рабочего процесса сэмплирующим профилировщиком.
+
+    Запрос выполняется seconds секунд: всё это время стеки потоков процесса
+    снимаются каждые interval_ms миллисекунд. Потоки, ждущие блокировки,
+    очереди или сокета, не учитываются (include_idle=true — учитывать).
+    Одновременно снимается не больше одного профиля, длительность ограничена
+    PROFILER_MAX_DURATION_S.
+
+    ---
+    tags:
+      - Admin
+    parameters:
+      - in: query
+        name: seconds
+        type: number
+        required: false
+        default: 10
+        description: Длительность профилирования (секунды)
+      - in: query
+        name: interval_ms
+        type: number
+        required: false
+        default: 10
+        description: Интервал между выборками (мс)
+      - in: query
+        name: format
+        type: string
+        enum: [speedscope, collapsed]
+        required: false
+        default: speedscope
+        description: JSON для speedscope.app или collapsed stacks (flamegraph.pl)
+      - in: query
+        name: include_idle
+        type: boolean
+        required: false
+        default: false
+    produces:
+      - application/json
+      - text/plain
+    responses:
+      200:
+        description: Профиль в выбранном формате
+      400:
+        description: Некорректные параметры
+      409:
+        description: Профиль уже снимается другим запросом
+    """
+    invalid = {
+        "error": "invalid_parameters",
+        "message": "seconds and interval_ms must be positive numbers, format: speedscope or collapsed",
+    }
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval_ms = float(request.args.get("interval_ms", 10))
+    except ValueError:
+        return jsonify(invalid), 400
+    fmt = request.args.get("format", "speedscope")
+    if not (seconds > 0 and interval_ms > 0) or fmt not in ("speedscope", "collapsed"):
+        return jsonify(invalid), 400
+    include_idle = request.args.get("include_idle", "false").lower() in ("1", "true", "yes")
+
+    try:
+        result = profile_for(seconds, interval_ms / 1000.0, include_idle=include_idle)
+    except ProfilerBusyError as e:
+        return jsonify({"error": "profile_in_progress", "message": str(e)}), 409
+    except Exception as e:
+        logger.error(f"Profiling failed: {e}")
+        return jsonify({"error": "profile_failed", "message": str(e)}), 500
+
+    logger.info(f"Profiler: collected {result.samples} samples in {result.duration_s:.1f}s")
+    if fmt == "collapsed":
+        return Response(result.to_collapsed(), mimetype="text/plain")
+    return jsonify(result.to_speedscope())
+
+
+@bp.get("/profile/summary")
+def profile_summary():
+    """Горячие функции по данным фонового сэмплера за скользящее окно.
+
+    Фоновый сэмплер включается PROFILER_BACKGROUND_ENABLED; без него
+    ответ {"enabled": false}.
+
+    ---
+    tags:
+      - Admin
+    parameters:
+      - in: query
+        name: top
+        type: integer
+        required: false
+        default: 20
+    responses:
+      200:
+        description: Доли выборок функций (self_pct — в самой функции, total_pct — с вызываемыми)
+      500:
+        description: Ошибка
+    """
+    try:
+        sampler = get_background_sampler()
+        if sampler is None:
+            return jsonify({"enabled": False})
+        top = max(1, min(int(request.args.get("top", 20)), 200))
+        return jsonify(sampler.summary(top=top))
+    except Exception as e:
+        logger.error(f"Profile summary failed: {e}")
+        return jsonify({"error": "profile_summary_failed", "message": str(e)}), 500
+
+
 @bp.get("/circuit-breakers")
 def circuit_breakers():
     """Получить состояние Circuit Breakers.
@@ -450,6 +562,8 @@ def cache_status():
     """
     try:
         stats = get_cache_stats()
+        from app.retrieval.theme_router import get_routing_cache_stats
+        stats["theme_routing"] = get_routing_cache_stats()
         return jsonify(stats)
     except Exception as e:
         logger.error(f"Cache status failed: {e}")
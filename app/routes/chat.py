@@ -1,10 +1,21 @@
 ﻿from __future__ import annotations
 
-from flask import Blueprint, request, jsonify
+import json
+
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from loguru import logger
-from app.orchestration.orchestrator import handle_query
+from app.config import CONFIG
+from app.orchestration.batch import handle_batch
+from app.orchestration.orchestrator import handle_query, stream_query
 from app.utils import validate_query_data
 from app.infrastructure import validate_request, security_monitor
+from app.infrastructure.admission import (
+    AdmissionDecision,
+    admission,
+    admission_scope,
+    admission_ticket,
+    overloaded_response,
+)
 
 bp = Blueprint("chat", __name__)
 
@@ -24,6 +35,8 @@ def chat_query():
     .. versionadded:: 4.0.0
     .. versionchanged:: 4.3.0
        Добавлены поля interaction_id, security_warnings, auto_merged для источников
+    .. versionchanged:: 4.5.0
+       Admission control: при перегрузке облегчённый пайплайн или ответ 503 с Retry-After
 
     ---
     tags:
@@ -241,6 +254,28 @@ def chat_query():
             error: "rate_limit_exceeded"
             message: "Слишком много запросов. Попробуйте позже."
             retry_after: 60
+      503:
+        description: Сервис перегружен (admission control), запрос не принят; повторить через Retry-After секунд
+        headers:
+          Retry-After:
+            type: integer
+            description: Через сколько секунд повторить запрос
+        schema:
+          type: object
+          properties:
+            error:
+              type: string
+              enum: [overloaded]
+            message:
+              type: string
+            retry_after:
+              type: integer
+              description: Количество секунд до следующей попытки (как в Retry-After)
+        examples:
+          overloaded:
+            error: "overloaded"
+            message: "Сервис перегружен. Повторите запрос позже."
+            retry_after: 2
       500:
         description: Внутренняя ошибка сервера
         schema:
@@ -258,44 +293,23 @@ def chat_query():
             message: "Внутренняя ошибка сервера. Попробуйте позже."
     """
     try:
-        # Получение и валидация данных
-        payload = request.get_json(silent=True) or {}
-        validated_data, errors = validate_query_data(payload)
-
-        if errors:
-            logger.warning(f"Validation errors: {errors}")
-            return jsonify({
-                "error": "validation_failed",
-                "message": "Некорректные данные запроса",
-                "details": errors
-            }), 400
-
-        # Дополнительная проверка безопасности
-        user_id = validated_data.get("chat_id", "unknown")
-        security_result = validate_request(
-            user_id=user_id,
-            message=validated_data["message"],
-            channel=validated_data["channel"],
-            chat_id=validated_data["chat_id"]
-        )
-
-        if not security_result["is_valid"]:
-            logger.warning(f"Security validation failed for user {user_id}: {security_result['errors']}")
-            return jsonify({
-                "error": "security_validation_failed",
-                "message": "Запрос не прошел проверку безопасности",
-                "details": security_result["errors"]
-            }), 400
+        validated_data, security_result, error_response = _validate_chat_request()
+        if error_response is not None:
+            return error_response
 
         # Используем санитизированное сообщение
         sanitized_message = security_result["sanitized_message"]
 
-        # Обработка запроса
-        result = handle_query(
-            channel=validated_data["channel"],
-            chat_id=validated_data["chat_id"],
-            message=sanitized_message
-        )
+        # Обработка запроса (при перегрузке — облегчённый пайплайн или быстрый отказ)
+        with admission() as decision:
+            if decision is AdmissionDecision.REJECT:
+                body = overloaded_response()
+                return jsonify(body), 503, {"Retry-After": str(body["retry_after"])}
+            result = handle_query(
+                channel=validated_data["channel"],
+                chat_id=validated_data["chat_id"],
+                message=sanitized_message
+            )
 
         # Добавляем метаданные запроса
         result["request_id"] = request.headers.get("X-Request-ID", "unknown")
@@ -309,3 +323,273 @@ def chat_query():
             "error": "internal_error",
             "message": "Внутренняя ошибка сервера. Попробуйте позже."
         }), 500
+
+
+def _validate_chat_request():
+    """
+    Валидация и проверка безопасности тела запроса чата.
+
+    Returns:
+        (validated_data, security_result, None) или (None, None, flask-ответ 400)
+    """
+    validated_data, security_result, error = check_chat_payload(request.get_json(silent=True) or {})
+    if error is not None:
+        body, status = error
+        return None, None, (jsonify(body), status)
+    return validated_data, security_result, None
+
+
+def check_chat_payload(payload: dict):
+    """
+    Валидация и проверка безопасности тела запроса без привязки к Flask
+    (используется и ASGI-приложением).
+
+    Returns:
+        (validated_data, security_result, None) или (None, None, (тело ошибки, 400))
+    """
+    validated_data, errors = validate_query_data(payload)
+
+    if errors:
+        logger.warning(f"Validation errors: {errors}")
+        return None, None, ({
+            "error": "validation_failed",
+            "message": "Некорректные данные запроса",
+            "details": errors
+        }, 400)
+
+    # Дополнительная проверка безопасности
+    user_id = validated_data.get("chat_id", "unknown")
+    security_result = validate_request(
+        user_id=user_id,
+        message=validated_data["message"],
+        channel=validated_data["channel"],
+        chat_id=validated_data["chat_id"]
+    )
+
+    if not security_result["is_valid"]:
+        logger.warning(f"Security validation failed for user {user_id}: {security_result['errors']}")
+        return None, None, ({
+            "error": "security_validation_failed",
+            "message": "Запрос не прошел проверку безопасности",
+            "details": security_result["errors"]
+        }, 400)
+
+    return validated_data, security_result, None
+
+
+def _format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@bp.post("/stream")
+def chat_stream():
+    """
+    Потоковая обработка запроса чата (Server-Sent Events).
+
+    Принимает то же тело, что и /v1/chat/query. Retrieval выполняется целиком,
+    затем фрагменты ответа LLM отправляются по мере генерации (ссылки уже
+    отфильтрованы по whitelist источников).
+
+    .. versionadded:: 4.4.0
+
+    ---
+    tags:
+      - Chat
+    consumes:
+      - application/json
+    produces:
+      - text/event-stream
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          properties:
+            message:
+              type: string
+              example: "Как настроить маршрутизацию?"
+            channel:
+              type: string
+              enum: [telegram, web, api]
+              example: "web"
+            chat_id:
+              type: string
+              example: "123456789"
+          required: [message, channel, chat_id]
+    responses:
+      200:
+        description: |
+          Поток событий SSE:
+          - `token` — `{"text": "..."}`, очередной фрагмент Markdown-ответа;
+          - `done` — итог в формате /v1/chat/query (answer_markdown, sources, meta,
+            interaction_id, processing_time) плюс `timings` по этапам,
+            включая `time_to_first_token`;
+          - `error` — `{"error": "...", "message": "..."}`, поток завершается.
+      400:
+        description: Ошибка валидации входных данных или проверки безопасности
+      503:
+        description: Сервис перегружен (admission control), запрос не принят; повторить через Retry-After секунд
+    """
+    try:
+        validated_data, security_result, error_response = _validate_chat_request()
+        if error_response is not None:
+            return error_response
+    except Exception as e:
+        logger.error(f"Unexpected error in chat_stream: {e}", exc_info=True)
+        return jsonify({
+            "error": "internal_error",
+            "message": "Внутренняя ошибка сервера. Попробуйте позже."
+        }), 500
+
+    request_id = request.headers.get("X-Request-ID", "unknown")
+    security_warnings = security_result.get("warnings", [])
+
+    # Поток отдаётся после выхода из обработчика: место в in-flight держится до закрытия ответа
+    decision, release_admission = admission_ticket()
+    if decision is AdmissionDecision.REJECT:
+        body = overloaded_response()
+        return jsonify(body), 503, {"Retry-After": str(body["retry_after"])}
+
+    def event_stream():
+        try:
+            with admission_scope(decision):
+                for event in stream_query(
+                    channel=validated_data["channel"],
+                    chat_id=validated_data["chat_id"],
+                    message=security_result["sanitized_message"],
+                ):
+                    data = event["data"]
+                    if event["event"] in ("done", "error"):
+                        data["request_id"] = request_id
+                        data["security_warnings"] = security_warnings
+                    yield _format_sse(event["event"], data)
+        except Exception as e:
+            logger.error(f"Unexpected error in chat_stream: {e}", exc_info=True)
+            yield _format_sse("error", {
+                "error": "internal_error",
+                "message": "Внутренняя ошибка сервера. Попробуйте позже."
+            })
+
+    response = Response(
+        stream_with_context(event_stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(release_admission)
+    return response
+
+
+@bp.post("/batch")
+def chat_batch():
+    """
+    Пакетная обработка вопросов (регрессионные наборы, обновление FAQ).
+
+    Вопросы проходят ту же валидацию, что и /v1/chat/query. Эмбеддинги,
+    поиск и rerank выполняются общими батчами, вызовы LLM — с ограниченной
+    параллельностью (CHAT_BATCH_LLM_CONCURRENCY). Результаты отдаются
+    потоком NDJSON по мере готовности, в порядке завершения.
+
+    .. versionadded:: 4.5.0
+
+    ---
+    tags:
+      - Chat
+    consumes:
+      - application/json
+    produces:
+      - application/x-ndjson
+    parameters:
+      - in: body
+        name: body
+        required: true
+        schema:
+          type: object
+          properties:
+            messages:
+              type: array
+              description: Вопросы (не больше CHAT_BATCH_MAX_SIZE)
+              items:
+                type: string
+              example: ["Как настроить маршрутизацию?", "Как подключить Telegram?"]
+            channel:
+              type: string
+              enum: [telegram, web, api]
+              example: "api"
+            chat_id:
+              type: string
+              example: "regression-2024-10"
+          required: [messages]
+    responses:
+      200:
+        description: |
+          Поток NDJSON, по одной строке на вопрос:
+          `{"index": <номер вопроса>, ...}` — ответ в формате /v1/chat/query
+          или ошибка (`error`, `message`; для невалидного вопроса также `details`).
+      400:
+        description: Тело запроса не содержит списка вопросов или он слишком длинный
+      503:
+        description: |
+          Сервис перегружен (admission control): пакет занимает столько мест среди
+          запросов в работе, сколько вопросов обрабатывает одновременно, и не
+          принимается, пока сервис деградирует; повторить через Retry-After секунд
+    """
+    payload = request.get_json(silent=True) or {}
+    messages = payload.get("messages")
+    max_size = int(getattr(CONFIG, "chat_batch_max_size", 500))
+    if not isinstance(messages, list) or not messages or len(messages) > max_size:
+        return jsonify({
+            "error": "validation_failed",
+            "message": "Некорректные данные запроса",
+            "details": {"messages": [f"Expected a non-empty list of at most {max_size} questions"]},
+        }), 400
+
+    channel = payload.get("channel", "api")
+    chat_id = payload.get("chat_id", "batch")
+    request_id = request.headers.get("X-Request-ID", "unknown")
+    valid_indexes = []
+    valid_messages = []
+    rejected = []
+    for index, message in enumerate(messages):
+        validated_data, security_result, error = check_chat_payload(
+            {"message": message, "channel": channel, "chat_id": chat_id}
+        )
+        if error is not None:
+            body, _status = error
+            rejected.append({"index": index, **body})
+        else:
+            valid_indexes.append(index)
+            valid_messages.append(security_result["sanitized_message"])
+
+    # Пакет нельзя удешевить (регрессионные прогоны сравнивают ответы), поэтому в режиме degrade — отказ
+    # (место в in-flight — на каждый одновременно обрабатываемый вопрос)
+    weight = min(len(valid_messages), max(1, int(getattr(CONFIG, "chat_batch_llm_concurrency", 4))))
+    decision, release_admission = admission_ticket(weight, allow_degrade=False)
+    if decision is AdmissionDecision.REJECT:
+        body = overloaded_response()
+        return jsonify(body), 503, {"Retry-After": str(body["retry_after"])}
+
+    def result_stream():
+        for item in rejected:
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+        if not valid_messages:
+            return
+        try:
+            for result in handle_batch(channel=channel, chat_id=str(chat_id), messages=valid_messages):
+                result["index"] = valid_indexes[result["index"]]
+                result["request_id"] = request_id
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        except Exception as e:
+            logger.error(f"Unexpected error in chat_batch: {e}", exc_info=True)
+            yield json.dumps({
+                "error": "internal_error",
+                "message": "Внутренняя ошибка сервера. Попробуйте позже."
+            }, ensure_ascii=False) + "\n"
+
+    response = Response(
+        stream_with_context(result_stream()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    response.call_on_close(release_admission)
+    return response
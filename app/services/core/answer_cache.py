@@ -0,0 +1,120 @@
+"""
+Кэш готовых ответов LLM.
+
+Ключ ответа включает всё, от чего зависит генерация:
+- нормализованный запрос;
+- отпечаток контекста (id чанков и хэши их текстов после оптимизации);
+- версию промптов (llm_router.PROMPT_VERSION) и policy (инструкция темы);
+- настройки провайдеров (порядок, модели, бюджет контекста);
+- поколение коллекции — после переиндексации все старые ключи перестают
+  совпадать, отдельная инвалидация не нужна.
+
+Повторный FAQ-вопрос с тем же контекстом отдаётся без вызова LLM. Типы
+запросов из ANSWER_CACHE_SKIP_QUERY_TYPES (по умолчанию troubleshooting)
+не кэшируются. Interaction id и лог запроса формируются оркестратором как
+обычно, поэтому feedback и аналитика работают и для кэшированных ответов.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+from copy import deepcopy
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from app.config import CONFIG
+from app.infrastructure.caching import cache_key, cache_manager, get_collection_generation
+from app.infrastructure.metrics import get_metrics_collector
+from app.services.core.llm_router import PROMPT_VERSION
+
+ANSWER_CACHE_PREFIX = "answer"
+
+
+def _skipped_query_types() -> set[str]:
+    raw = getattr(CONFIG, "answer_cache_skip_query_types", "") or ""
+    return {item.strip().lower() for item in raw.split(",") if item.strip()}
+
+
+def context_fingerprint(docs: List[Dict[str, Any]]) -> str:
+    """Отпечаток контекста: id чанков и хэши их текстов в порядке подачи в LLM."""
+    digest = hashlib.sha1()
+    for doc in docs or []:
+        payload = doc.get("payload") or {}
+        doc_id = doc.get("id") or payload.get("chunk_id") or payload.get("doc_id") or ""
+        text = payload.get("text") or ""
+        digest.update(str(doc_id).encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(hashlib.sha1(str(text).encode("utf-8")).digest())
+    return digest.hexdigest()
+
+
+def _provider_settings() -> Dict[str, Any]:
+    return {
+        "default_llm": CONFIG.default_llm,
+        "models": [CONFIG.yandex_model, CONFIG.gpt5_model, CONFIG.deepseek_model, CONFIG.gigachat_model],
+        "context_packing": getattr(CONFIG, "llm_context_packing_enabled", False),
+        "context_max_tokens": getattr(CONFIG, "llm_context_max_tokens", None),
+    }
+
+
+def build_answer_cache_key(retrieval: Dict[str, Any]) -> Optional[str]:
+    """
+    Ключ кэша ответа для результата retrieval оркестратора.
+
+    Returns:
+        ключ или None, если кэш выключен или тип запроса исключён
+    """
+    if not getattr(CONFIG, "answer_cache_enabled", False):
+        return None
+    query_type = retrieval.get("query_type")
+    query_type_value = getattr(query_type, "value", query_type)
+    if query_type_value and str(query_type_value).lower() in _skipped_query_types():
+        return None
+    return cache_key(
+        ANSWER_CACHE_PREFIX,
+        " ".join(str(retrieval.get("normalized") or "").lower().split()),
+        context_fingerprint(retrieval.get("optimized_docs") or []),
+        PROMPT_VERSION,
+        json.dumps(retrieval.get("policy") or {}, sort_keys=True, ensure_ascii=False, default=str),
+        json.dumps(_provider_settings(), sort_keys=True, default=str),
+        get_collection_generation(),
+    )
+
+
+def get_cached_answer(key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Кэшированный ответ (копия) или None; метаданные помечаются cache_hit."""
+    if not key:
+        return None
+    cached = cache_manager.get(key)
+    metrics = get_metrics_collector()
+    if not isinstance(cached, dict) or not cached.get("answer_markdown"):
+        metrics.record_cache_miss(ANSWER_CACHE_PREFIX)
+        return None
+    metrics.record_cache_hit(ANSWER_CACHE_PREFIX)
+    answer = deepcopy(cached)
+    meta = dict(answer.get("meta") or {})
+    meta["cache_hit"] = True
+    answer["meta"] = meta
+    return answer
+
+
+def store_answer(key: Optional[str], answer_payload: Dict[str, Any]) -> None:
+    """Сохраняет успешный ответ; ответы-заглушки при отказе провайдеров не кэшируются."""
+    if not key or not answer_payload.get("answer_markdown"):
+        return
+    meta = answer_payload.get("meta") or {}
+    if meta.get("error") or not meta.get("provider"):
+        return
+    try:
+        cache_manager.set(
+            key,
+            deepcopy({
+                "answer_markdown": answer_payload["answer_markdown"],
+                "sources": answer_payload.get("sources", []),
+                "meta": meta,
+            }),
+            int(getattr(CONFIG, "answer_cache_ttl_s", 3600)),
+        )
+    except Exception as e:  # pragma: no cover - CacheManager сам логирует ошибки Redis
+        logger.warning(f"Failed to store answer in cache: {e}")
@@ -0,0 +1,250 @@
+"""
+Упаковка контекста для LLM с точным бюджетом токенов.
+
+ContextOptimizer режет документы по оценке len/3.5, а overlap из
+UniversalChunker._apply_overlap и окна auto-merge приводят к тому, что одни
+и те же абзацы попадают в промпт по два-три раза. Пакер:
+- удаляет повторяющиеся фрагменты (предложения, строки списков, code-блоки)
+  между выбранными документами и внутри одного окна auto-merge;
+- считает токены токенайзером провайдера (tiktoken, если установлен);
+- заполняет бюджет жадно по rerank score: документы с большим score
+  сохраняют общий фрагмент и попадают в контекст первыми, последний
+  невлезающий документ обрезается по Markdown-блокам.
+
+Исходный порядок документов (после Long Context Reorder) сохраняется.
+"""
+from __future__ import annotations
+
+import re
+import threading
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from app.services.core.context_optimizer import context_optimizer
+
+try:  # Optional: точный подсчёт токенов
+    import tiktoken
+    TIKTOKEN_AVAILABLE = True
+except ImportError:  # pragma: no cover - зависит от окружения
+    tiktoken = None
+    TIKTOKEN_AVAILABLE = False
+
+
+# Кодировки tiktoken по провайдерам. Для GPT-5 кодировка точная; у YandexGPT,
+# GigaChat и DeepSeek нет локального токенайзера в tiktoken, cl100k_base для
+# них — ближайшая доступная оценка (ошибка единицы процентов, а не ~30% у len/4).
+PROVIDER_ENCODINGS: Dict[str, str] = {
+    "GPT5": "o200k_base",
+    "DEEPSEEK": "cl100k_base",
+    "YANDEX": "cl100k_base",
+    "GIGACHAT": "cl100k_base",
+}
+DEFAULT_ENCODING = "cl100k_base"
+
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?…])\s+")
+_NORMALIZE_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+_counters: Dict[str, Callable[[str], int]] = {}
+_counters_lock = threading.Lock()
+
+
+def _heuristic_count(text: str) -> int:
+    # Та же оценка, что в ContextOptimizer._estimate_tokens
+    return int(len(text) / 3.5) if text else 0
+
+
+def get_token_counter(provider: Optional[str] = None) -> Callable[[str], int]:
+    """Функция подсчёта токенов для провайдера (кэшируется по кодировке)."""
+    encoding_name = PROVIDER_ENCODINGS.get(str(provider or "").upper(), DEFAULT_ENCODING)
+    counter = _counters.get(encoding_name)
+    if counter is not None:
+        return counter
+    with _counters_lock:
+        counter = _counters.get(encoding_name)
+        if counter is None:
+            counter = _heuristic_count
+            if TIKTOKEN_AVAILABLE:
+                try:
+                    encoding = tiktoken.get_encoding(encoding_name)
+                    counter = lambda text: len(encoding.encode(text, disallowed_special=())) if text else 0  # noqa: E731
+                except Exception as e:
+                    logger.warning(f"tiktoken encoding {encoding_name} unavailable: {e}, using heuristic token count")
+            _counters[encoding_name] = counter
+    return counter
+
+
+def _normalize_unit(text: str) -> str:
+    return _NORMALIZE_RE.sub(" ", text.lower()).strip()
+
+
+def _doc_score(doc: Dict[str, Any]) -> float:
+    for key in ("rerank_score", "boosted_score", "rrf_score", "score"):
+        value = doc.get(key)
+        if isinstance(value, (int, float)):
+            return float(value)
+    return 0.0
+
+
+class ContextPacker:
+    """Дедупликация и жадная упаковка документов в бюджет токенов."""
+
+    def __init__(
+        self,
+        token_counter: Optional[Callable[[str], int]] = None,
+        min_dedup_chars: int = 24,
+        min_partial_tokens: int = 64,
+    ):
+        """
+        Args:
+            token_counter: функция подсчёта токенов (по умолчанию — cl100k_base / эвристика)
+            min_dedup_chars: более короткие фрагменты (заголовки, «Шаги:») не дедуплицируются
+            min_partial_tokens: минимальный остаток бюджета, ради которого документ обрезается
+        """
+        self.count_tokens = token_counter or get_token_counter()
+        self.min_dedup_chars = min_dedup_chars
+        self.min_partial_tokens = min_partial_tokens
+
+    def _dedupe_text(self, text: str, seen: Set[str]) -> Tuple[str, int]:
+        """Удаляет из текста уже встречавшиеся фрагменты. Возвращает (текст, удалено символов)."""
+        kept_blocks: List[str] = []
+        removed = 0
+        for block in context_optimizer._split_markdown_blocks(text):
+            if block.lstrip().startswith("```"):
+                key = _normalize_unit(block)
+                if key and key in seen:
+                    removed += len(block)
+                    continue
+                seen.add(key)
+                kept_blocks.append(block)
+                continue
+
+            kept_lines: List[str] = []
+            for line in block.splitlines():
+                kept_units: List[str] = []
+                for unit in _SENTENCE_SPLIT_RE.split(line.strip()):
+                    key = _normalize_unit(unit)
+                    if len(key) >= self.min_dedup_chars:
+                        if key in seen:
+                            removed += len(unit)
+                            continue
+                        seen.add(key)
+                    if unit:
+                        kept_units.append(unit)
+                if kept_units:
+                    indent = line[: len(line) - len(line.lstrip())]
+                    kept_lines.append(indent + " ".join(kept_units))
+            if kept_lines:
+                kept_blocks.append("\n".join(kept_lines))
+        return "\n\n".join(kept_blocks), removed
+
+    def _truncate_to_budget(self, text: str, render: Callable[[str], str], budget: int) -> Tuple[str, int]:
+        """
+        Оставляет максимальный префикс Markdown-блоков, укладывающийся в бюджет.
+
+        Каждый блок считается один раз (нарастающий итог), полный префикс
+        рендерится только для финальной проверки — без квадратичной пересклейки.
+        """
+        overhead = self.count_tokens(render(""))
+        separator_tokens = self.count_tokens("\n\n")
+        kept_blocks: List[str] = []
+        estimate = overhead
+        for block in context_optimizer._split_markdown_blocks(text):
+            cost = self.count_tokens(block) + (separator_tokens if kept_blocks else 0)
+            if estimate + cost > budget:
+                break
+            kept_blocks.append(block)
+            estimate += cost
+
+        # Токенизатор не обязан быть аддитивным на стыках блоков — сверяемся с точным подсчётом
+        while kept_blocks:
+            kept = "\n\n".join(kept_blocks)
+            tokens = self.count_tokens(render(kept))
+            if tokens <= budget:
+                return kept, tokens
+            kept_blocks.pop()
+        return "", 0
+
+    def pack(
+        self,
+        documents: List[Dict[str, Any]],
+        budget_tokens: int,
+        render: Optional[Callable[[Dict[str, Any], str], str]] = None,
+    ) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        Упаковывает документы в бюджет.
+
+        Args:
+            documents: документы после ContextOptimizer (порядок сохраняется)
+            budget_tokens: бюджет токенов на весь блок контекста
+            render: как документ с данным текстом выглядит в промпте
+                (заголовок, URL и т.п. тоже расходуют бюджет); по умолчанию — только текст
+
+        Returns:
+            (упакованные документы, статистика)
+        """
+        render = render or (lambda _doc, text: text)
+        separator_tokens = self.count_tokens("\n\n")
+        ranked = sorted(range(len(documents)), key=lambda i: _doc_score(documents[i]), reverse=True)
+
+        seen: Set[str] = set()
+        selected: Dict[int, Dict[str, Any]] = {}
+        used = 0
+        removed_chars = 0
+        tokens_before = 0
+        truncated = 0
+
+        for index in ranked:
+            doc = documents[index]
+            payload = doc.get("payload", {}) or {}
+            original = payload.get("text", "") or ""
+            tokens_before += self.count_tokens(render(doc, original))
+
+            text, removed = self._dedupe_text(original, seen)
+            removed_chars += removed
+            if original.strip() and not text.strip():
+                continue  # документ целиком повторяет уже выбранные
+
+            cost = (separator_tokens if selected else 0)
+            doc_tokens = self.count_tokens(render(doc, text))
+            if used + cost + doc_tokens > budget_tokens:
+                remaining = budget_tokens - used - cost
+                if remaining < self.min_partial_tokens:
+                    continue
+                text, doc_tokens = self._truncate_to_budget(text, lambda t: render(doc, t), remaining)
+                if not text:
+                    continue
+                truncated += 1
+
+            used += cost + doc_tokens
+            packed_payload = dict(payload)
+            packed_payload["text"] = text
+            packed_payload["context_tokens"] = doc_tokens
+            if removed:
+                packed_payload["dedup_removed_chars"] = removed
+            packed_doc = dict(doc)
+            packed_doc["payload"] = packed_payload
+            selected[index] = packed_doc
+
+        packed = [selected[i] for i in range(len(documents)) if i in selected]
+        stats = {
+            "docs_in": len(documents),
+            "docs_out": len(packed),
+            "tokens": used,
+            "tokens_before": tokens_before + separator_tokens * max(0, len(documents) - 1),
+            "budget": budget_tokens,
+            "dedup_removed_chars": removed_chars,
+            "truncated_docs": truncated,
+        }
+        return packed, stats
+
+
+def pack_context(
+    documents: List[Dict[str, Any]],
+    budget_tokens: int,
+    provider: Optional[str] = None,
+    render: Optional[Callable[[Dict[str, Any], str], str]] = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    """Упаковка контекста токенайзером указанного провайдера."""
+    packer = ContextPacker(token_counter=get_token_counter(provider))
+    return packer.pack(documents, budget_tokens, render=render)
@@ -38,6 +38,7 @@ else:  # pragma: no cover - защитный патч от ошибок заве
 
 from app.config import CONFIG
 from app.infrastructure import cache_embedding
+from app.infrastructure.tracing import span
 
 # Совместимость с Windows для HuggingFace Hub
 os.environ.setdefault("HF_HUB_DISABLE_SYMLINKS", "1")
@@ -471,13 +472,16 @@ def _process_onnx_embedding(texts: List[str], max_length: int, return_dense: boo
         # Нормализуем тексты для безопасной обработки
         safe_texts = _normalize_texts(texts)
 
-        inputs = tokenizer(
-            safe_texts,
-            padding=True,
-            truncation=True,
-            max_length=max_length,
-            return_tensors="np"
-        )
+        chars = sum(len(text) for text in safe_texts)
+        with span("embeddings.tokenize", batch_size=len(safe_texts), chars=chars) as tokenize_span:
+            inputs = tokenizer(
+                safe_texts,
+                padding=True,
+                truncation=True,
+                max_length=max_length,
+                return_tensors="np"
+            )
+            tokenize_span.set("tokens", int(inputs["input_ids"].size))
 
         # Подготавливаем словарь входных данных - обеспечиваем int64 для ONNX
         input_dict = {
@@ -488,7 +492,8 @@ def _process_onnx_embedding(texts: List[str], max_length: int, return_dense: boo
         if "token_type_ids" in inputs:
             input_dict["token_type_ids"] = inputs["token_type_ids"].astype(np.int64)
 
-        outputs = embedder.run(None, input_dict)
+        with span("embeddings.onnx_inference", batch_size=len(safe_texts), max_length=max_length):
+            outputs = embedder.run(None, input_dict)
         embeddings = outputs[0]
 
         # Среднее пулинга для получения финальных эмбеддингов
@@ -532,13 +537,21 @@ def _process_bge_embedding(texts: List[str], max_length: int, return_dense: bool
         return _get_empty_result(return_dense, return_sparse, return_colbert)
 
     try:
-        output = model.encode(
-            texts,
+        with span(
+            "embeddings.bge_encode",
+            batch_size=len(texts),
+            chars=sum(len(text) for text in texts),
             max_length=max_length,
-            return_dense=return_dense,
-            return_sparse=return_sparse,
-            return_colbert_vecs=return_colbert
-        )
+            dense=return_dense,
+            sparse=return_sparse,
+        ):
+            output = model.encode(
+                texts,
+                max_length=max_length,
+                return_dense=return_dense,
+                return_sparse=return_sparse,
+                return_colbert_vecs=return_colbert
+            )
 
         logger.debug(f"BGE-M3 кодирование завершено: {len(texts)} текстов, max_length={max_length}, "
                     f"dense={return_dense}, sparse={return_sparse}, colbert={return_colbert}")
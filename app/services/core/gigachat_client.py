@@ -3,13 +3,13 @@ GigaChat client wrapper around the official SDK.
 
 - берет client_id/client_secret из CONFIG, кодирует в base64 как credentials;
 - переиспользует один синхронный клиент с потокобезопасной инициализацией;
-- предоставляет метод chat_completion в терминах Chat Completions.
+- предоставляет методы chat_completion / chat_completion_stream в терминах Chat Completions.
 """
 from __future__ import annotations
 
 import base64
 import threading
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 
 from loguru import logger
 
@@ -112,6 +112,30 @@ class GigachatClient:
         return message.content
 
 
+    def chat_completion_stream(
+        self,
+        messages: List[Dict[str, str]],
+        *,
+        temperature: Optional[float] = None,
+        top_p: Optional[float] = None,
+        max_tokens: Optional[int] = None,
+    ) -> Iterator[str]:
+        """Потоковый вариант chat_completion: отдаёт дельты текста по мере генерации."""
+        client = self._get_client()
+        chat = Chat(
+            messages=self._convert_messages(messages),
+            temperature=temperature,
+            top_p=top_p,
+            max_tokens=max_tokens,
+            model=CONFIG.gigachat_model or None,
+        )
+        for chunk in client.stream(chat):
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
 _gigachat_client: Optional[GigachatClient] = None
 
 
@@ -14,8 +14,18 @@ LLM Router - маршрутизатор для работы с различны
 """
 from __future__ import annotations
 
-from typing import Any, Dict, List, Optional
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import contextvars
+import json
+import math
 import re
+import threading
+import time
+import weakref
 from urllib.parse import urlparse
 import requests
 from app.config import CONFIG
@@ -35,8 +45,53 @@ except Exception:  # pragma: no cover - fallback for test environments without t
         tokens = text.split()
         return " ".join(tokens[:max_tokens])
 
+try:
+    from app.infrastructure.metrics import (  # type: ignore
+        llm_hedge_requests_total,
+        llm_hedge_wins_total,
+        llm_provider_saturated_total,
+        llm_context_tokens,
+    )
+except Exception:  # pragma: no cover - метрики недоступны в облегчённых тестовых окружениях
+    llm_hedge_requests_total = llm_hedge_wins_total = llm_provider_saturated_total = None
+    llm_context_tokens = None
+
+try:
+    from app.infrastructure.http_client import get_async_provider_http_client, get_provider_http_client  # type: ignore
+except Exception:  # pragma: no cover - без пула используем requests.post напрямую
+    get_provider_http_client = get_async_provider_http_client = None
+
+try:
+    from app.services.core.context_packer import pack_context  # type: ignore
+except Exception:  # pragma: no cover - без пакера контекст уходит в LLM как есть
+    pack_context = None
+
+try:
+    from app.services.core.provider_scheduler import get_provider_scheduler  # type: ignore
+except Exception:  # pragma: no cover - без планировщика используется статический порядок
+    get_provider_scheduler = None
+
+try:
+    from app.infrastructure.deadline import current_deadline  # type: ignore
+except Exception:  # pragma: no cover - без дедлайна запроса генерация не ограничена по времени
+    def current_deadline() -> Any:
+        return None
+
+try:
+    from app.infrastructure.tracing import span  # type: ignore
+except Exception:  # pragma: no cover - без трассировки вызовы LLM не попадают в спаны запроса
+    class _NoTraceSpan:
+        def set(self, key: str, value: Any) -> None:
+            pass
+
+    def span(name: str, **attributes: Any) -> Any:
+        return nullcontext(_NoTraceSpan())
+
 
 DEFAULT_LLM = CONFIG.default_llm
+# Версия системных промптов и формата контекста. Входит в ключ кэша ответов:
+# увеличивать при любом изменении промптов в _prepare_generation
+PROMPT_VERSION = "1"
 LIST_INTENT_PATTERN = re.compile(r"\b(какие|список|перечень)\b.*\bканал", re.IGNORECASE | re.DOTALL)
 
 
@@ -152,6 +207,86 @@ def apply_url_whitelist(answer_md: str, sources: List[Dict[str, str]]) -> str:
     return "".join(result_parts)
 
 
+_CODE_FENCE_RE = re.compile(r"```")
+_OPEN_LINK_RE = re.compile(r"\[[^\]]*|\[[^\]]+\]\([^)]*", re.DOTALL)
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+class StreamingUrlWhitelist:
+    """
+    Инкрементальный apply_url_whitelist для потоковой генерации.
+
+    Накапливает дельты модели и отдаёт наружу только «безопасный» префикс:
+    разрез делается по пробельному символу вне незакрытого code block и вне
+    незавершённой markdown-ссылки, поэтому к каждому отданному сегменту
+    применяется обычный apply_url_whitelist с тем же результатом, что и для
+    ответа целиком.
+    """
+
+    def __init__(self, sources: List[Dict[str, str]]):
+        self.sources = sources
+        self._pending = ""
+        self._emitted: List[str] = []
+
+    @property
+    def text(self) -> str:
+        """Всё, что уже отдано клиенту."""
+        return "".join(self._emitted)
+
+    def feed(self, delta: str) -> str:
+        """Добавить дельту модели; вернуть отфильтрованный текст, который можно отдать."""
+        if not delta:
+            return ""
+        self._pending += delta
+        if not self._emitted:
+            self._pending = self._pending.lstrip()
+        cut = self._safe_cut(self._pending)
+        if cut <= 0:
+            return ""
+        segment, self._pending = self._pending[:cut], self._pending[cut:]
+        return self._emit(segment)
+
+    def finish(self) -> str:
+        """Отдать остаток буфера в конце генерации."""
+        segment, self._pending = self._pending.rstrip(), ""
+        if not self._emitted:
+            segment = segment.lstrip()
+        return self._emit(segment)
+
+    def _emit(self, segment: str) -> str:
+        if not segment:
+            return ""
+        sanitized = apply_url_whitelist(segment, self.sources)
+        self._emitted.append(sanitized)
+        return sanitized
+
+    @staticmethod
+    def _safe_cut(text: str) -> int:
+        limit = len(text)
+        while limit > 0:
+            # Разрез — начало последней пробельной серии: хвостовые пробелы
+            # остаются в буфере и срезаются в finish()
+            cut = -1
+            for match in _WHITESPACE_RE.finditer(text, 0, limit):
+                cut = match.start()
+            if cut <= 0:
+                return 0
+            head = text[:cut]
+            fences = [m.start() for m in _CODE_FENCE_RE.finditer(head)]
+            if len(fences) % 2:
+                limit = fences[-1]
+                continue
+            open_link = next(
+                (m.start() for m in re.finditer(r"\[", head) if _OPEN_LINK_RE.fullmatch(head, m.start())),
+                None,
+            )
+            if open_link is not None:
+                limit = open_link
+                continue
+            return cut
+        return 0
+
+
 def is_list_intent(query: str) -> bool:
     """Определяет, относится ли запрос к списочному режиму (extract mode)."""
     if not query:
@@ -234,43 +369,69 @@ def _trim_text(text: str) -> str:
     return text.strip() if isinstance(text, str) else ""
 
 
+def _render_context_doc(doc: Dict[str, Any], idx: int, text: Optional[str] = None) -> str:
+    payload = doc.get("payload", {}) or {}
+    title = _trim_text(payload.get("title")) or f"Документ {idx}"
+    url = _trim_text(payload.get("site_url") or payload.get("canonical_url") or payload.get("url"))
+    text = _trim_text(payload.get("text") if text is None else text)
+    theme_label = _trim_text(payload.get("theme_label"))
+    block_lines = [f"### {title}"]
+    if theme_label:
+        block_lines.append(f"Тема: {theme_label}")
+    if url:
+        block_lines.append(f"{url}")
+    if text:
+        block_lines.append(text)
+    return "\n".join(block_lines)
+
+
 def _build_context_block(context: List[Dict[str, Any]]) -> str:
-    blocks: List[str] = []
-    for idx, doc in enumerate(context, start=1):
-        payload = doc.get("payload", {}) or {}
-        title = _trim_text(payload.get("title")) or f"Документ {idx}"
-        group_labels = payload.get("group_labels") or payload.get("groups_path")
-        url = _trim_text(payload.get("site_url") or payload.get("canonical_url") or payload.get("url"))
-        text = _trim_text(payload.get("text"))
-        theme_label = _trim_text(payload.get("theme_label"))
-        block_lines = [f"### {title}"]
-        if theme_label:
-            block_lines.append(f"Тема: {theme_label}")
-        if url:
-            block_lines.append(f"{url}")
-        if text:
-            block_lines.append(text)
-        blocks.append("\n".join(block_lines))
-    return "\n\n".join(blocks)
+    return "\n\n".join(_render_context_doc(doc, idx) for idx, doc in enumerate(context, start=1))
 
 
-def _yandex_complete(prompt: str, max_tokens: int = 800, temperature: Optional[float] = None, top_p: Optional[float] = None, system_prompt: Optional[str] = None) -> str:
+def _pack_context(context: List[Dict[str, Any]], provider: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]]]:
     """
-    Генерирует ответ через Yandex GPT API.
+    Дедупликация и упаковка контекста в LLM_CONTEXT_MAX_TOKENS токенайзером
+    провайдера (см. app.services.core.context_packer).
+    """
+    if pack_context is None or not context or not getattr(CONFIG, "llm_context_packing_enabled", False):
+        return context, None
+    positions = {id(doc): idx for idx, doc in enumerate(context, start=1)}
+    try:
+        packed, stats = pack_context(
+            context,
+            int(getattr(CONFIG, "llm_context_max_tokens", 2400)),
+            provider=provider,
+            render=lambda doc, text: _render_context_doc(doc, positions.get(id(doc), 1), text),
+        )
+    except Exception as exc:  # pragma: no cover - упаковка не должна ломать генерацию
+        logger.warning(f"Context packing failed: {exc}, using unpacked context")
+        return context, None
+    logger.info(
+        f"Context packed: docs {stats['docs_in']} -> {stats['docs_out']}, "
+        f"tokens {stats['tokens_before']} -> {stats['tokens']} (budget={stats['budget']}), "
+        f"dedup_removed_chars={stats['dedup_removed_chars']}"
+    )
+    _observe_metric(llm_context_tokens, stats["tokens"])
+    return packed, stats
 
-    Args:
-        prompt: Пользовательский промпт
-        max_tokens: Максимальное количество токенов
-        temperature: Температура генерации (0.0-1.0)
-        top_p: Top-p параметр для nucleus sampling
-        system_prompt: Системный промпт
 
-    Returns:
-        Сгенерированный текст ответа
+def _http_post(provider: str, url: str, headers: Dict[str, str], payload: Dict[str, Any], stream: bool = False) -> Any:
+    """POST к провайдеру через общий keep-alive клиент (см. app.infrastructure.http_client)."""
+    if get_provider_http_client is None:
+        return requests.post(url, headers=headers, json=payload, timeout=60, stream=stream)
+    return get_provider_http_client(provider).post(url, headers=headers, json=payload, stream=stream)
 
-    Raises:
-        Exception: При ошибках API или сети
-    """
+
+def _build_yandex_request(
+    prompt: str,
+    max_tokens: int = 800,
+    temperature: Optional[float] = None,
+    top_p: Optional[float] = None,
+    system_prompt: Optional[str] = None,
+    stream: bool = False,
+) -> tuple[str, Dict[str, str], Dict[str, Any]]:
+    """Собирает URL, заголовки и тело запроса Yandex GPT (общие для обычного и потокового режима)."""
     url = f"{CONFIG.yandex_api_url}/completion"
     logger.debug(f"Yandex URL: {url}")
     headers = {
@@ -308,15 +469,52 @@ def _yandex_complete(prompt: str, max_tokens: int = 800, temperature: Optional[f
     payload = {
         "modelUri": f"gpt://{CONFIG.yandex_catalog_id}/{CONFIG.yandex_model}",
         "completionOptions": {
-            "stream": False,
+            "stream": stream,
             "temperature": _temperature,
             "topP": _top_p,
             "maxTokens": str(min(max_tokens, CONFIG.yandex_max_tokens))
         },
         "messages": messages
     }
+    return url, headers, payload
+
+
+def _yandex_text(data: Any) -> str:
+    # Ответ Yandex может отличаться; извлекаем текст из completion
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=60)
+        return data["result"]["alternatives"][0]["message"]["text"]
+    except Exception:
+        return str(data)
+
+
+def _chat_completion_text(data: Any) -> str:
+    """Текст ответа Chat Completions (GPT-5, DeepSeek)."""
+    try:
+        return data["choices"][0]["message"]["content"]
+    except Exception:
+        return str(data)
+
+
+def _yandex_complete(prompt: str, max_tokens: int = 800, temperature: Optional[float] = None, top_p: Optional[float] = None, system_prompt: Optional[str] = None) -> str:
+    """
+    Генерирует ответ через Yandex GPT API.
+
+    Args:
+        prompt: Пользовательский промпт
+        max_tokens: Максимальное количество токенов
+        temperature: Температура генерации (0.0-1.0)
+        top_p: Top-p параметр для nucleus sampling
+        system_prompt: Системный промпт
+
+    Returns:
+        Сгенерированный текст ответа
+
+    Raises:
+        Exception: При ошибках API или сети
+    """
+    url, headers, payload = _build_yandex_request(prompt, max_tokens, temperature, top_p, system_prompt)
+    try:
+        resp = _http_post("YANDEX", url, headers, payload)
         status = resp.status_code
         body_preview = resp.text[:500]
     except Exception as e:
@@ -330,16 +528,74 @@ def _yandex_complete(prompt: str, max_tokens: int = 800, temperature: Optional[f
     except Exception as e:
         logger.error(f"Yandex JSON parse error: {e}; body preview={body_preview!r}")
         raise
-    # Ответ Yandex может отличаться; извлекаем текст из completion
-    try:
-        text = data["result"]["alternatives"][0]["message"]["text"]
-    except Exception:
-        text = str(data)
+    text = _yandex_text(data)
     # Логируем сырой ответ (repr, чтобы видеть экранирования)
     logger.debug(f"LLM[Yandex] raw len={len(text)} preview={text[:200]!r}")
     return text
 
 
+def _yandex_stream(prompt: str, max_tokens: int = 800, temperature: Optional[float] = None, top_p: Optional[float] = None, system_prompt: Optional[str] = None) -> Iterator[str]:
+    """
+    Потоковая генерация через Yandex GPT API.
+
+    Yandex присылает построчный JSON, где каждая строка содержит весь текст
+    на текущий момент; наружу отдаются только приросты.
+    """
+    url, headers, payload = _build_yandex_request(prompt, max_tokens, temperature, top_p, system_prompt, stream=True)
+    resp = _http_post("YANDEX", url, headers, payload, stream=True)
+    if resp.status_code != 200:
+        logger.error(f"Yandex HTTP {resp.status_code}: {resp.text[:500]}")
+        resp.raise_for_status()
+    produced = ""
+    try:
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            data = json.loads(line)
+            text = data["result"]["alternatives"][0]["message"]["text"]
+            if len(text) > len(produced):
+                delta, produced = text[len(produced):], text
+                yield delta
+    finally:
+        resp.close()
+    logger.debug(f"LLM[Yandex] streamed len={len(produced)} preview={produced[:200]!r}")
+
+
+def _openai_compatible_stream(api_url: str, headers: Dict[str, str], payload: Dict[str, Any], provider: str) -> Iterator[str]:
+    """Читает SSE-ответ Chat Completions (`data: {...}` / `data: [DONE]`) и отдаёт дельты текста."""
+    resp = _http_post(provider, api_url, headers, {**payload, "stream": True}, stream=True)
+    resp.raise_for_status()
+    produced = 0
+    try:
+        for line in resp.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices") or []
+            delta = ((choices[0].get("delta") or {}).get("content") if choices else None) or ""
+            if delta:
+                produced += len(delta)
+                yield delta
+    finally:
+        resp.close()
+    logger.debug(f"LLM[{provider}] streamed len={produced}")
+
+
+def _gpt5_request(prompt: str, max_tokens: int, system_prompt: Optional[str]) -> tuple[Dict[str, str], Dict[str, Any]]:
+    if not CONFIG.gpt5_api_url or not CONFIG.gpt5_api_key:
+        raise RuntimeError("GPT-5 credentials are not configured")
+
+    headers = {"Authorization": f"Bearer {CONFIG.gpt5_api_key}", "Content-Type": "application/json"}
+
+    # Используем общую функцию для формирования messages
+    messages = _build_messages(prompt, system_prompt, content_key="content")
+
+    payload = {"model": CONFIG.gpt5_model or "gpt5", "messages": messages, "max_tokens": max_tokens}
+    return headers, payload
+
+
 def _gpt5_complete(prompt: str, max_tokens: int = 800, system_prompt: Optional[str] = None) -> str:
     """
     Генерирует ответ через GPT-5 API.
@@ -356,24 +612,28 @@ def _gpt5_complete(prompt: str, max_tokens: int = 800, system_prompt: Optional[s
         RuntimeError: Если не настроены credentials для GPT-5
         Exception: При ошибках API или сети
     """
-    if not CONFIG.gpt5_api_url or not CONFIG.gpt5_api_key:
-        raise RuntimeError("GPT-5 credentials are not configured")
+    headers, payload = _gpt5_request(prompt, max_tokens, system_prompt)
+    resp = _http_post("GPT5", CONFIG.gpt5_api_url, headers, payload)
+    resp.raise_for_status()
+    text = _chat_completion_text(resp.json())
+    logger.debug(f"LLM[GPT5] raw len={len(text)} preview={text[:200]!r}")
+    return text
 
-    headers = {"Authorization": f"Bearer {CONFIG.gpt5_api_key}", "Content-Type": "application/json"}
+
+def _gpt5_stream(prompt: str, max_tokens: int = 800, system_prompt: Optional[str] = None) -> Iterator[str]:
+    """Потоковая генерация через GPT-5 API (OpenAI-совместимый SSE)."""
+    headers, payload = _gpt5_request(prompt, max_tokens, system_prompt)
+    return _openai_compatible_stream(CONFIG.gpt5_api_url, headers, payload, "GPT5")
+
+
+def _deepseek_request(prompt: str, max_tokens: int, system_prompt: Optional[str]) -> tuple[Dict[str, str], Dict[str, Any]]:
+    headers = {"Authorization": f"Bearer {CONFIG.deepseek_api_key}", "Content-Type": "application/json"}
 
     # Используем общую функцию для формирования messages
     messages = _build_messages(prompt, system_prompt, content_key="content")
 
-    payload = {"model": CONFIG.gpt5_model or "gpt5", "messages": messages, "max_tokens": max_tokens}
-    resp = requests.post(CONFIG.gpt5_api_url, headers=headers, json=payload, timeout=60)
-    resp.raise_for_status()
-    data = resp.json()
-    try:
-        text = data["choices"][0]["message"]["content"]
-    except Exception:
-        text = str(data)
-    logger.debug(f"LLM[GPT5] raw len={len(text)} preview={text[:200]!r}")
-    return text
+    payload = {"model": CONFIG.deepseek_model, "messages": messages, "max_tokens": max_tokens}
+    return headers, payload
 
 
 def _deepseek_complete(prompt: str, max_tokens: int = 800, system_prompt: Optional[str] = None) -> str:
@@ -391,23 +651,20 @@ def _deepseek_complete(prompt: str, max_tokens: int = 800, system_prompt: Option
     Raises:
         Exception: При ошибках API или сети
     """
-    headers = {"Authorization": f"Bearer {CONFIG.deepseek_api_key}", "Content-Type": "application/json"}
-
-    # Используем общую функцию для формирования messages
-    messages = _build_messages(prompt, system_prompt, content_key="content")
-
-    payload = {"model": CONFIG.deepseek_model, "messages": messages, "max_tokens": max_tokens}
-    resp = requests.post(CONFIG.deepseek_api_url, headers=headers, json=payload, timeout=60)
+    headers, payload = _deepseek_request(prompt, max_tokens, system_prompt)
+    resp = _http_post("DEEPSEEK", CONFIG.deepseek_api_url, headers, payload)
     resp.raise_for_status()
-    data = resp.json()
-    try:
-        text = data["choices"][0]["message"]["content"]
-    except Exception:
-        text = str(data)
-        logger.debug(f"LLM[DEEPSEEK] raw len={len(text)} preview={text[:200]!r}")
+    text = _chat_completion_text(resp.json())
+    logger.debug(f"LLM[DEEPSEEK] raw len={len(text)} preview={text[:200]!r}")
     return text
 
 
+def _deepseek_stream(prompt: str, max_tokens: int = 800, system_prompt: Optional[str] = None) -> Iterator[str]:
+    """Потоковая генерация через DeepSeek API (OpenAI-совместимый SSE)."""
+    headers, payload = _deepseek_request(prompt, max_tokens, system_prompt)
+    return _openai_compatible_stream(CONFIG.deepseek_api_url, headers, payload, "DEEPSEEK")
+
+
 def _gigachat_complete(
     prompt: str,
     max_tokens: int = 800,
@@ -440,11 +697,90 @@ def _gigachat_complete(
     return text
 
 
-def generate_answer(query: str, context: List[Dict[str, Any]], policy: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+def _gigachat_stream(
+    prompt: str,
+    max_tokens: int = 800,
+    system_prompt: Optional[str] = None,
+    temperature: Optional[float] = None,
+    top_p: Optional[float] = None,
+) -> Iterator[str]:
+    """Потоковая генерация через GigaChat SDK."""
+    messages = _build_messages(prompt, system_prompt, content_key="content")
+    client = get_gigachat_client()
+    return client.chat_completion_stream(
+        messages,
+        temperature=temperature,
+        top_p=top_p,
+        max_tokens=max_tokens,
+    )
+
+
+def _static_provider_order() -> List[str]:
+    preferred_order = [DEFAULT_LLM, "YANDEX", "GIGACHAT", "GPT5", "DEEPSEEK"]
+    order: List[str] = []
+    seen: set[str] = set()
+    for provider in preferred_order:
+        provider_upper = str(provider).upper()
+        if provider_upper not in seen:
+            seen.add(provider_upper)
+            order.append(provider_upper)
+    return order
+
+
+def _scheduler() -> Any:
+    if get_provider_scheduler is None or not getattr(CONFIG, "llm_dynamic_ordering_enabled", False):
+        return None
+    return get_provider_scheduler()
+
+
+def _provider_order() -> List[str]:
     """
-    Генерирует ответ на основе контекста документов и возвращает структуру
-    с чистым Markdown и whitelisted источниками.
+    Порядок опроса провайдеров.
+
+    При LLM_DYNAMIC_ORDERING_ENABLED — по ожидаемой задержке (EWMA задержки
+    и доли ошибок) без провайдеров с открытым circuit breaker, иначе статический.
     """
+    order = _static_provider_order()
+    scheduler = _scheduler()
+    if scheduler is not None:
+        order = scheduler.order(order)
+    return _deadline_order(order)
+
+
+def _deadline_order(order: List[str]) -> List[str]:
+    """
+    Последний шаг деградации по дедлайну запроса (fastest_provider): если
+    времени осталось мало или меньше ожидаемой задержки основного провайдера,
+    опрашивается только самый быстрый провайдер, без fallback и hedging.
+    """
+    deadline = current_deadline()
+    if deadline is None or not order:
+        return order
+    latencies = {provider: _expected_latency(provider) for provider in order}
+    if not deadline.should_degrade("fastest_provider", needed_s=latencies[order[0]] or 0.0):
+        return order
+    fastest = min(order, key=lambda provider: math.inf if latencies[provider] is None else latencies[provider])
+    logger.info(f"LLM Router: {deadline.remaining():.2f}s left until request deadline, using only {fastest}")
+    return [fastest]
+
+
+def _expected_latency(provider: str) -> Optional[float]:
+    """Ожидаемая задержка провайдера: оценка планировщика или медиана окна задержек; None — нет данных."""
+    scheduler = _scheduler()
+    if scheduler is not None:
+        return scheduler.expected_latency(provider)
+    with _hedge_lock:
+        samples = sorted(_provider_latencies.get(provider, ()))
+    return samples[len(samples) // 2] if samples else None
+
+
+def _deadline_expired() -> bool:
+    deadline = current_deadline()
+    return deadline is not None and deadline.expired()
+
+
+def _prepare_generation(query: str, context: List[Dict[str, Any]], policy: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Общая подготовка для generate_answer и stream_answer: режим, промпты, источники."""
     policy = policy or {}
     mode = "extract" if is_list_intent(query) else "compose"
 
@@ -472,8 +808,11 @@ def generate_answer(query: str, context: List[Dict[str, Any]], policy: Optional[
             "Не придумывай ссылки, пути API, названия методов или структуры объектов, если их нет в контексте."
         )
 
-    sources = _collect_sources(context, query)
-    context_block = _build_context_block(context)
+    order = _provider_order()
+    packed_context, context_stats = _pack_context(context, order[0] if order else None)
+    # Ссылки — только на документы, которые действительно попали в промпт
+    sources = _collect_sources(packed_context, query)
+    context_block = _build_context_block(packed_context)
     sources_block = _build_sources_block(sources)
 
     prompt = (
@@ -482,97 +821,753 @@ def generate_answer(query: str, context: List[Dict[str, Any]], policy: Optional[
         f"Ссылки на источники:\n{sources_block}"
     )
 
-    preferred_order = [DEFAULT_LLM, "YANDEX", "GIGACHAT", "GPT5", "DEEPSEEK"]
-    order: List[str] = []
-    seen: set[str] = set()
-    for provider in preferred_order:
-        provider_upper = str(provider).upper()
-        if provider_upper not in seen:
-            seen.add(provider_upper)
-            order.append(provider_upper)
-    logger.info(
-        f"LLM Router: mode={mode}, providers={' -> '.join(order)}, "
-        f"context_docs={len(context)}, sources={len(sources)}"
-    )
-
-    meta: Dict[str, Any] = {
+    return {
         "mode": mode,
         "temperature": temperature,
         "top_p": top_p,
-        "provider": None,
+        "system_prompt": system_prompt,
+        "theme_instruction": theme_instruction,
+        "sources": sources,
+        "prompt": prompt,
+        "order": order,
+        "context_stats": context_stats,
+    }
+
+
+def _complete_with_provider(provider: str, generation: Dict[str, Any]) -> str:
+    """Вызывает non-streaming функцию провайдера по имени."""
+    prompt = generation["prompt"]
+    system_prompt = generation["system_prompt"]
+    temperature = generation["temperature"]
+    top_p = generation["top_p"]
+    if provider == "YANDEX":
+        return _yandex_complete(
+            prompt,
+            system_prompt=system_prompt,
+            temperature=temperature,
+            top_p=top_p,
+        )
+    if provider == "GIGACHAT":
+        return _gigachat_complete(
+            prompt,
+            system_prompt=system_prompt,
+            temperature=temperature,
+            top_p=top_p,
+        )
+    if provider == "GPT5":
+        return _gpt5_complete(
+            prompt,
+            system_prompt=system_prompt,
+        )
+    return _deepseek_complete(
+        prompt,
+        system_prompt=system_prompt,
+    )
+
+
+def _stream_with_provider(provider: str, generation: Dict[str, Any]) -> Iterator[str]:
+    """
+    Поток дельт ответа провайдера.
+
+    Провайдеры вне LLM_STREAM_PROVIDERS вызываются в обычном режиме,
+    и весь ответ отдаётся одной дельтой.
+    """
+    prompt = generation["prompt"]
+    system_prompt = generation["system_prompt"]
+    temperature = generation["temperature"]
+    top_p = generation["top_p"]
+    streaming = {
+        name.strip().upper()
+        for name in str(getattr(CONFIG, "llm_stream_providers", "YANDEX,GIGACHAT,GPT5,DEEPSEEK")).split(",")
+        if name.strip()
     }
+    if provider not in streaming:
+        return iter([_complete_with_provider(provider, generation)])
+    if provider == "YANDEX":
+        return _yandex_stream(prompt, system_prompt=system_prompt, temperature=temperature, top_p=top_p)
+    if provider == "GIGACHAT":
+        return _gigachat_stream(prompt, system_prompt=system_prompt, temperature=temperature, top_p=top_p)
+    if provider == "GPT5":
+        return _gpt5_stream(prompt, system_prompt=system_prompt)
+    return _deepseek_stream(prompt, system_prompt=system_prompt)
+
+
+ALL_PROVIDERS_FAILED_ANSWER = "Извините, провайдеры LLM недоступны. Попробуйте позже."
+PROVIDERS_BUSY_ANSWER = "Извините, сервис сейчас перегружен. Попробуйте через минуту."
+
+
+# --- Hedged-запросы к провайдерам --------------------------------------------
+
+_LATENCY_WINDOW = 200
+_provider_latencies: Dict[str, Deque[float]] = {}
+_provider_slots: Dict[str, threading.BoundedSemaphore] = {}
+# asyncio.Semaphore привязан к event loop, поэтому слоты ASGI-пути — свои для каждого loop
+_async_provider_slots: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, asyncio.Semaphore]]" = (
+    weakref.WeakKeyDictionary()
+)
+_hedge_lock = threading.Lock()
+_hedge_executor: Optional[ThreadPoolExecutor] = None
+
+
+class ProviderCallCancelled(RuntimeError):
+    """Вызов провайдера отменён: другой провайдер уже ответил."""
+
+
+class ProviderUnavailable(RuntimeError):
+    """Circuit breaker провайдера открыт, вызов не выполняется."""
+
+
+class EmptyProviderAnswer(RuntimeError):
+    """Провайдер вернул пустой ответ (или только пробелы) — считается отказом, как и ошибка."""
+
+
+class ProviderSaturated(RuntimeError):
+    """Свободный слот провайдера (LLM_PROVIDER_MAX_CONCURRENCY) не освободился за отведённое время."""
+
+
+class _SlotLease:
+    """Занятый слот провайдера; освобождается ровно один раз — при отмене или завершении вызова."""
+
+    def __init__(self, slot: threading.BoundedSemaphore):
+        self._slot = slot
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self, *_args: Any) -> None:
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._slot.release()
+
+
+def record_provider_latency(provider: str, seconds: float) -> None:
+    """Запоминает задержку успешного ответа провайдера (скользящее окно)."""
+    with _hedge_lock:
+        window = _provider_latencies.setdefault(provider, deque(maxlen=_LATENCY_WINDOW))
+        window.append(float(seconds))
+
+
+def _hedge_delay(provider: str) -> float:
+    """Через сколько секунд без ответа провайдера запускать резервный."""
+    default_delay = float(getattr(CONFIG, "llm_hedge_default_delay_s", 8.0))
+    min_delay = float(getattr(CONFIG, "llm_hedge_min_delay_s", 0.5))
+    min_samples = int(getattr(CONFIG, "llm_hedge_min_samples", 20))
+    percentile = float(getattr(CONFIG, "llm_hedge_percentile", 0.95))
+    with _hedge_lock:
+        samples = sorted(_provider_latencies.get(provider, ()))
+    if len(samples) < max(1, min_samples):
+        return default_delay
+    index = min(len(samples) - 1, max(0, math.ceil(percentile * len(samples)) - 1))
+    return max(min_delay, samples[index])
+
 
+def _provider_slot(provider: str) -> threading.BoundedSemaphore:
+    with _hedge_lock:
+        slot = _provider_slots.get(provider)
+        if slot is None:
+            slot = threading.BoundedSemaphore(int(getattr(CONFIG, "llm_provider_max_concurrency", 8)))
+            _provider_slots[provider] = slot
+        return slot
+
+
+def _async_provider_slot(provider: str) -> asyncio.Semaphore:
+    loop = asyncio.get_running_loop()
+    with _hedge_lock:
+        slots = _async_provider_slots.setdefault(loop, {})
+        slot = slots.get(provider)
+        if slot is None:
+            slot = asyncio.Semaphore(int(getattr(CONFIG, "llm_provider_max_concurrency", 8)))
+            slots[provider] = slot
+        return slot
+
+
+def _slot_wait_until() -> float:
+    """
+    До какого момента (perf_counter) запрос может ждать свободный слот провайдера:
+    до дедлайна запроса, а без него — не дольше таймаута чтения ответа провайдера.
+    """
+    deadline = current_deadline()
+    if deadline is not None:
+        budget = deadline.remaining()
+    else:
+        budget = float(getattr(CONFIG, "llm_http_read_timeout_s", 60.0))
+    return time.perf_counter() + max(0.0, budget)
+
+
+def _acquire_slot(provider: str, wait_until: float) -> Optional[_SlotLease]:
+    slot = _provider_slot(provider)
+    if not slot.acquire(timeout=max(0.0, wait_until - time.perf_counter())):
+        return None
+    return _SlotLease(slot)
+
+
+def _record_saturation(provider: str, meta: Dict[str, Any], role: str) -> None:
+    logger.warning(f"LLM Router: provider {provider} skipped ({role}): concurrency limit reached")
+    _inc_metric(llm_provider_saturated_total, provider=provider)
+    meta.setdefault("providers_saturated", []).append(provider)
+
+
+def _get_hedge_executor() -> ThreadPoolExecutor:
+    global _hedge_executor
+    if _hedge_executor is None:
+        with _hedge_lock:
+            if _hedge_executor is None:
+                _hedge_executor = ThreadPoolExecutor(
+                    max_workers=int(getattr(CONFIG, "llm_hedge_max_workers", 32)),
+                    thread_name_prefix="llm-hedge",
+                )
+    return _hedge_executor
+
+
+def _inc_metric(metric: Any, **labels: str) -> None:
+    if metric is None:
+        return
+    try:
+        (metric.labels(**labels) if labels else metric).inc()
+    except Exception:  # pragma: no cover - метрики не должны ломать генерацию
+        pass
+
+
+def _observe_metric(metric: Any, value: float) -> None:
+    if metric is None:
+        return
+    try:
+        metric.observe(value)
+    except Exception:  # pragma: no cover - метрики не должны ломать генерацию
+        pass
+
+
+def _report_provider_failure(provider: str, exc: BaseException) -> None:
+    write_debug_event(
+        "llm.provider_error",
+        {"provider": provider, "error": f"{type(exc).__name__}: {exc}"},
+    )
+    logger.warning(
+        f"LLM Router: provider {provider} failed: {type(exc).__name__}: {exc}"
+    )
+
+
+def _timed_completion(provider: str, generation: Dict[str, Any]) -> str:
+    scheduler = _scheduler()
+    if scheduler is not None and not scheduler.allow(provider):
+        raise ProviderUnavailable(f"circuit breaker for {provider} is OPEN")
+    started = time.perf_counter()
+    try:
+        prompt_chars = len(generation.get("prompt") or "")
+        with span("llm.completion", provider=provider, prompt_chars=prompt_chars) as call:
+            answer = _complete_with_provider(provider, generation)
+            call.set("answer_chars", len(answer or ""))
+        if not (answer or "").strip():
+            raise EmptyProviderAnswer(f"{provider} returned an empty answer")
+    except Exception:
+        if scheduler is not None:
+            scheduler.record_failure(provider)
+        raise
+    latency = time.perf_counter() - started
+    record_provider_latency(provider, latency)
+    if scheduler is not None:
+        scheduler.record_success(provider, latency)
+    return answer
+
+
+def _slotted_completion(provider: str, generation: Dict[str, Any], cancelled: threading.Event) -> str:
+    if cancelled.is_set():
+        raise ProviderCallCancelled(provider)
+    return _timed_completion(provider, generation)
+
+
+def _complete_serial(order: List[str], generation: Dict[str, Any], meta: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """Строго последовательный fallback по списку провайдеров (до дедлайна запроса)."""
+    slot_wait_until = _slot_wait_until()
     for provider in order:
+        if meta.get("providers_tried") and _deadline_expired():
+            logger.warning(f"LLM Router: request deadline expired, not falling back to {provider}")
+            break
+        lease = _acquire_slot(provider, slot_wait_until)
+        if lease is None:
+            _record_saturation(provider, meta, "serial")
+            continue
         try:
             logger.info(
-                f"LLM Router: provider={provider}, mode={mode}, "
-                f"temperature={temperature}, top_p={top_p}"
+                f"LLM Router: provider={provider}, mode={generation['mode']}, "
+                f"temperature={generation['temperature']}, top_p={generation['top_p']}"
             )
-            if provider == "YANDEX":
-                answer = _yandex_complete(
-                    prompt,
-                    system_prompt=system_prompt,
-                    temperature=temperature,
-                    top_p=top_p,
-                )
-            elif provider == "GIGACHAT":
-                answer = _gigachat_complete(
-                    prompt,
-                    system_prompt=system_prompt,
-                    temperature=temperature,
-                    top_p=top_p,
-                )
-            elif provider == "GPT5":
-                answer = _gpt5_complete(
-                    prompt,
-                    system_prompt=system_prompt,
-                )
-            else:
-                answer = _deepseek_complete(
-                    prompt,
-                    system_prompt=system_prompt,
+            meta.setdefault("providers_tried", []).append(provider)
+            return provider, _timed_completion(provider, generation)
+        except Exception as exc:
+            _report_provider_failure(provider, exc)
+        finally:
+            lease.release()
+    return None
+
+
+def _complete_hedged(order: List[str], generation: Dict[str, Any], meta: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """
+    Hedged-вызов провайдеров.
+
+    Основной провайдер запускается сразу. Если он не ответил за перцентиль
+    своей задержки (_hedge_delay), параллельно запускается следующий по
+    списку (не более LLM_HEDGE_MAX_EXTRA раз). Ошибка провайдера сразу
+    запускает следующий. Побеждает первый успешный ответ, остальные
+    отменяются: ещё не начатые вызовы не выполняются, а результат уже
+    идущих HTTP-запросов отбрасывается.
+
+    Основной и fallback-вызовы ждут свободный слот провайдера
+    (LLM_PROVIDER_MAX_CONCURRENCY) до дедлайна запроса; резервный (hedge)
+    не ждёт и пропускает занятого провайдера. Слот проигравшего вызова
+    освобождается сразу при отмене.
+    """
+    remaining = list(order)
+    in_flight: Dict[Future, Tuple[str, threading.Event, str, _SlotLease]] = {}
+    tried: List[str] = meta.setdefault("providers_tried", [])
+    max_extra = max(0, int(getattr(CONFIG, "llm_hedge_max_extra", 1)))
+    executor = _get_hedge_executor()
+    hedges = 0
+    last_launch: Tuple[str, float] = ("", 0.0)
+    slot_wait_until = _slot_wait_until()
+
+    def launch(role: str) -> bool:
+        nonlocal last_launch
+        if role != "primary" and remaining and _deadline_expired():
+            logger.warning(f"LLM Router: request deadline expired, not starting {role} request")
+            return False
+        while remaining:
+            provider = remaining.pop(0)
+            # Резервный запрос нужен только если он стартует сразу — его не ждём
+            lease = _acquire_slot(provider, 0.0 if role == "hedge" else slot_wait_until)
+            if lease is None:
+                _record_saturation(provider, meta, role)
+                continue
+            cancelled = threading.Event()
+            try:
+                # Вызов видит contextvars запроса: дедлайн и текущий спан трассировки
+                future = executor.submit(
+                    contextvars.copy_context().run, _slotted_completion, provider, generation, cancelled
                 )
+            except Exception:
+                lease.release()
+                raise
+            # Слот освобождается и при отмене ещё не начатого вызова (функция тогда не выполняется)
+            future.add_done_callback(lease.release)
+            in_flight[future] = (provider, cancelled, role, lease)
+            tried.append(provider)
+            last_launch = (provider, time.perf_counter())
+            logger.info(
+                f"LLM Router: provider={provider} ({role}), mode={generation['mode']}, "
+                f"temperature={generation['temperature']}, top_p={generation['top_p']}"
+            )
+            return True
+        return False
 
-            answer_markdown = (answer or "").strip()
-            filtered_answer = apply_url_whitelist(answer_markdown, sources)
-            if filtered_answer != answer_markdown:
-                logger.info("LLM Router: removed non-whitelisted links from answer")
+    launch("primary")
+    while in_flight:
+        timeout = None
+        if remaining and hedges < max_extra:
+            provider, launched_at = last_launch
+            timeout = max(0.0, launched_at + _hedge_delay(provider) - time.perf_counter())
 
-            meta["provider"] = provider
-            meta["answer_length"] = len(filtered_answer)
+        done, _ = wait(list(in_flight), timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            hedges += 1
+            logger.info(
+                f"LLM Router: provider {last_launch[0]} slower than hedge delay, "
+                f"starting hedge request"
+            )
+            if launch("hedge"):
+                meta["hedged"] = True
+            continue
 
-            write_debug_event(
-                "llm.answer",
-                {
-                    "provider": provider,
-                    "mode": mode,
-                    "len": len(answer_markdown),
-                    "preview": answer_markdown[:500],
-                    "temperature": temperature,
-                    "top_p": top_p,
-                },
+        for future in done:
+            provider, _cancelled, role, _lease = in_flight.pop(future)
+            try:
+                answer = future.result()
+            except Exception as exc:
+                _report_provider_failure(provider, exc)
+                continue
+
+            for loser, (loser_provider, loser_cancelled, _role, loser_lease) in in_flight.items():
+                loser_cancelled.set()
+                loser.cancel()
+                # Ответ проигравшего отбрасывается — слот не должен ждать конца его HTTP-запроса
+                loser_lease.release()
+                logger.debug(f"LLM Router: cancelled {loser_provider} request, {provider} answered first")
+            in_flight.clear()
+            _inc_metric(llm_hedge_wins_total, provider=provider, role=role)
+            return provider, answer
+
+        if not in_flight:
+            launch("fallback")
+
+    return None
+
+
+def _answer_meta(generation: Dict[str, Any]) -> Dict[str, Any]:
+    meta: Dict[str, Any] = {
+        "mode": generation["mode"],
+        "temperature": generation["temperature"],
+        "top_p": generation["top_p"],
+        "provider": None,
+    }
+    if generation.get("context_stats"):
+        meta["context"] = generation["context_stats"]
+    return meta
+
+
+def _build_answer(
+    generation: Dict[str, Any],
+    meta: Dict[str, Any],
+    winner: Optional[Tuple[str, str]],
+) -> Dict[str, Any]:
+    """Итог генерации: фильтрация ссылок по whitelist, метаданные, debug-событие."""
+    sources = generation["sources"]
+    if winner is None:
+        if meta.get("providers_saturated") and not meta.get("providers_tried"):
+            # Ни один провайдер не отказал — все заняты до предела LLM_PROVIDER_MAX_CONCURRENCY
+            logger.error("LLM Router: all providers are at their concurrency limit")
+            meta["error"] = "providers_saturated"
+            answer = PROVIDERS_BUSY_ANSWER
+        else:
+            logger.error("LLM Router: all providers failed")
+            meta["error"] = "all_providers_failed"
+            answer = ALL_PROVIDERS_FAILED_ANSWER
+        return {
+            "answer_markdown": answer,
+            "sources": sources,
+            "meta": meta,
+        }
+
+    provider, answer = winner
+    answer_markdown = (answer or "").strip()
+    filtered_answer = apply_url_whitelist(answer_markdown, sources)
+    if filtered_answer != answer_markdown:
+        logger.info("LLM Router: removed non-whitelisted links from answer")
+
+    meta["provider"] = provider
+    meta["answer_length"] = len(filtered_answer)
+
+    write_debug_event(
+        "llm.answer",
+        {
+            "provider": provider,
+            "mode": generation["mode"],
+            "len": len(answer_markdown),
+            "preview": answer_markdown[:500],
+            "temperature": generation["temperature"],
+            "top_p": generation["top_p"],
+            "hedged": meta.get("hedged", False),
+        },
+    )
+
+    return {
+        "answer_markdown": filtered_answer,
+        "sources": sources,
+        "meta": meta,
+    }
+
+
+def generate_answer(query: str, context: List[Dict[str, Any]], policy: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Генерирует ответ на основе контекста документов и возвращает структуру
+    с чистым Markdown и whitelisted источниками.
+    """
+    generation = _prepare_generation(query, context, policy)
+    order = generation["order"]
+    hedging = bool(getattr(CONFIG, "llm_hedging_enabled", False))
+    logger.info(
+        f"LLM Router: mode={generation['mode']}, providers={' -> '.join(order)}, hedging={hedging}, "
+        f"context_docs={len(context)}, sources={len(generation['sources'])}"
+    )
+
+    meta = _answer_meta(generation)
+    if hedging:
+        meta["hedged"] = False
+        winner = _complete_hedged(order, generation, meta)
+        _inc_metric(llm_hedge_requests_total, outcome="hedged" if meta["hedged"] else "unhedged")
+    else:
+        winner = _complete_serial(order, generation, meta)
+
+    return _build_answer(generation, meta, winner)
+
+
+# --- Асинхронная генерация (ASGI-пайплайн) -------------------------------------
+
+async def _async_http_post(provider: str, url: str, headers: Dict[str, str], payload: Dict[str, Any]) -> Any:
+    """POST к провайдеру через асинхронный keep-alive клиент текущего event loop."""
+    if get_async_provider_http_client is None:
+        return await asyncio.to_thread(_http_post, provider, url, headers, payload)
+    return await get_async_provider_http_client(provider).post(url, headers=headers, json=payload)
+
+
+async def _complete_with_provider_async(provider: str, generation: Dict[str, Any]) -> str:
+    """Асинхронный вызов провайдера; GigaChat (синхронный SDK) уходит в поток."""
+    prompt = generation["prompt"]
+    system_prompt = generation["system_prompt"]
+    if provider == "YANDEX":
+        url, headers, payload = _build_yandex_request(
+            prompt,
+            temperature=generation["temperature"],
+            top_p=generation["top_p"],
+            system_prompt=system_prompt,
+        )
+        resp = await _async_http_post("YANDEX", url, headers, payload)
+        if resp.status_code != 200:
+            logger.error(f"Yandex HTTP {resp.status_code}: {resp.text[:500]}")
+            resp.raise_for_status()
+        return _yandex_text(resp.json())
+    if provider == "GPT5":
+        headers, payload = _gpt5_request(prompt, 800, system_prompt)
+        resp = await _async_http_post("GPT5", CONFIG.gpt5_api_url, headers, payload)
+        resp.raise_for_status()
+        return _chat_completion_text(resp.json())
+    if provider == "DEEPSEEK":
+        headers, payload = _deepseek_request(prompt, 800, system_prompt)
+        resp = await _async_http_post("DEEPSEEK", CONFIG.deepseek_api_url, headers, payload)
+        resp.raise_for_status()
+        return _chat_completion_text(resp.json())
+    return await asyncio.to_thread(_complete_with_provider, provider, generation)
+
+
+async def _timed_completion_async(provider: str, generation: Dict[str, Any]) -> str:
+    scheduler = _scheduler()
+    if scheduler is not None and not scheduler.allow(provider):
+        raise ProviderUnavailable(f"circuit breaker for {provider} is OPEN")
+    started = time.perf_counter()
+    try:
+        prompt_chars = len(generation.get("prompt") or "")
+        with span("llm.completion", provider=provider, prompt_chars=prompt_chars) as call:
+            answer = await _complete_with_provider_async(provider, generation)
+            call.set("answer_chars", len(answer or ""))
+        if not (answer or "").strip():
+            raise EmptyProviderAnswer(f"{provider} returned an empty answer")
+    except Exception:
+        if scheduler is not None:
+            scheduler.record_failure(provider)
+        raise
+    latency = time.perf_counter() - started
+    record_provider_latency(provider, latency)
+    if scheduler is not None:
+        scheduler.record_success(provider, latency)
+    return answer
+
+
+async def _slotted_completion_async(
+    provider: str,
+    generation: Dict[str, Any],
+    slot: asyncio.Semaphore,
+    wait_until: float,
+) -> str:
+    if slot.locked():
+        try:
+            await asyncio.wait_for(slot.acquire(), timeout=max(0.0, wait_until - time.perf_counter()))
+        except asyncio.TimeoutError:
+            raise ProviderSaturated(provider) from None
+    else:
+        await slot.acquire()
+    try:
+        return await _timed_completion_async(provider, generation)
+    finally:
+        # И при отмене проигравшей задачи — вместе с её HTTP-запросом
+        slot.release()
+
+
+async def _complete_async(
+    order: List[str],
+    generation: Dict[str, Any],
+    meta: Dict[str, Any],
+    hedging: bool,
+) -> Optional[Tuple[str, str]]:
+    """
+    Асинхронный аналог _complete_hedged/_complete_serial.
+
+    Без hedging провайдеры опрашиваются строго по очереди. С hedging
+    резервный провайдер стартует, если текущий не ответил за _hedge_delay;
+    проигравшие задачи отменяются вместе с их HTTP-запросами. Ограничение
+    LLM_PROVIDER_MAX_CONCURRENCY — то же, что в синхронном пути.
+    """
+    remaining = list(order)
+    tried: List[str] = meta.setdefault("providers_tried", [])
+    max_extra = max(0, int(getattr(CONFIG, "llm_hedge_max_extra", 1))) if hedging else 0
+    tasks: Dict[asyncio.Task, Tuple[str, str]] = {}
+    hedges = 0
+    last_launch: Tuple[str, float] = ("", 0.0)
+    slot_wait_until = _slot_wait_until()
+
+    def launch(role: str) -> bool:
+        nonlocal last_launch
+        if not remaining:
+            return False
+        if role != "primary" and _deadline_expired():
+            logger.warning(f"LLM Router (async): request deadline expired, not starting {role} request")
+            return False
+        while remaining:
+            provider = remaining.pop(0)
+            slot = _async_provider_slot(provider)
+            if role == "hedge" and slot.locked():
+                _record_saturation(provider, meta, role)
+                continue
+            task = asyncio.ensure_future(_slotted_completion_async(provider, generation, slot, slot_wait_until))
+            tasks[task] = (provider, role)
+            tried.append(provider)
+            last_launch = (provider, time.perf_counter())
+            logger.info(
+                f"LLM Router (async): provider={provider} ({role}), mode={generation['mode']}, "
+                f"temperature={generation['temperature']}, top_p={generation['top_p']}"
             )
+            return True
+        return False
 
-            return {
-                "answer_markdown": filtered_answer,
-                "sources": sources,
-                "meta": meta,
-            }
+    launch("primary")
+    try:
+        while tasks:
+            timeout = None
+            if remaining and hedges < max_extra:
+                provider, launched_at = last_launch
+                timeout = max(0.0, launched_at + _hedge_delay(provider) - time.perf_counter())
+
+            done, _ = await asyncio.wait(list(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedges += 1
+                logger.info(f"LLM Router: provider {last_launch[0]} slower than hedge delay, starting hedge request")
+                if launch("hedge"):
+                    meta["hedged"] = True
+                continue
+
+            for task in done:
+                provider, role = tasks.pop(task)
+                try:
+                    answer = task.result()
+                except ProviderSaturated:
+                    tried.remove(provider)
+                    _record_saturation(provider, meta, role)
+                    continue
+                except Exception as exc:
+                    _report_provider_failure(provider, exc)
+                    continue
+                if hedging:
+                    _inc_metric(llm_hedge_wins_total, provider=provider, role=role)
+                return provider, answer
+
+            if not tasks:
+                launch("fallback")
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None
+
+
+async def generate_answer_async(
+    query: str,
+    context: List[Dict[str, Any]],
+    policy: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """
+    Асинхронный generate_answer: ожидание провайдеров не занимает поток.
+    Возвращает ту же структуру, что generate_answer.
+    """
+    generation = _prepare_generation(query, context, policy)
+    order = generation["order"]
+    hedging = bool(getattr(CONFIG, "llm_hedging_enabled", False))
+    logger.info(
+        f"LLM Router (async): mode={generation['mode']}, providers={' -> '.join(order)}, hedging={hedging}, "
+        f"context_docs={len(context)}, sources={len(generation['sources'])}"
+    )
+
+    meta = _answer_meta(generation)
+    if hedging:
+        meta["hedged"] = False
+    winner = await _complete_async(order, generation, meta, hedging)
+    if hedging:
+        _inc_metric(llm_hedge_requests_total, outcome="hedged" if meta["hedged"] else "unhedged")
+    return _build_answer(generation, meta, winner)
+
+
+def stream_answer(query: str, context: List[Dict[str, Any]], policy: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Потоковый вариант generate_answer.
+
+    Отдаёт события {"type": "delta", "text": ...} с уже отфильтрованным
+    по whitelist текстом и в конце {"type": "done", "answer_markdown",
+    "sources", "meta"} — та же структура, что у generate_answer.
+    Fallback на следующего провайдера возможен, пока клиенту не ушёл ни один
+    токен; обрыв после этого завершает ответ с meta.error="stream_interrupted".
+    """
+    generation = _prepare_generation(query, context, policy)
+    mode = generation["mode"]
+    sources = generation["sources"]
+    order = generation["order"]
+    logger.info(
+        f"LLM Router (stream): mode={mode}, providers={' -> '.join(order)}, "
+        f"context_docs={len(context)}, sources={len(sources)}"
+    )
+
+    meta: Dict[str, Any] = {
+        "mode": mode,
+        "temperature": generation["temperature"],
+        "top_p": generation["top_p"],
+        "provider": None,
+        "streamed": True,
+    }
+    if generation.get("context_stats"):
+        meta["context"] = generation["context_stats"]
+
+    scheduler = _scheduler()
+    for provider in order:
+        whitelist = StreamingUrlWhitelist(sources)
+        raw_len = 0
+        started = time.perf_counter()
+        try:
+            if scheduler is not None and not scheduler.allow(provider):
+                raise ProviderUnavailable(f"circuit breaker for {provider} is OPEN")
+            logger.info(f"LLM Router (stream): provider={provider}, mode={mode}")
+            for chunk in _stream_with_provider(provider, generation):
+                raw_len += len(chunk or "")
+                text = whitelist.feed(chunk)
+                if text:
+                    yield {"type": "delta", "text": text}
+            tail = whitelist.finish()
+            if tail:
+                yield {"type": "delta", "text": tail}
+            if not whitelist.text.strip():
+                raise EmptyProviderAnswer(f"{provider} returned an empty answer")
+            if scheduler is not None:
+                scheduler.record_success(provider, time.perf_counter() - started)
         except Exception as exc:
+            if scheduler is not None and not isinstance(exc, ProviderUnavailable):
+                scheduler.record_failure(provider)
             write_debug_event(
                 "llm.provider_error",
-                {"provider": provider, "error": f"{type(exc).__name__}: {exc}"},
+                {"provider": provider, "error": f"{type(exc).__name__}: {exc}", "streamed_chars": len(whitelist.text)},
             )
             logger.warning(
                 f"LLM Router: provider {provider} failed: {type(exc).__name__}: {exc}"
             )
-            continue
+            if not whitelist.text.strip():
+                # Клиент получил разве что пробелы — можно переключиться на следующего провайдера
+                continue
+            # Часть ответа уже у клиента — переключать провайдера поздно
+            tail = whitelist.finish()
+            if tail:
+                yield {"type": "delta", "text": tail}
+            meta["error"] = "stream_interrupted"
+
+        answer_markdown = whitelist.text
+        meta["provider"] = provider
+        meta["answer_length"] = len(answer_markdown)
+        write_debug_event(
+            "llm.answer",
+            {
+                "provider": provider,
+                "mode": mode,
+                "len": raw_len,
+                "preview": answer_markdown[:500],
+                "streamed": True,
+            },
+        )
+        yield {"type": "done", "answer_markdown": answer_markdown, "sources": sources, "meta": meta}
+        return
 
     logger.error("LLM Router: all providers failed")
-    failure_answer = "Извините, провайдеры LLM недоступны. Попробуйте позже."
     meta["error"] = "all_providers_failed"
-    return {
-        "answer_markdown": failure_answer,
-        "sources": sources,
-        "meta": meta,
-    }
+    yield {"type": "delta", "text": ALL_PROVIDERS_FAILED_ANSWER}
+    yield {"type": "done", "answer_markdown": ALL_PROVIDERS_FAILED_ANSWER, "sources": sources, "meta": meta}
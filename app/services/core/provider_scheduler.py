@@ -0,0 +1,151 @@
+"""
+Планировщик порядка LLM-провайдеров.
+
+Для каждого провайдера ведутся EWMA задержки успешного ответа и EWMA доли
+ошибок. Ожидаемая задержка = EWMA задержки + доля ошибок * штраф (ошибка
+означает fallback на следующего провайдера). Провайдеры сортируются по
+ожидаемой задержке, провайдеры с открытым circuit breaker пропускаются.
+Без статистики все провайдеры получают одинаковую априорную задержку,
+поэтому исходный (статический) порядок сохраняется.
+"""
+from __future__ import annotations
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from app.config import CONFIG
+from app.infrastructure.circuit_breaker import get_provider_circuit_breaker
+
+
+@dataclass
+class ProviderStats:
+    """Скользящая статистика одного провайдера."""
+
+    latency_ewma: Optional[float] = None
+    error_rate: float = 0.0
+    calls: int = 0
+    failures: int = 0
+    updated_at: float = 0.0
+
+
+class ProviderScheduler:
+    """Упорядочивает провайдеров по ожидаемой задержке ответа."""
+
+    def __init__(
+        self,
+        alpha: float = 0.3,
+        prior_latency: float = 5.0,
+        failure_penalty: float = 10.0,
+        error_half_life: float = 300.0,
+    ):
+        self.alpha = alpha
+        self.prior_latency = prior_latency
+        self.failure_penalty = failure_penalty
+        self.error_half_life = error_half_life
+        self._stats: Dict[str, ProviderStats] = {}
+        self._lock = threading.Lock()
+
+    def _decayed_error_rate(self, stats: ProviderStats, now: float) -> float:
+        # Без новых вызовов доля ошибок затухает, иначе провайдер, однажды
+        # ушедший в конец списка, больше никогда не получил бы шанса
+        if stats.error_rate <= 0.0 or self.error_half_life <= 0:
+            return stats.error_rate
+        age = max(0.0, now - stats.updated_at)
+        return stats.error_rate * 0.5 ** (age / self.error_half_life)
+
+    def allow(self, provider: str) -> bool:
+        """Разрешён ли вызов провайдера (после timeout открытый breaker пропускает пробный вызов)."""
+        return get_provider_circuit_breaker(provider).allow_request()
+
+    def record_success(self, provider: str, latency: float) -> None:
+        """Учитывает успешный ответ провайдера и его задержку."""
+        now = time.time()
+        with self._lock:
+            stats = self._stats.setdefault(provider, ProviderStats())
+            if stats.latency_ewma is None:
+                stats.latency_ewma = float(latency)
+            else:
+                stats.latency_ewma += self.alpha * (float(latency) - stats.latency_ewma)
+            stats.error_rate = (1 - self.alpha) * self._decayed_error_rate(stats, now)
+            stats.calls += 1
+            stats.updated_at = now
+        get_provider_circuit_breaker(provider).record_success()
+
+    def record_failure(self, provider: str) -> None:
+        """Учитывает ошибку провайдера (в том числе в его circuit breaker)."""
+        now = time.time()
+        with self._lock:
+            stats = self._stats.setdefault(provider, ProviderStats())
+            stats.error_rate = (1 - self.alpha) * self._decayed_error_rate(stats, now) + self.alpha
+            stats.calls += 1
+            stats.failures += 1
+            stats.updated_at = now
+        get_provider_circuit_breaker(provider).record_failure()
+
+    def expected_latency(self, provider: str) -> float:
+        """Ожидаемая задержка ответа провайдера с учётом доли ошибок."""
+        now = time.time()
+        with self._lock:
+            stats = self._stats.get(provider)
+            if stats is None:
+                return self.prior_latency
+            latency = stats.latency_ewma if stats.latency_ewma is not None else self.prior_latency
+            return latency + self._decayed_error_rate(stats, now) * self.failure_penalty
+
+    def order(self, providers: List[str]) -> List[str]:
+        """
+        Провайдеры по возрастанию ожидаемой задержки без открытых breakers.
+
+        Сортировка стабильная: при равных оценках сохраняется исходный порядок.
+        """
+        available: List[str] = []
+        for provider in providers:
+            if get_provider_circuit_breaker(provider).is_open():
+                logger.info(f"Provider scheduler: skipping {provider}, circuit breaker is OPEN")
+                continue
+            available.append(provider)
+        return sorted(available, key=self.expected_latency)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Текущая статистика для отладки и админских эндпоинтов."""
+        now = time.time()
+        with self._lock:
+            items = list(self._stats.items())
+        return {
+            provider: {
+                "latency_ewma": stats.latency_ewma,
+                "error_rate": round(self._decayed_error_rate(stats, now), 4),
+                "expected_latency": round(self.expected_latency(provider), 4),
+                "calls": stats.calls,
+                "failures": stats.failures,
+                "breaker": get_provider_circuit_breaker(provider).get_state()["state"],
+            }
+            for provider, stats in items
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+_scheduler: Optional[ProviderScheduler] = None
+_scheduler_lock = threading.Lock()
+
+
+def get_provider_scheduler() -> ProviderScheduler:
+    """Общий для процесса планировщик провайдеров."""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = ProviderScheduler(
+                    alpha=float(getattr(CONFIG, "llm_scheduler_ewma_alpha", 0.3)),
+                    prior_latency=float(getattr(CONFIG, "llm_scheduler_prior_latency_s", 5.0)),
+                    failure_penalty=float(getattr(CONFIG, "llm_scheduler_failure_penalty_s", 10.0)),
+                    error_half_life=float(getattr(CONFIG, "llm_scheduler_error_half_life_s", 300.0)),
+                )
+    return _scheduler
@@ -234,6 +234,28 @@ def get_strategy_for_query(query: str) -> tuple[QueryType, RetrievalStrategy]:
     return query_type, strategy
 
 
+# Ограничения облегчённой стратегии для запросов, принятых при перегрузке (admission control)
+DEGRADED_STRATEGY_LIMITS: Dict[str, int] = {"k": 10, "rerank_top_n": 3}
+
+
+def get_degraded_strategy(strategy: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Облегчённый вариант стратегии: меньше кандидатов поиска и документов
+    в контексте, без auto-merge.
+
+    Args:
+        strategy: Стратегия в формате RetrievalStrategy.to_dict()
+
+    Returns:
+        Новый словарь стратегии
+    """
+    degraded = dict(strategy)
+    for key, limit in DEGRADED_STRATEGY_LIMITS.items():
+        degraded[key] = min(int(strategy.get(key, limit)), limit)
+    degraded["use_auto_merge"] = False
+    return degraded
+
+
 # =============================================================================
 # Existing Query Processing Functions
 # =============================================================================
@@ -90,6 +90,45 @@ class UnifiedQualityManager:
             logger.error(f"Failed to save interaction for feedback: {e}")
             return False
 
+    async def save_interactions_for_feedback(self, interactions: List[Dict[str, Any]]) -> int:
+        """
+        Сохраняет пачку взаимодействий для feedback (вызывается фоновой очередью).
+
+        У quality_db нет пакетной вставки: записи сохраняются по одной через
+        save_interaction, пачка лишь экономит пробуждения фонового потока.
+
+        Args:
+            interactions: словари с полями interaction_id, query, response, contexts, sources
+
+        Returns:
+            Количество сохранённых взаимодействий
+        """
+        if not CONFIG.quality_db_enabled or not interactions:
+            return 0
+
+        created_at = datetime.utcnow()
+        records = [
+            QualityInteractionData(
+                interaction_id=item["interaction_id"],
+                query=item["query"],
+                response=item["response"],
+                contexts=item["contexts"],
+                sources=item["sources"],
+                ragas_faithfulness=None,
+                ragas_context_precision=None,
+                ragas_answer_relevancy=None,
+                ragas_overall_score=None,
+                combined_score=None,
+                created_at=created_at
+            )
+            for item in interactions
+        ]
+
+        for record in records:
+            await quality_db.save_interaction(record)
+        logger.info(f"Saved {len(records)} interactions for feedback")
+        return len(records)
+
     async def evaluate_interaction(
         self,
         query: str,
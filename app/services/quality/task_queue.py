@@ -0,0 +1,236 @@
+"""
+Фоновая очередь задач качества: сохранение взаимодействий для feedback и
+RAGAS-оценка.
+
+Запрос только кладёт задачу в ограниченную очередь и сразу отвечает
+пользователю. Единственный фоновый поток держит собственный event loop на
+всё время жизни процесса и:
+- сохраняет взаимодействия пачками (до batch_size штук или flush_interval
+  ожидания; в БД записи пачки пишутся по одной);
+- запускает RAGAS только для доли запросов sample_rate и только когда
+  очередь сохранения пуста — под нагрузкой оценки откладываются, а при
+  переполнении буфера отложенных отбрасываются самые старые.
+"""
+from __future__ import annotations
+
+import asyncio
+import atexit
+import queue
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Deque, List, Optional
+
+from loguru import logger
+
+from app.config import CONFIG
+from app.infrastructure.metrics import quality_queue_depth, quality_tasks_total
+
+
+@dataclass
+class QualityInteraction:
+    interaction_id: str
+    query: str
+    response: str
+    contexts: List[str]
+    sources: List[str]
+
+
+SaveBatchFn = Callable[[List[QualityInteraction]], Awaitable[Any]]
+EvaluateFn = Callable[[QualityInteraction], Awaitable[Any]]
+
+_STOP = object()
+
+
+class QualityTaskQueue:
+    """Ограниченная очередь с одним фоновым воркером и постоянным event loop."""
+
+    def __init__(
+        self,
+        save_batch: SaveBatchFn,
+        evaluate: EvaluateFn,
+        max_queue_size: int = 1000,
+        batch_size: int = 20,
+        flush_interval_s: float = 1.0,
+        sample_rate: float = 1.0,
+        max_pending_evaluations: int = 50,
+        evaluation_timeout_s: float = 60.0,
+        name: str = "quality",
+    ):
+        if max_queue_size <= 0 or batch_size <= 0:
+            raise ValueError("max_queue_size and batch_size must be positive")
+        self.save_batch = save_batch
+        self.evaluate = evaluate
+        self.batch_size = batch_size
+        self.flush_interval = max(0.0, flush_interval_s)
+        self.sample_rate = min(1.0, max(0.0, sample_rate))
+        self.evaluation_timeout = evaluation_timeout_s
+        self.name = name
+        self._queue: "queue.Queue[object]" = queue.Queue(maxsize=max_queue_size)
+        self._evaluations: Deque[QualityInteraction] = deque(maxlen=max(1, max_pending_evaluations))
+        self._evaluations_lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    # ------------------------------------------------------------------ API
+
+    def enqueue_interaction(self, interaction: QualityInteraction) -> bool:
+        """Поставить сохранение в очередь; False — задача отброшена (очередь заполнена)."""
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(interaction)
+        except queue.Full:
+            self._count("save", "dropped")
+            logger.warning(f"Quality queue is full, interaction {interaction.interaction_id} dropped")
+            return False
+        quality_queue_depth.labels(kind="save").set(self._queue.qsize())
+        return True
+
+    def enqueue_evaluation(self, interaction: QualityInteraction) -> bool:
+        """Отложить RAGAS-оценку (с учётом sample_rate); False — оценка не будет выполнена."""
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self._count("evaluate", "sampled_out")
+            return False
+        self._ensure_worker()
+        with self._evaluations_lock:
+            if len(self._evaluations) == self._evaluations.maxlen:
+                # Самая старая оценка вытесняется новой
+                self._count("evaluate", "dropped")
+            self._evaluations.append(interaction)
+            quality_queue_depth.labels(kind="evaluate").set(len(self._evaluations))
+        return True
+
+    def queue_depth(self) -> dict:
+        with self._evaluations_lock:
+            pending = len(self._evaluations)
+        return {"save": self._queue.qsize(), "evaluate": pending}
+
+    def shutdown(self, timeout: float = 5.0) -> None:
+        """Остановить воркер, дописав уже поставленные сохранения (оценки не ждём)."""
+        worker = self._worker
+        if worker is None:
+            return
+        self._queue.put(_STOP)
+        worker.join(timeout=timeout)
+        self._worker = None
+
+    # ------------------------------------------------------------- internals
+
+    def _count(self, kind: str, outcome: str, amount: int = 1) -> None:
+        quality_tasks_total.labels(kind=kind, outcome=outcome).inc(amount)
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name=f"{self.name}-tasks", daemon=True)
+                self._worker.start()
+
+    def _collect_batch(self, first: QualityInteraction) -> tuple[List[QualityInteraction], bool]:
+        batch = [first]
+        deadline = time.perf_counter() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)  # type: ignore[arg-type]
+        return batch, False
+
+    def _next_evaluation(self) -> Optional[QualityInteraction]:
+        with self._evaluations_lock:
+            interaction = self._evaluations.popleft() if self._evaluations else None
+            quality_queue_depth.labels(kind="evaluate").set(len(self._evaluations))
+        return interaction
+
+    def _run(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                with self._evaluations_lock:
+                    idle_work = bool(self._evaluations)
+                try:
+                    # Сохранения важнее: отложенные оценки выполняются, только если очередь пуста
+                    item = self._queue.get_nowait() if idle_work else self._queue.get(timeout=self.flush_interval or 0.1)
+                except queue.Empty:
+                    interaction = self._next_evaluation()
+                    if interaction is not None:
+                        loop.run_until_complete(self._evaluate(interaction))
+                    continue
+                if item is _STOP:
+                    return
+                batch, stop = self._collect_batch(item)  # type: ignore[arg-type]
+                quality_queue_depth.labels(kind="save").set(self._queue.qsize())
+                loop.run_until_complete(self._save(batch))
+                if stop:
+                    return
+        finally:
+            loop.close()
+
+    async def _save(self, batch: List[QualityInteraction]) -> None:
+        try:
+            await self.save_batch(batch)
+        except Exception as e:
+            logger.error(f"Failed to save {len(batch)} interactions for feedback: {e}")
+            self._count("save", "failed", len(batch))
+            return
+        self._count("save", "processed", len(batch))
+        logger.debug(f"Saved {len(batch)} interactions for feedback")
+
+    async def _evaluate(self, interaction: QualityInteraction) -> None:
+        try:
+            await asyncio.wait_for(self.evaluate(interaction), timeout=self.evaluation_timeout)
+        except Exception as e:
+            logger.error(f"RAGAS evaluation failed in background ({interaction.interaction_id}): {e!r}")
+            self._count("evaluate", "failed")
+            return
+        self._count("evaluate", "processed")
+
+
+async def _save_with_quality_manager(batch: List[QualityInteraction]) -> None:
+    from app.services.quality.quality_manager import quality_manager
+
+    await quality_manager.save_interactions_for_feedback([vars(item) for item in batch])
+
+
+async def _evaluate_with_quality_manager(interaction: QualityInteraction) -> None:
+    from app.services.quality.quality_manager import quality_manager
+
+    await quality_manager.evaluate_interaction(
+        query=interaction.query,
+        response=interaction.response,
+        contexts=interaction.contexts,
+        sources=interaction.sources,
+        interaction_id=interaction.interaction_id,
+    )
+
+
+_task_queue: Optional[QualityTaskQueue] = None
+_task_queue_lock = threading.Lock()
+
+
+def get_quality_task_queue() -> QualityTaskQueue:
+    """Общая для процесса очередь задач качества."""
+    global _task_queue
+    if _task_queue is None:
+        with _task_queue_lock:
+            if _task_queue is None:
+                _task_queue = QualityTaskQueue(
+                    save_batch=_save_with_quality_manager,
+                    evaluate=_evaluate_with_quality_manager,
+                    max_queue_size=int(getattr(CONFIG, "quality_queue_max_size", 1000)),
+                    batch_size=int(getattr(CONFIG, "quality_queue_batch_size", 20)),
+                    flush_interval_s=float(getattr(CONFIG, "quality_queue_flush_interval_s", 1.0)),
+                    sample_rate=float(getattr(CONFIG, "ragas_evaluation_sample_rate", 1.0)),
+                    max_pending_evaluations=int(getattr(CONFIG, "ragas_max_pending", 50)),
+                    evaluation_timeout_s=float(getattr(CONFIG, "ragas_async_timeout", 60)),
+                )
+                atexit.register(_task_queue.shutdown)
+    return _task_queue
@@ -0,0 +1,6 @@
+from __future__ import annotations
+
+from app.asgi import create_asgi_app
+
+# Production: uvicorn asgi:app --host 0.0.0.0 --port 9000 --workers 2
+app = create_asgi_app()
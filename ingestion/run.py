@@ -24,6 +24,7 @@ from ingestion.pipeline.indexers.qdrant_writer import QdrantWriter
 from ingestion.pipeline.dag import PipelineDAG
 from ingestion.state.state_manager import get_state_manager
 from app.config.app_config import CONFIG
+from app.infrastructure.caching import bump_collection_generation
 from ingestion.metadata.docusaurus import DocusaurusMetadataMapper
 
 
@@ -317,6 +318,11 @@ def run_unified_indexing(
         # Запускаем обработку через DAG
         logger.info("🔄 Запуск обработки через DAG...")
         stats = dag.run(documents)
+        # Данные коллекции изменились: объединение запросов и кэш ответов
+        # больше не должны отдавать результаты, посчитанные на старых данных
+        bump_collection_generation(
+            writer.collection_name if isinstance(writer, QdrantWriter) else config.get("collection_name")
+        )
 
         # Сохраняем состояние
         with get_state_manager() as state_manager: